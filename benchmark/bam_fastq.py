@@ -0,0 +1,69 @@
+"""Benchmark converting unmapped reads from BAM to FASTQ
+
+Writes a BAM file of unmapped reads like the one TopHat leaves in
+unmapped.bam and reports how many records per second tophat.write_fastq
+converts to FASTQ, compared with building a SeqRecord for each read.
+
+	python benchmark/bam_fastq.py --reads 1000000
+"""
+
+import argparse, random, tempfile, shutil, time, os.path, pysam
+from Bio import SeqIO
+
+from waistcoat import tophat
+
+def generate(fname, reads, length=30, seed=0):
+	"""Write reads unmapped reads to the BAM file fname"""
+	rand = random.Random(seed)
+	header = {'HD': {'VN': '1.0'}, 'SQ': [{'SN': 'chr', 'LN': 1000}]}
+	samfile = pysam.Samfile(fname, 'wb', header=header)
+	for i in xrange(reads):
+		read = pysam.AlignedRead()
+		read.qname = "read{}".format(i)
+		read.seq = ''.join(rand.choice("ATCG") for k in range(length))
+		read.qual = ''.join(rand.choice("#5?I") for k in range(length))
+		read.flag = 4
+		read.tid = -1
+		read.pos = -1
+		samfile.write(read)
+	samfile.close()
+
+def seqrecords(samfile, outfile):
+	"""Convert the way discard_mapped used to, one SeqRecord at a time"""
+	count = 0
+	for read in samfile:
+		count += 1
+		SeqIO.write(tophat.build_fastq(read), outfile, 'fastq')
+	return count
+
+def time_conversion(fn, bam, out):
+	samfile = pysam.Samfile(bam, 'rb')
+	start = time.time()
+	with open(out, 'wb', tophat.FASTQ_BUFFER) as outfile:
+		count = fn(samfile, outfile)
+	elapsed = time.time() - start
+	samfile.close()
+	return (count, elapsed)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--reads', type=int, default=1000000,
+			help='Number of reads to generate [1000000]')
+	args = parser.parse_args()
+
+	tempdir = tempfile.mkdtemp(prefix='waistcoat_bench')
+	try:
+		bam = os.path.join(tempdir, 'unmapped.bam')
+		generate(bam, args.reads)
+
+		for name,fn in (('SeqRecord', seqrecords), 
+				('write_fastq', tophat.write_fastq),):
+			(count, elapsed) = time_conversion(fn, bam, 
+					os.path.join(tempdir, name + '.fq'))
+			print "{}: {} records in {:.2f}s, {:.0f} records/s".format(name, count,
+					elapsed, count / elapsed)
+	finally:
+		shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,68 @@
+"""Benchmark UMI deduplication in preprocess.process_sample
+
+Generates a synthetic single sample FASTQ file of barcoded, UMI-tagged reads
+and reports how many reads per second process_sample can deduplicate.
+
+	python benchmark/dedup.py --reads 10000000 --umi 4
+"""
+
+import argparse, random, tempfile, shutil, time, os.path
+
+from waistcoat import preprocess, settings, statistics
+
+BARCODE = "TCCA"
+
+def generate(fname, reads, umi_length, duplication=0.5, length=28, seed=0):
+	"""Write reads to fname, roughly a fraction of duplication are duplicates"""
+	rand = random.Random(seed)
+	barcode_format = "BBB" + "N"*umi_length + "B"
+	qual = 'I' * (len(barcode_format) + length + 1)
+	seen = []
+	with open(fname, 'wb') as f:
+		for i in xrange(reads):
+			if seen and rand.random() < duplication:
+				seq = rand.choice(seen)
+			else:
+				umi = ''.join(rand.choice("ATCG") for k in range(umi_length))
+				seq = (BARCODE[:3] + umi + BARCODE[3] + 
+						''.join(rand.choice("ATCG") for k in range(length)) + 'G')
+				if len(seen) < 100000:
+					seen.append(seq)
+				else:
+					seen[rand.randrange(len(seen))] = seq
+			f.write("@read{}\n{}\n+\n{}\n".format(i, seq, qual))
+	return barcode_format
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--reads', type=int, default=1000000,
+			help='Number of reads to generate [1000000]')
+	parser.add_argument('--umi', type=int, default=4,
+			help='Length of the UMI [4]')
+	parser.add_argument('--duplication', type=float, default=0.5,
+			help='Approximate fraction of duplicate reads [0.5]')
+	args = parser.parse_args()
+
+	preprocess.verbose = False
+	statistics.recording = False
+
+	tempdir = tempfile.mkdtemp(prefix='waistcoat_bench')
+	try:
+		reads = os.path.join(tempdir, 'reads.fq')
+		barcode_format = generate(reads, args.reads, args.umi, args.duplication)
+		s = settings.Settings({
+			'barcodes': {'sample': BARCODE,},
+			'barcode_format': barcode_format,
+			'target': 'null',})
+
+		start = time.time()
+		preprocess.process_sample({'sample': (reads, args.reads,),}, s, tempdir)
+		elapsed = time.time() - start
+
+		print "{} reads, {}nt UMI: {:.2f}s, {:.0f} reads/s".format(args.reads,
+				args.umi, elapsed, args.reads / elapsed)
+	finally:
+		shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,281 @@
+"""Benchmark the preprocess extension on synthetic reads at several scales
+
+Generates barcoded, UMI-tagged FASTQ with a controlled duplication rate, read
+length distribution and number of samples, then times
+preprocess.split_by_barcode, preprocess.process_sample and preprocess.run, in
+one pass and in two, on it, and preprocess.collapse on the cleaned reads.
+Each is run in its own process, so that its peak memory can be reported.
+Results can be saved and compared against an earlier run to catch regressions.
+
+	python benchmark/preprocess_suite.py --reads 1M 10M --samples 4 \\
+			--save results.json
+	python benchmark/preprocess_suite.py --reads 1M 10M --samples 4 \\
+			--baseline results.json
+"""
+
+import argparse, tempfile, shutil, time, traceback, os, os.path, sys
+import numpy
+import simplejson as json
+
+from waistcoat import preprocess, settings, statistics
+
+BASES = numpy.frombuffer('ACGT', dtype=numpy.uint8)
+#reads are generated this many at a time
+CHUNK = 1 << 16
+#duplicates are copies of one of the last POOL distinct reads
+POOL = 1 << 17
+
+def parse_count(s):
+	"""Read a number of reads such as 100000, 10M or 1.5k"""
+	scale = {'k': 10**3, 'M': 10**6, 'G': 10**9,}
+	if s[-1] in scale:
+		return int(float(s[:-1]) * scale[s[-1]])
+	return int(s)
+
+def barcodes(samples, length, rand):
+	"""Return {sample: barcode} of random barcodes which differ from each other
+	at at least 2 positions where possible"""
+	ret = []
+	for attempt in xrange(100000):
+		if len(ret) == samples:
+			break
+		b = BASES[rand.randint(0, 4, length)].tostring()
+		if all(sum(x != y for x,y in zip(b, o)) >= min(2, length) for o in ret):
+			ret.append(b)
+	else:
+		raise ValueError("Can't find {} barcodes of length {}".format(samples,
+			length))
+	return dict(("sample_{}".format(i), b) for i,b in enumerate(ret))
+
+def generate(fname, reads, barcode_format, samples, duplication=0.5,
+		length_mean=28., length_sd=3., min_length=18, max_length=40,
+		polya=0.3, unmatched=0.05, seed=0):
+	"""Write reads to fname and return their {sample: barcode}.
+	A fraction duplication of reads repeat an earlier read, including its UMI,
+	insert lengths are normally distributed and clipped to [min_length,
+	max_length], a fraction polya have a poly-A tail and a fraction unmatched
+	have a barcode which belongs to no sample"""
+	rand = numpy.random.RandomState(seed)
+	b_cols = [i for i,c in enumerate(barcode_format) if c == 'B']
+	samples = barcodes(samples, len(b_cols), rand)
+	codes = numpy.array([numpy.frombuffer(b, dtype=numpy.uint8)
+		for s,b in sorted(samples.iteritems())])
+
+	header = len(barcode_format)
+	width = header + max_length + 20
+	qual = 'I' * width
+	pool = numpy.zeros((0, width), dtype=numpy.uint8)
+	pool_lengths = numpy.zeros(0, dtype=numpy.int64)
+
+	with open(fname, 'wb') as f:
+		for start in xrange(0, reads, CHUNK):
+			n = min(CHUNK, reads - start)
+			rows = BASES[rand.randint(0, 4, (n, width))]
+
+			#barcodes, mostly from one of the samples
+			which = rand.randint(0, len(codes), n)
+			rows[:, b_cols] = codes[which]
+			stray = rand.random_sample(n) < unmatched
+			rows[numpy.ix_(stray, b_cols)] = BASES[rand.randint(0, 4,
+				(stray.sum(), len(b_cols)))]
+
+			#insert lengths, with some poly-A tails
+			lengths = numpy.clip(numpy.rint(rand.normal(length_mean, length_sd, n)),
+					min_length, max_length).astype(numpy.int64) + header
+			tails = numpy.where(rand.random_sample(n) < polya,
+					rand.randint(1, 21, n), 0)
+			for i in numpy.flatnonzero(tails):
+				rows[i, lengths[i]:lengths[i] + tails[i]] = ord('A')
+			lengths += tails
+
+			#duplicates copy a recent distinct read
+			dup = rand.random_sample(n) < duplication
+			pool = numpy.concatenate((pool, rows[~dup]))[-POOL:]
+			pool_lengths = numpy.concatenate((pool_lengths, lengths[~dup]))[-POOL:]
+			if len(pool):
+				src = rand.randint(0, len(pool), dup.sum())
+				rows[dup] = pool[src]
+				lengths[dup] = pool_lengths[src]
+
+			data = rows.tostring()
+			f.write(''.join("@r{}\n{}\n+\n{}\n".format(start + i,
+				data[i*width:i*width + l], qual[:l])
+				for i,l in enumerate(lengths.tolist())))
+
+	return samples
+
+def measure(fn, *args):
+	"""Call fn(*args) in a child process. Returns (seconds, peak RSS in kB)"""
+	(r, w) = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+		code = 1
+		try:
+			start = time.time()
+			fn(*args)
+			os.write(w, repr(time.time() - start))
+			code = 0
+		except:
+			traceback.print_exc()
+		finally:
+			os._exit(code)
+
+	os.close(w)
+	with os.fdopen(r) as f:
+		elapsed = f.read()
+	(pid, status, usage) = os.wait4(pid, 0)
+	if status != 0:
+		raise RuntimeError("Benchmark of {} failed".format(fn.__name__))
+	return (float(elapsed), usage.ru_maxrss)
+
+def split_by_barcode(reads, s, workdir, workers):
+	preprocess.split_by_barcode(reads, s, workdir, False)
+
+def process_sample(reads, s, workdir, workers, split):
+	preprocess.process_sample(split, s, workdir, False, workers)
+
+def run(reads, s, workdir, workers):
+	preprocess.run(reads, s, workdir, False, workers)
+
+def run_two_pass(reads, s, workdir, workers):
+	preprocess.run(reads, s, workdir, False, workers, 0, False)
+
+def collapse(reads, s, workdir, workers, files):
+	preprocess.collapse(files, os.path.join(workdir, 'collapsed.fq'),
+			os.path.join(workdir, 'collapsed.counts'))
+
+def benchmark(reads, count, samples, barcode_format, workers, tempdir):
+	"""Time each stage on reads, returning {stage: result}"""
+	s = settings.Settings({
+		'barcodes': samples,
+		'barcode_format': barcode_format,
+		'target': 'null',})
+
+	results = {}
+	def record(stage, (elapsed, peak)):
+		results[stage] = {'seconds': elapsed, 'reads_per_s': count / elapsed,
+				'peak_rss_kb': peak,}
+		print "\t{:<18s} {:>8.2f}s {:>12.0f} reads/s {:>10.1f}MB".format(stage,
+				elapsed, count / elapsed, peak / 1024.)
+
+	workdir = tempfile.mkdtemp(dir=tempdir)
+	record('split_by_barcode', measure(split_by_barcode, reads, s, workdir,
+		workers))
+	shutil.rmtree(workdir)
+
+	#process_sample needs the split reads, made here without being timed
+	workdir = tempfile.mkdtemp(dir=tempdir)
+	split = preprocess.split_by_barcode(reads, s, workdir, False)
+	record('process_sample', measure(process_sample, reads, s, workdir, workers,
+		split))
+	shutil.rmtree(workdir)
+
+	for fn in [run, run_two_pass,]:
+		workdir = tempfile.mkdtemp(dir=tempdir)
+		record(fn.__name__, measure(fn, reads, s, workdir, workers))
+		shutil.rmtree(workdir)
+
+	#collapse needs the cleaned reads, made here without being timed
+	workdir = tempfile.mkdtemp(dir=tempdir)
+	files = preprocess.run(reads, s, workdir, False, workers)
+	record('collapse', measure(collapse, reads, s, workdir, workers,
+		files.values()))
+	shutil.rmtree(workdir)
+
+	return results
+
+def compare(results, baseline, tolerance):
+	"""Print and return the measurements which are worse than baseline by more
+	than a fraction tolerance"""
+	regressions = []
+	for scale, stages in sorted(results.iteritems()):
+		for stage, r in sorted(stages.iteritems()):
+			b = baseline.get(scale, {}).get(stage)
+			if b is None:
+				continue
+			if r['reads_per_s'] < b['reads_per_s'] * (1. - tolerance):
+				regressions.append((scale, stage, 'reads_per_s', b['reads_per_s'],
+					r['reads_per_s']))
+			if r['peak_rss_kb'] > b['peak_rss_kb'] * (1. + tolerance):
+				regressions.append((scale, stage, 'peak_rss_kb', b['peak_rss_kb'],
+					r['peak_rss_kb']))
+	for (scale, stage, name, before, after) in regressions:
+		print "REGRESSION {} reads, {}: {} {:.0f} -> {:.0f}".format(scale, stage,
+				name, before, after)
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--reads', nargs='+', default=['1M',],
+			help='Numbers of reads to benchmark, e.g. 1M 10M 100M [1M]')
+	parser.add_argument('--samples', type=int, default=4,
+			help='Number of samples [4]')
+	parser.add_argument('--barcode-format', default='BBBNNNNBB',
+			help='Barcode format, B for barcode and N for UMI [BBBNNNNBB]')
+	parser.add_argument('--duplication', type=float, default=0.5,
+			help='Fraction of duplicate reads [0.5]')
+	parser.add_argument('--length-mean', type=float, default=28.,
+			help='Mean insert length [28]')
+	parser.add_argument('--length-sd', type=float, default=3.,
+			help='Standard deviation of the insert length [3]')
+	parser.add_argument('--workers', type=int, default=1,
+			help='Worker threads for process_sample and run [1]')
+	parser.add_argument('--seed', type=int, default=0,
+			help='Random seed, the same seed generates the same reads [0]')
+	parser.add_argument('--data', default=None,
+			help='Directory to keep generated reads in between runs')
+	parser.add_argument('--save', default=None,
+			help='Save the results as JSON')
+	parser.add_argument('--baseline', default=None,
+			help='Compare with results saved by an earlier run')
+	parser.add_argument('--tolerance', type=float, default=0.1,
+			help='Fraction by which a measurement may get worse [0.1]')
+	args = parser.parse_args()
+
+	preprocess.verbose = False
+	statistics.recording = False
+
+	tempdir = tempfile.mkdtemp(prefix='waistcoat_bench')
+	datadir = args.data or tempdir
+	if not os.path.exists(datadir):
+		os.makedirs(datadir)
+	results = {}
+	try:
+		for scale in args.reads:
+			count = parse_count(scale)
+			reads = os.path.join(datadir, "reads_{}_{}_{}_{}_{}_{}_{}.fq".format(
+				count, args.samples, args.barcode_format, args.duplication,
+				args.length_mean, args.length_sd, args.seed))
+			if os.path.exists(reads + '.json'):
+				with open(reads + '.json') as f:
+					samples = json.loads(f.read())
+			else:
+				start = time.time()
+				samples = generate(reads, count, args.barcode_format, args.samples,
+						args.duplication, args.length_mean, args.length_sd,
+						seed=args.seed)
+				with open(reads + '.json', 'wb') as f:
+					f.write(json.dumps(samples))
+				print "Generated {} reads in {:.1f}s".format(count,
+						time.time() - start)
+
+			print "{} reads, {} samples, {:.0%} duplicates:".format(count,
+					args.samples, args.duplication)
+			results[scale] = benchmark(reads, count, samples, args.barcode_format,
+					args.workers, tempdir)
+	finally:
+		shutil.rmtree(tempdir)
+
+	if args.save:
+		with open(args.save, 'wb') as f:
+			f.write(json.dumps(results, indent=1, sort_keys=True))
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.loads(f.read())
+		if compare(results, baseline, args.tolerance):
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -5,7 +5,8 @@ def read(fname):
 	return open(os.path.join(os.path.dirname(__file__), fname)).read()
 
 preprocess = Extension('waistcoat.preprocess', 
-		sources=['waistcoat/preprocess.c',])
+		sources=['waistcoat/preprocess.c',],
+		libraries=['z', 'pthread',])
 
 setup(
     name = "waistcoat",
@@ -13,7 +14,7 @@ setup(
     packages = find_packages(),
 		ext_modules = [preprocess,],
 
-    install_requires = ['pysam>=0.7'],
+    install_requires = ['pysam>=0.7', 'numpy'],
 
 		test_suite = 'test',
 
@@ -0,0 +1,148 @@
+from waistcoat import bowtie2
+import unittest, os, os.path, tempfile, shutil, subprocess, gzip, pysam
+from Bio import SeqIO
+
+DATA_DIR = os.path.join( os.path.split(__file__)[0], "data/")
+
+index_files = ['test_ref.1.bt2',
+							 'test_ref.2.bt2',
+							 'test_ref.3.bt2',
+							 'test_ref.4.bt2',
+							 'test_ref.rev.1.bt2',
+							 'test_ref.rev.2.bt2',
+							 'test_ref_two.1.bt2',
+							 'test_ref_two.2.bt2',
+							 'test_ref_two.3.bt2',
+							 'test_ref_two.4.bt2',
+							 'test_ref_two.rev.1.bt2',
+							 'test_ref_two.rev.2.bt2',]
+
+class Bowtie2TestOptions(unittest.TestCase):
+	"""Test the Bowtie2 class options"""
+
+	def test_getOptions(self):
+		"""Test that Bowtie2.getOptions works"""
+		b = bowtie2.Bowtie2()
+		self.assertEqual(b.getOptions(), [])
+
+		b.b2_N = 1
+		self.assertEqual(b.getOptions(), ['-N', '1',])
+		b.b2_N = None
+
+		b.b2_very_fast = True
+		self.assertEqual(b.getOptions(), ['--very-fast',])
+		b.b2_very_fast = False
+		self.assertEqual(b.getOptions(), [])
+
+	def test_from_settings(self):
+		"""Test that TopHat settings are translated and TopHat-only ones ignored"""
+		b = bowtie2.bowtie2_from_settings({
+			'_comment': 'ignored',
+			'num_threads': 4,
+			'b2_score_min': 'L,0,-0.2',
+			'max_insertion_length': 5,})
+		self.assertEqual(sorted(b.getOptions()),
+				sorted(['--threads', '4', '--score-min', 'L,0,-0.2',]))
+
+	def test_invalid_settings(self):
+		"""Test that invalid settings are rejected"""
+		self.assertRaises(TypeError, bowtie2.bowtie2_from_settings,
+				{'b2_N': 'one'})
+		self.assertRaises(ValueError, bowtie2.bowtie2_from_settings,
+				{'not_an_option': 1})
+
+	def test_summary(self):
+		"""Test reading the number of unaligned reads from the summary"""
+		self.assertEqual(bowtie2._unaligned(
+			"10000 reads; of these:\n" +
+			"  10000 (100.00%) were unpaired; of these:\n" +
+			"    596 (5.96%) aligned 0 times\n" +
+			"    9404 (94.04%) aligned exactly 1 time\n" +
+			"    0 (0.00%) aligned >1 times\n" +
+			"94.04% overall alignment rate\n"), 596)
+		self.assertEqual(bowtie2._unaligned(
+			"0 reads\n0.00% overall alignment rate\n"), 0)
+		self.assertRaises(ValueError, bowtie2._unaligned, "Error: bad index\n")
+
+	def test_args(self):
+		"""Test that alignments are only kept when asked for"""
+		b = bowtie2.Bowtie2()
+		args = b.args('idx', 'in.fq', 'un.fq')
+		self.assertEqual(args[args.index('-S') + 1], os.devnull)
+		self.assertTrue('--un' in args and '--no-unal' not in args)
+
+		args = b.args('idx', 'in.fq', 'un.fq.gz', True, 'out.sam')
+		self.assertEqual(args[args.index('-S') + 1], 'out.sam')
+		self.assertTrue('--un-gz' in args and '--no-unal' in args and
+				'--end-to-end' in args)
+
+class Bowtie2TestRun(unittest.TestCase):
+	"""Test that reads can be discarded by piping through bowtie2"""
+
+	def setUp(self):
+		self.output = tempfile.mkdtemp(prefix='test')
+		data = os.path.join(DATA_DIR, 'tophat_data/')
+		for f in index_files + ['reads_1.fq',]:
+			shutil.copyfile(os.path.join(data, f), os.path.join(self.output,f))
+		self.reads = os.path.join(self.output, 'reads_1.fq')
+		self.input = [str(r.seq) for r in SeqIO.parse(self.reads, 'fastq')]
+
+	def tearDown(self):
+		shutil.rmtree(self.output)
+
+	def test_discard_mapped(self):
+		"""Test discarding against two indexes in one pass"""
+		indexes = [(os.path.join(self.output, 'test_ref'), {}),
+				(os.path.join(self.output, 'test_ref_two'), {'num_threads': 2}),]
+
+		(fname, counts) = bowtie2.discard_mapped(self.reads, indexes)
+
+		self.assertEqual(fname,
+				os.path.join(self.output, 'reads_1_nomapping.fq'))
+		self.assertFalse(os.path.exists(self.reads))
+
+		kept = [str(r.seq) for r in SeqIO.parse(fname, 'fastq')]
+		self.assertEqual(len(counts), 2)
+		self.assertEqual(counts[-1], len(kept))
+		self.assertTrue(len(self.input) >= counts[0] >= counts[1])
+		self.assertTrue(set(kept) <= set(self.input))
+
+	def test_discard_compressed(self):
+		"""Test that the reads kept can be gzipped"""
+		indexes = [(os.path.join(self.output, 'test_ref'), {}),]
+
+		(fname, counts) = bowtie2.discard_mapped(self.reads, indexes, compress=1)
+
+		self.assertEqual(fname,
+				os.path.join(self.output, 'reads_1_nomapping.fq.gz'))
+		with gzip.open(fname) as f:
+			kept = [str(r.seq) for r in SeqIO.parse(f, 'fastq')]
+		self.assertEqual(counts[-1], len(kept))
+		self.assertTrue(set(kept) <= set(self.input))
+
+	def test_map_reads(self):
+		"""Test mapping reads end-to-end, keeping those which don't align"""
+		bam = os.path.join(self.output, 'premapped.bam')
+		(fname, count) = bowtie2.map_reads(self.reads, 
+				os.path.join(self.output, 'test_ref'), {}, bam)
+
+		self.assertEqual(fname, os.path.join(self.output, 'reads_1_unaligned.fq'))
+		self.assertTrue(os.path.exists(self.reads))
+		unaligned = [str(r.seq) for r in SeqIO.parse(fname, 'fastq')]
+		self.assertEqual(count, len(unaligned))
+
+		samfile = pysam.Samfile(bam, 'rb')
+		aligned = list(samfile)
+		samfile.close()
+		self.assertTrue(all(not r.is_unmapped for r in aligned))
+		self.assertEqual(len(aligned) + count, len(self.input))
+		positions = [(r.tid, r.pos) for r in aligned]
+		self.assertEqual(positions, sorted(positions))
+
+	def test_failure(self):
+		"""Test that a bowtie2 failure is reported"""
+		indexes = [(os.path.join(self.output, 'test_ref'), {}),
+				(os.path.join(self.output, 'not_an_index'), {}),]
+
+		self.assertRaises(subprocess.CalledProcessError,
+				bowtie2.discard_mapped, self.reads, indexes)
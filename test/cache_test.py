@@ -0,0 +1,57 @@
+import unittest, tempfile, shutil, os, os.path
+from waistcoat import cache
+
+class TestCache(unittest.TestCase):
+
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp(prefix='cachetest')
+		self.cache = cache.Cache(os.path.join(self.tempdir, 'cache'), 
+				max_size=1200)
+
+	def tearDown(self):
+		shutil.rmtree(self.tempdir)
+
+	def reads(self, name, size):
+		path = os.path.join(self.tempdir, name)
+		with open(path, 'w') as f:
+			f.write('A' * size)
+		return path
+
+	def test_get(self):
+		"""Test storing and retrieving reads"""
+		self.cache.put('a', self.reads('a.fq', 100), counts={'discard_rRNA': 4})
+		self.assertIsNone(self.cache.get('b', os.path.join(self.tempdir, 'b.fq')))
+		#entries with reads need somewhere to put them
+		self.assertIsNone(self.cache.get('a'))
+
+		dest = os.path.join(self.tempdir, 'out.fq')
+		record = self.cache.get('a', dest)
+		self.assertEqual(record['counts'], {'discard_rRNA': 4})
+		self.assertEqual(record['reads'], dest)
+		with open(dest) as f:
+			self.assertEqual(f.read(), 'A' * 100)
+
+		#removing the copy leaves the cache intact
+		os.remove(dest)
+		self.assertIsNotNone(self.cache.get('a', dest))
+
+		self.cache.put('stats', values=[1, 2])
+		self.assertEqual(self.cache.get('stats')['values'], [1, 2])
+
+	def test_prune(self):
+		"""Test that the least recently used entries are removed first"""
+		dest = os.path.join(self.tempdir, 'out.fq')
+		for key in ['a', 'b', 'c',]:
+			self.cache.put(key, self.reads(key, 300))
+		#set the last use of each entry
+		for t,key in enumerate(['b', 'a', 'c',]):
+			os.utime(self.cache._path(key, cache.RECORD), (t, t))
+
+		self.cache.put('d', self.reads('d', 300))
+		self.assertIsNone(self.cache.get('b', dest))
+		self.assertIsNotNone(self.cache.get('a', dest))
+		self.assertEqual(sorted(e[0] for e in self.cache.entries()), 
+				['a', 'c', 'd',])
+
+		self.assertEqual(len(self.cache.prune(0)), 3)
+		self.assertEqual(os.listdir(self.cache.directory), [])
@@ -0,0 +1,55 @@
+import unittest, tempfile, shutil, os, os.path
+from waistcoat import checkpoint
+
+class TestManifest(unittest.TestCase):
+
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp(prefix='checkpointtest')
+		self.path = os.path.join(self.tempdir, 'checkpoints.json')
+		self.output = os.path.join(self.tempdir, 'output.fq')
+		with open(self.output, 'w') as f:
+			f.write('@read\nACGT\n+\nIIII\n')
+
+	def tearDown(self):
+		shutil.rmtree(self.tempdir)
+
+	def test_complete(self):
+		"""Test that completed stages are remembered between runs"""
+		key = checkpoint.key('map', {'num_threads': 4})
+		m = checkpoint.Manifest(self.path)
+		self.assertIsNone(m.get('map', key))
+		m.complete('map', key, [self.output,], counts={'final_seqs': 1})
+
+		m = checkpoint.Manifest(self.path)
+		record = m.get('map', key)
+		self.assertEqual(record['counts'], {'final_seqs': 1})
+		self.assertIsNone(m.get('map', checkpoint.key('map', {'num_threads': 2})))
+		self.assertIsNone(m.get('discard', key))
+
+	def test_outputs(self):
+		"""Test that a stage whose outputs have changed is not skipped"""
+		m = checkpoint.Manifest(self.path)
+		m.complete('discard', 'key', [self.output,])
+		with open(self.output, 'a') as f:
+			f.write('@read\nACGT\n+\nIIII\n')
+		self.assertIsNone(m.get('discard', 'key'))
+		self.assertIsNotNone(m.get('discard', 'key', outputs=False))
+
+		os.remove(self.output)
+		self.assertIsNone(m.get('discard', 'key'))
+
+	def test_key(self):
+		"""Test that keys depend only on their contents"""
+		self.assertEqual(checkpoint.key({'a': 1, 'b': 2}, 'x'), 
+				checkpoint.key({'b': 2, 'a': 1}, 'x'))
+		self.assertNotEqual(checkpoint.key('x', 'y'), checkpoint.key('y', 'x'))
+		self.assertEqual(checkpoint.file_hash(self.output, block_size=3),
+				checkpoint.file_hash(self.output))
+
+	def test_file_id(self):
+		"""Test that a file's id changes when it is modified"""
+		before = checkpoint.file_id(self.output)
+		self.assertEqual(checkpoint.file_id(self.output), before)
+		with open(self.output, 'a') as f:
+			f.write('@read\nACGT\n+\nIIII\n')
+		self.assertNotEqual(checkpoint.file_id(self.output), before)
@@ -0,0 +1,62 @@
+import unittest, tempfile, shutil, os.path, pysam, numpy
+from waistcoat import collapse
+
+class TestCollapse(unittest.TestCase):
+
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp(prefix='collapsetest')
+		#reads 0 to 3 found in two samples
+		self.table = os.path.join(self.tempdir, 'collapsed.counts')
+		numpy.array([[1, 2], [0, 1], [3, 0], [1, 1]], 
+				dtype=numpy.uint32).tofile(self.table)
+
+	def tearDown(self):
+		shutil.rmtree(self.tempdir)
+
+	def test_count(self):
+		"""Test that reads are counted for each sample, with their lengths"""
+		reads = os.path.join(self.tempdir, 'reads.fq')
+		with open(reads, 'wb') as f:
+			for (i, length) in [(2, 3), (0, 5), (3, 3)]:
+				f.write("@{}\n{}\n+\n{}\n".format(i, 'A' * length, 'I' * length))
+
+		#the same whether the hits are looked up at once or a few at a time
+		default = collapse.BLOCK
+		for block in [default, 2]:
+			collapse.BLOCK = block
+			try:
+				(counts, lengths) = collapse.Table(self.table, ['a', 'b']).count(
+						reads)
+			finally:
+				collapse.BLOCK = default
+			self.assertEqual(counts, {'a': 5, 'b': 3,})
+			self.assertEqual(lengths['a'].tolist(), [0, 0, 0, 4, 0, 1])
+			self.assertEqual(lengths['b'].tolist(), [0, 0, 0, 1, 0, 2])
+
+	def test_expand(self):
+		"""Test that each alignment is copied once for every time its read was
+		found in each sample, in order"""
+		header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 
+				'SQ': [{'SN': 'chr1', 'LN': 1000},]}
+		bam = os.path.join(self.tempdir, 'hits.bam')
+		samfile = pysam.Samfile(bam, 'wb', header = header)
+		for (read, pos) in [(1, 10), (0, 20), (3, 30), (1, 40)]:
+			alg = pysam.AlignedRead()
+			alg.qname = str(read)
+			alg.seq = 'C' * 20
+			alg.qual = 'I' * 20
+			alg.tid = 0
+			alg.pos = pos
+			alg.cigar = [(0, 20),]
+			alg.mapq = 50
+			samfile.write(alg)
+		samfile.close()
+
+		outputs = [os.path.join(self.tempdir, s + '.bam') for s in ['a', 'b']]
+		written = collapse.Table(self.table, ['a', 'b']).expand(bam, outputs)
+		self.assertEqual(written, [2, 5])
+		self.assertEqual([(alg.qname, alg.pos) for alg in 
+			pysam.Samfile(outputs[0], 'rb')], [('0_0', 20), ('3_0', 30),])
+		self.assertEqual([(alg.qname, alg.pos) for alg in 
+			pysam.Samfile(outputs[1], 'rb')], [('1_0', 10), ('0_0', 20), 
+				('0_1', 20), ('3_0', 30), ('1_0', 40),])
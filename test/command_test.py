@@ -1,4 +1,4 @@
-import unittest, os, os.path, subprocess
+import unittest, os, os.path, subprocess, time
 
 from waistcoat import command
 
@@ -31,6 +31,11 @@ class StreamTester(command.Command):
 		self.cmd = 'sh'
 		self.default_args = [os.path.join(DATA_DIR, 'stream.sh'),]
 
+class ShellTester(command.Command):
+	def __init__(self):
+		self.cmd = 'sh'
+		self.default_args = ['-c',]
+
 class TestCommandCall(unittest.TestCase):
 	"""Test the Command.call function"""
 	fmt = "My arguments were \"{}\"\n"
@@ -73,4 +78,40 @@ class TestCommandCall(unittest.TestCase):
 		with self.assertRaises(subprocess.CalledProcessError):
 			self.ret.call()
 
+class TestCommandRun(unittest.TestCase):
+	"""Test running commands from the poll loop"""
+	sh = ShellTester()
+
+	def test_both_streams(self):
+		"""Test that filling both pipes doesn't deadlock, and output is bounded"""
+		lines = []
+		(out, err) = self.sh.call(["yes out 2>/dev/null | head -c 3000000; " +
+			"yes err 2>/dev/null | head -c 3000000 1>&2; echo last 1>&2",], 
+			update_fn = lines.append, stderr = True)
+		self.assertEqual(len(out), command.BUFFER_SIZE)
+		self.assertEqual(len(err), command.BUFFER_SIZE)
+		self.assertTrue(err.endswith('err\nlast\n'))
+		self.assertEqual(len(lines), 750001)
+		self.assertEqual(lines[-1], 'last')
+
+	def test_timeout(self):
+		"""Test that a command which runs too long is killed"""
+		start = time.time()
+		with self.assertRaises(command.Timeout):
+			self.sh.call(["echo started; sleep 10",], timeout = 0.5)
+		self.assertTrue(time.time() - start < 5)
+
+	def test_parallel(self):
+		"""Test running several commands at once"""
+		procs = [self.sh.start(["sleep 0.5; echo {}".format(i),], timeout = 5)
+				for i in range(8)]
+		start = time.time()
+		command.run(procs)
+		self.assertTrue(time.time() - start < 4)
+		self.assertEqual([p.check()[0] for p in procs],
+				["{}\n".format(i) for i in range(8)])
 
+		procs = [self.sh.start(["exit 0",]), self.sh.start(["exit 3",])]
+		command.run(procs)
+		procs[0].check()
+		self.assertRaises(subprocess.CalledProcessError, procs[1].check)
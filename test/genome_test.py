@@ -0,0 +1,66 @@
+import unittest, tempfile, shutil, os, os.path, random
+from waistcoat import genome
+
+def brute_after(seq, p):
+	n = 0
+	while 0 <= p + n < len(seq) and seq[p + n] == 'A':
+		n += 1
+	return n
+
+def brute_before(seq, p):
+	n = 0
+	while 0 <= p - n < len(seq) and seq[p - n] == 'A':
+		n += 1
+	return n
+
+class TestPackedGenome(unittest.TestCase):
+
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp(prefix='genometest')
+		self.fasta = os.path.join(self.tempdir, 'genome.fa')
+		rand = random.Random(0)
+		self.seqs = {
+				'chr1': ''.join(rand.choice('ACGTa') for i in range(2000)),
+				'chr2': 'A'*300 + 'CG' + 'a'*600 + 'T' + 'A'*255 + 'G' + 'A'*256,
+				}
+		self.write(self.seqs)
+
+	def tearDown(self):
+		shutil.rmtree(self.tempdir)
+
+	def write(self, seqs):
+		with open(self.fasta, 'w') as f:
+			for name,seq in sorted(seqs.iteritems()):
+				f.write(">{} description\n".format(name))
+				for i in range(0, len(seq), 60):
+					f.write(seq[i:i+60] + '\n')
+
+	def test_runs(self):
+		"""Test the runs of As against walking the sequence"""
+		g = genome.PackedGenome(self.fasta)
+		for name,seq in self.seqs.iteritems():
+			seq = seq.upper()
+			contig = g[name]
+			self.assertEqual(len(contig), len(seq))
+			self.assertEqual(''.join(contig[p] for p in range(len(seq))), seq)
+			for p in range(-1, len(seq) + 1):
+				self.assertEqual(contig.a_after(p), brute_after(seq, p))
+				self.assertEqual(contig.a_before(p), brute_before(seq, p))
+		self.assertFalse('chr3' in g)
+		g.close()
+
+	def test_cache(self):
+		"""Test that the cache is reused, and rebuilt when the genome changes"""
+		genome.PackedGenome(self.fasta).close()
+		cache = self.fasta + genome.CACHE_SUFFIX
+		self.assertTrue(os.path.exists(cache))
+		mtime = os.stat(cache).st_mtime
+
+		genome.PackedGenome(self.fasta).close()
+		self.assertEqual(os.stat(cache).st_mtime, mtime)
+
+		self.write({'chr3': 'CAAAG'})
+		g = genome.PackedGenome(self.fasta)
+		self.assertEqual(g.contigs.keys(), ['chr3'])
+		self.assertEqual(g['chr3'].a_after(1), 3)
+		g.close()
@@ -0,0 +1,63 @@
+import unittest, tempfile, shutil, os.path, threading
+import simplejson as json
+from waistcoat import instrument, command
+
+class Shell(command.Command):
+	cmd = 'sh'
+	default_args = ['-c',]
+
+class InstrumentTest(unittest.TestCase):
+	"""Test measuring stages"""
+
+	def setUp(self):
+		instrument.clear()
+		self.tempdir = tempfile.mkdtemp(prefix='instrumenttest')
+
+	def tearDown(self):
+		shutil.rmtree(self.tempdir)
+
+	def test_stage(self):
+		"""Test that a stage records its own work and that of its commands"""
+		path = os.path.join(self.tempdir, 'data')
+		with instrument.stage('work', 'sample 1') as s:
+			s.reads = 1000
+			with open(path, 'wb') as f:
+				f.write('A' * 100000)
+			Shell().call(['i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done',])
+		record = instrument.stages[0]
+		self.assertEqual((record['stage'], record['sample']), ('work', 'sample 1'))
+		self.assertTrue(record['ok'])
+		self.assertTrue(record['wall_s'] > 0)
+		self.assertEqual(record['reads_per_s'], 1000 / record['wall_s'])
+		self.assertEqual(record['children']['count'], 1)
+		self.assertTrue(record['children']['cpu_s'] > 0)
+		self.assertTrue(record['children']['peak_rss_kb'] > 0)
+		if record['write_bytes'] is not None:
+			self.assertTrue(record['write_bytes'] >= 100000)
+
+	def test_threads(self):
+		"""Test that commands are counted against their own thread's stage"""
+		def run(name):
+			with instrument.stage(name):
+				Shell().call(['true',])
+		threads = [threading.Thread(target=run, args=(str(i),)) for i in range(4)]
+		with instrument.stage('outer'):
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+		self.assertEqual(sorted((r['stage'], r['children']['count']) 
+			for r in instrument.stages), 
+			[('0', 1), ('1', 1), ('2', 1), ('3', 1), ('outer', 0),])
+
+	def test_failed(self):
+		"""Test that stages which raise are recorded and written"""
+		with self.assertRaises(ValueError):
+			with instrument.stage('broken'):
+				raise ValueError()
+		instrument.write(self.tempdir)
+		with open(os.path.join(self.tempdir, 'resources.json')) as f:
+			data = json.loads(f.read())
+		self.assertEqual([r['stage'] for r in data['stages']], ['broken',])
+		self.assertFalse(data['stages'][0]['ok'])
+		self.assertTrue(data['total']['wall_s'] > 0)
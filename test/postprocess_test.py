@@ -1,4 +1,4 @@
-import unittest, testcases, tempfile, shutil, os.path
+import unittest, testcases, tempfile, shutil, os.path, pysam
 from waistcoat import postprocess, statistics
 
 DATA_DIR = os.path.join(os.path.split(__file__)[0], "data/postprocess/")
@@ -35,3 +35,120 @@ class TestPostprocess(testcases.TestSamfile):
 		self.assertBAM(os.path.join(self.tempdir, '{}.bam'.format(sample)), 
 				os.path.join(DATA_DIR, 'genome.fa'))
 
+
+	def test_single_pass(self):
+		"""Test that hits are copied, counted and measured in one pass"""
+		sample = "sampleName"
+		tophatDir = os.path.join(self.tempdir, sample)
+		os.mkdir(tophatDir)
+		statistics.recording = True
+		statistics.clear()
+
+		header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 
+				'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]}
+		samfile = pysam.Samfile(os.path.join(tophatDir, 'accepted_hits.bam'), 'wb',
+				header = header)
+		reads = [(0, 10, 20), (0, 15, 25), (0, 15, 20), (1, 5, 30)]
+		for i,(tid, pos, length) in enumerate(reads):
+			alg = pysam.AlignedRead()
+			alg.qname = 'read{}'.format(i)
+			alg.seq = 'C' * length
+			alg.qual = 'I' * length
+			alg.flag = 16 if i % 2 else 0
+			alg.tid = tid
+			alg.pos = pos
+			alg.cigar = [(0, length),]
+			alg.mapq = 50
+			samfile.write(alg)
+		samfile.close()
+
+		count = postprocess.run(self.tempdir, sample, None)
+		self.assertEqual(count, len(reads))
+
+		out = os.path.join(self.tempdir, '{}.bam'.format(sample))
+		self.assertTrue(os.path.exists(out + '.bai'))
+		self.assertEqual([(alg.tid, alg.pos, alg.alen) 
+			for alg in pysam.Samfile(out, 'rb')], reads)
+
+		expected = [0,] * 31
+		for (tid, pos, length) in reads:
+			expected[length] += 1
+		self.assertEqual(list(statistics.lengths()[sample]), expected)
+
+	def test_sharded(self):
+		"""Test that extending in several processes gives the same reads and
+		lengths as extending in one, unmapped reads included"""
+		import random
+		rand = random.Random(1)
+		genome = os.path.join(self.tempdir, 'genome.fa')
+		contigs = [''.join(rand.choice('ACGTAAA') for i in range(1000)) 
+				for c in range(3)]
+		with open(genome, 'wb') as f:
+			for i,contig in enumerate(contigs):
+				f.write(">chr{}\n{}\n".format(i + 1, contig))
+
+		header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 
+				'SQ': [{'SN': 'chr{}'.format(i + 1), 'LN': 1000} for i in range(3)]}
+		reads = sorted((rand.randint(0, 2), rand.randint(30, 950), i % 2) 
+				for i in range(200))
+		statistics.recording = True
+		results = []
+		for processes in (1, 3):
+			statistics.clear()
+			sample = "sample{}".format(processes)
+			tophatDir = os.path.join(self.tempdir, sample)
+			os.mkdir(tophatDir)
+			samfile = pysam.Samfile(os.path.join(tophatDir, 'accepted_hits.bam'), 
+					'wb', header = header)
+			for i,(tid, pos, reverse) in enumerate(reads):
+				alg = pysam.AlignedRead()
+				alg.qname = 'read{}'.format(i)
+				alg.seq = contigs[tid][pos:pos + 20]
+				alg.qual = 'I' * 20
+				alg.flag = 16 if reverse else 0
+				alg.tid = tid
+				alg.pos = pos
+				alg.cigar = [(0, 20),]
+				alg.mapq = 50
+				samfile.write(alg)
+			#unmapped reads come last
+			alg = pysam.AlignedRead()
+			alg.qname = 'unmapped'
+			alg.seq = 'ACGT' * 5
+			alg.qual = 'I' * 20
+			alg.flag = 4
+			alg.tid = -1
+			alg.pos = -1
+			samfile.write(alg)
+			samfile.close()
+
+			count = postprocess.run(self.tempdir, sample, genome, extend=True,
+					processes=processes)
+			out = pysam.Samfile(os.path.join(self.tempdir, sample + '.bam'), 'rb')
+			results.append((count, sorted((alg.qname, alg.tid, alg.pos, alg.seq) 
+				for alg in out), list(statistics.lengths()[sample])))
+
+		self.assertEqual(results[0][0], len(reads))
+		self.assertEqual(len(results[0][1]), len(reads) + 1)
+		self.assertEqual(results[1], results[0])
+
+class TestSplitRegions(unittest.TestCase):
+
+	def test_split(self):
+		"""Test that regions cover every reference exactly once"""
+		references = ['chr1', 'chr2', 'chr3', 'chr4']
+		lengths = [1000, 10, 355, 1]
+		for n in (1, 2, 3, 7, 16, 2000):
+			shards = postprocess.split_regions(references, lengths, n)
+			self.assertTrue(len(shards) <= n + 1)
+			regions = [r for shard in shards for r in shard]
+			for name,length in zip(references, lengths):
+				covered = sorted((s,e) for (r,s,e) in regions if r == name)
+				self.assertEqual(covered[0][0], 0)
+				self.assertEqual(covered[-1][1], length)
+				for (s1,e1),(s2,e2) in zip(covered, covered[1:]):
+					self.assertEqual(e1, s2)
+
+	def test_empty(self):
+		"""Test splitting a BAM file with no references"""
+		self.assertEqual(postprocess.split_regions([], [], 4), [[]])
@@ -1,4 +1,4 @@
-import tempfile, unittest, shutil, testcases
+import tempfile, unittest, shutil, gzip, numpy, testcases, sys
 
 from os.path import join as pjoin
 from os.path import split as psplit
@@ -6,6 +6,7 @@ import os, shutil
 
 from waistcoat import preprocess, settings, statistics
 
+from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
@@ -13,16 +14,46 @@ preprocess.verbose = False
 
 DATA_DIR = pjoin(psplit(__file__)[0], "data/preprocess/")
 
+def io_written():
+	"""Return the bytes this process has written, or None if it isn't known"""
+	try:
+		with open('/proc/self/io') as f:
+			for line in f:
+				if line.startswith('wchar:'):
+					return int(line.split()[1])
+	except IOError:
+		pass
+	return None
+
 
 class PreprocessTest(testcases.TestFastQ):
 
 	def setUp(self):
 		self.tempdir = tempfile.mkdtemp(prefix="test")
 		statistics.recording = False
+		self.min_memory = preprocess.min_memory
 
 	def tearDown(self):
 		shutil.rmtree(self.tempdir)
 		statistics.recording = True
+		preprocess.min_memory = self.min_memory
+
+	def verbose(self, f, *args):
+		"""Call f(*args) verbosely, returning its result and what it printed"""
+		out = pjoin(self.tempdir, 'stdout')
+		sys.stdout.flush()
+		saved = os.dup(1)
+		with open(out, 'wb') as o:
+			os.dup2(o.fileno(), 1)
+		preprocess.verbose = True
+		try:
+			r = f(*args)
+		finally:
+			sys.stdout.flush()
+			preprocess.verbose = False
+			os.dup2(saved, 1)
+			os.close(saved)
+		return (r, open(out).read())
 
 	def test_split(self):
 		reads = pjoin(DATA_DIR, 'test_reads.fq')
@@ -54,6 +85,82 @@ class PreprocessTest(testcases.TestFastQ):
 		self.assertFastQ(code1, files['barcode_1'][0])
 		self.assertFastQ(code2, files['barcode_2'][0])
 
+	def test_split_gzip(self):
+		"""Test that multi-member gzip input is read directly"""
+		reads = pjoin(DATA_DIR, 'test_reads.fq')
+		gzreads = pjoin(self.tempdir, 'test_reads.fq.gz')
+
+		#write the reads as two gzip members
+		data = open(reads, 'rb').read()
+		half = data.index('\n@', len(data) / 2) + 1
+		for mode, part in [('wb', data[:half]), ('ab', data[half:])]:
+			f = gzip.open(gzreads, mode)
+			f.write(part)
+			f.close()
+
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA', "barcode_2": 'TCTT',},
+			'barcode_format': "BBBNNNB",
+			'target': 'null',})
+		
+		files = preprocess.split_by_barcode(gzreads, s, self.tempdir)
+
+		self.assertEqual(files['barcode_1'][1], 2)
+		self.assertEqual(files['barcode_2'][1], 3)
+		self.assertFastQ(pjoin(DATA_DIR, 'expected_1.fq'), files['barcode_1'][0])
+		self.assertFastQ(pjoin(DATA_DIR, 'expected_2.fq'), files['barcode_2'][0])
+
+	def test_split_wrapped(self):
+		"""Test reading wrapped records and a final line with no newline"""
+		reads = pjoin(self.tempdir, 'wrapped.fq')
+		seq = "TCCAAA" + "ACGT" * 40
+		with open(reads, 'wb') as f:
+			for i in range(3):
+				f.write("@seq{}\n{}\n{}\n+\n{}\n{}\n".format(i, seq[:80], seq[80:],
+					'I'*80, 'I'*(len(seq) - 80)))
+			f.write("@seq3\n{}\n+\n{}".format(seq, 'I'*len(seq)))
+
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA',},
+			'barcode_format': "BBBNNNB",
+			'target': 'null',})
+		
+		files = preprocess.split_by_barcode(reads, s, self.tempdir)
+
+		self.assertEqual(files['barcode_1'][1], 4)
+		output = list(SeqIO.parse(files['barcode_1'][0], 'fastq'))
+		self.assertEqual([r.id for r in output], ['seq0', 'seq1', 'seq2', 'seq3'])
+		for r in output:
+			self.assertEqual(str(r.seq), seq)
+
+	def test_split_mismatch(self):
+		"""Test reads with a single barcode mismatch are assigned"""
+		reads = pjoin(self.tempdir, 'mismatch.fq')
+		#TCTA is one away from both barcodes and GGTT is two from TCTT
+		barcodes = ['TCCA', 'TACA', 'TCTA', 'TCTT', 'GCTT', 'GGTT', 'TCNA']
+		with open(reads, 'wb') as f:
+			for i, b in enumerate(barcodes):
+				seq = b + "AC" + "ACGT" * 5
+				f.write("@seq{}\n{}\n+\n{}\n".format(i, seq, 'I'*len(seq)))
+
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA', "barcode_2": 'TCTT',},
+			'barcode_format': "BBBBNN",
+			'barcode_mismatches': 1,
+			'target': 'null',})
+		files = preprocess.split_by_barcode(reads, s, self.tempdir)
+
+		self.assertEqual([r.id for r in SeqIO.parse(files['barcode_1'][0], 'fastq')],
+				['seq0', 'seq1'])
+		self.assertEqual([r.id for r in SeqIO.parse(files['barcode_2'][0], 'fastq')],
+				['seq3', 'seq4'])
+
+		#without mismatches only exact barcodes match
+		s.barcode_mismatches = 0
+		files = preprocess.split_by_barcode(reads, s, self.tempdir)
+		self.assertEqual(files['barcode_1'][1], 1)
+		self.assertEqual(files['barcode_2'][1], 1)
+
 	def test_process_sample(self):
 		"""Test process_sample"""
 		input_file = pjoin(self.tempdir, 'process_seq_in.fq')
@@ -85,6 +192,181 @@ class PreprocessTest(testcases.TestFastQ):
 		#check that the contents of the output file are correct
 		self.assertFastQ(test_output, output_file)
 
+	def test_process_long_reads(self):
+		"""Test that reads longer than 64nt and Ns are deduplicated exactly"""
+		input_file = pjoin(self.tempdir, 'long_in.fq')
+
+		insert = ''.join('ATGC'[(i*7) % 4 ] for i in range(70)) + 'G'
+		insert = insert[:10] + 'A' + insert[11:]
+		seqs = [
+				insert,
+				insert,
+				insert[:66] + ('C' if insert[66] != 'C' else 'T') + insert[67:],
+				insert[:10] + 'N' + insert[11:],]
+
+		with open(input_file, 'wb') as f:
+			for i,seq in enumerate(seqs):
+				seq = "TCCAA" + seq
+				f.write("@seq{}\n{}\n+\n{}\n".format(i, seq, 'I'*len(seq)))
+
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA',},
+			'barcode_format': "BBBNB",
+			'target': 'null',})
+		files = preprocess.process_sample(
+				{'sample_1': (input_file, len(seqs),),}, s, self.tempdir)
+
+		output = sorted(str(r.seq) for r in 
+				SeqIO.parse(files['sample_1'], 'fastq'))
+		self.assertEqual(output, sorted(seqs[1:]))
+
+	def test_process_long_umi(self):
+		"""Test that 32nt UMIs are compared exactly, Ns included"""
+		input_file = pjoin(self.tempdir, 'umi_in.fq')
+		umi = 'ACGT' * 8
+		insert = 'CTGACTGACTGACTGACTGG'
+		umis = [
+				umi,
+				umi,
+				'G' + umi[1:],
+				'T' + umi[1:],
+				umi[:31] + 'A',
+				umi[:31] + 'N',
+				umi[:31] + 'N',
+				'N' + umi[1:],]
+		with open(input_file, 'wb') as f:
+			for i,u in enumerate(umis):
+				seq = "TCC" + u + "A" + insert
+				f.write("@seq{}\n{}\n+\n{}\n".format(i, seq, 'I'*len(seq)))
+
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA',},
+			'barcode_format': "BBB" + "N"*32 + "B",
+			'target': 'null',})
+		files = preprocess.process_sample(
+				{'sample_1': (input_file, len(umis),),}, s, self.tempdir, False)
+		output = list(SeqIO.parse(files['sample_1'], 'fastq'))
+		self.assertEqual(len(output), 6)
+		self.assertTrue(all(str(r.seq) == insert for r in output))
+
+		s.barcode_format = "BBB" + "N"*33 + "B"
+		self.assertRaises(ValueError, preprocess.process_sample,
+				{'sample_1': (input_file, len(umis),),}, s, self.tempdir, False)
+
+	def test_process_max_memory(self):
+		"""Test that spilling to disk keeps the same reads as deduplicating in
+		memory, the earliest copy of each"""
+		import random
+		rand = random.Random(1)
+		inserts = [''.join(rand.choice('ACGTN' if i % 5 else 'ACGT') 
+			for j in range(rand.randint(20, 90))) for i in range(200)]
+		input_file = pjoin(self.tempdir, 'memory_in.fq')
+		with open(input_file, 'wb') as f:
+			for i in range(2000):
+				seq = "TCC{}A{}G".format(rand.choice(['AC', 'GT', 'NA',]),
+						rand.choice(inserts))
+				f.write("@seq{}\n{}\n+\n{}\n".format(i, seq, 'I'*len(seq)))
+
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA',},
+			'barcode_format': "BBBNNB",
+			'target': 'null',})
+		def dedup(max_memory):
+			d = tempfile.mkdtemp(dir=self.tempdir)
+			files = preprocess.process_sample({'sample_1': (input_file, 2000,),}, 
+					s, d, False, 1, max_memory)
+			#the runs on disk have been removed
+			self.assertEqual(os.listdir(d), [psplit(files['sample_1'])[1],])
+			return sorted((r.id, str(r.seq)) for r in 
+					SeqIO.parse(files['sample_1'], 'fastq'))
+
+		expected = dedup(0)
+		self.assertTrue(200 < len(expected) < 2000)
+		self.assertRaises(ValueError, dedup, preprocess.min_memory - 1)
+		self.assertEqual(dedup(8 << 20), expected)
+		#a read per run, so that runs are merged before the end too
+		preprocess.min_memory = 0
+		self.assertEqual(dedup(1), expected)
+
+	def test_process_spill_runs(self):
+		"""Test that the runs spilled hold as many reads as the budget allows,
+		rather than the memory set aside for them"""
+		import random
+		rand = random.Random(3)
+		input_file = pjoin(self.tempdir, 'runs_in.fq')
+		with open(input_file, 'wb') as f:
+			for i in range(20000):
+				seq = "TCCAA" + ''.join(rand.choice('ACGT') for j in range(95))
+				f.write("@seq{}\n{}\n+\n{}\n".format(i, seq, 'I'*len(seq)))
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA',},
+			'barcode_format': "BBBNB",
+			'target': 'null',})
+
+		#the reads take a couple of megabytes, well inside a block of the arena
+		preprocess.min_memory = 0
+		(files, out) = self.verbose(preprocess.process_sample, 
+				{'sample_1': (input_file, 20000,),}, s, self.tempdir, False, 1, 
+				256 << 10)
+		runs = out.count('Spilled run')
+		self.assertTrue(4 <= runs <= 64, "{} runs spilled".format(runs))
+
+	def test_process_compress(self):
+		"""Test that reads are written on one line each, or gzipped"""
+		import random
+		rand = random.Random(2)
+		seqs = [''.join(rand.choice('ACGT') for j in range(200)) + 'G' 
+				for i in range(5)]
+		input_file = pjoin(self.tempdir, 'compress_in.fq')
+		with open(input_file, 'wb') as f:
+			for i,seq in enumerate(seqs):
+				seq = "TCCAA" + seq
+				f.write("@seq{}\n{}\n+\n{}\n".format(i, seq, 'I'*len(seq)))
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA',},
+			'barcode_format': "BBBNB",
+			'target': 'null',})
+		def process(compress):
+			return preprocess.process_sample({'sample_1': (input_file, 5,),}, 
+					s, self.tempdir, False, 1, 0, compress)['sample_1']
+
+		plain = process(0)
+		self.assertEqual(len(open(plain).read().splitlines()), 4 * len(seqs))
+		expected = sorted(str(r.seq) for r in SeqIO.parse(plain, 'fastq'))
+		self.assertEqual(expected, sorted(seqs))
+
+		compressed = process(1)
+		self.assertTrue(compressed.endswith('.clean.gz'))
+		with gzip.open(compressed) as f:
+			self.assertEqual(sorted(str(r.seq) for r in SeqIO.parse(f, 'fastq')),
+					expected)
+
+		self.assertRaises(ValueError, process, 10)
+
+	def test_process_lengths(self):
+		"""Test that the lengths of the cleaned reads are recorded"""
+		input_file = pjoin(self.tempdir, 'lengths_in.fq')
+		seqs = ['C'*19 + 'G', 'T'*599 + 'G', 'C'*599 + 'G', 'C'*599 + 'G',]
+		with open(input_file, 'wb') as f:
+			for i,seq in enumerate(seqs):
+				seq = "TCCAA" + seq
+				f.write("@seq{}\n{}\n+\n{}\n".format(i, seq, 'I'*len(seq)))
+
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA',},
+			'barcode_format': "BBBNB",
+			'target': 'null',})
+		statistics.recording = True
+		statistics.setUp(['sample_1',])
+		preprocess.process_sample(
+				{'sample_1': (input_file, len(seqs),),}, s, self.tempdir)
+
+		lengths = statistics.lengths('clean')['sample_1']
+		self.assertEqual(len(lengths), 601)
+		self.assertEqual(lengths[20], 1)
+		self.assertEqual(lengths[600], 2)
+		self.assertEqual(lengths.sum(), 3)
+
 	def test_run(self):
 		"""test preprocess.run"""
 	
@@ -105,3 +387,124 @@ class PreprocessTest(testcases.TestFastQ):
 		#check that the sequences are correct
 		self.assertFastQ(pjoin(DATA_DIR, 'run_out_bc1.fq'), files['barcode_1'])
 		self.assertFastQ(pjoin(DATA_DIR, 'run_out_bc2.fq'), files['barcode_2'])
+
+	def test_run_workers(self):
+		"""test preprocess.run deduplicating samples in parallel"""
+		reads = pjoin(DATA_DIR, 'run_in.fq')
+
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA', "barcode_2": 'TCTT',},
+			'barcode_format': "BBBNNNB",
+			'target': 'null',})
+		
+		files = preprocess.run(reads, s, self.tempdir, False, 2)
+
+		self.assertEqual(sorted(files.keys()), ['barcode_1','barcode_2',])
+		self.assertFastQ(pjoin(DATA_DIR, 'run_out_bc1.fq'), files['barcode_1'])
+		self.assertFastQ(pjoin(DATA_DIR, 'run_out_bc2.fq'), files['barcode_2'])
+
+	def test_run_two_pass(self):
+		"""test that splitting and deduplicating in one pass gives the same reads
+		and statistics as split_by_barcode then process_sample"""
+		reads = pjoin(DATA_DIR, 'run_in.fq')
+		s = settings.Settings({
+			'barcodes': {"barcode_1": 'TCCA', "barcode_2": 'TCTT',},
+			'barcode_format': "BBBNNNB",
+			'target': 'null',})
+
+		statistics.recording = True
+		#spill a run for every read
+		preprocess.min_memory = 0
+		results = []
+		for (fused, max_memory) in [(False, 0), (True, 0), (True, 1)]:
+			statistics.setUp(['barcode_1', 'barcode_2',])
+			outdir = tempfile.mkdtemp(dir=self.tempdir)
+			files = preprocess.run(reads, s, outdir, False, 1, max_memory, fused)
+			self.assertEqual(sorted(os.listdir(outdir)), 
+					sorted(psplit(f)[1] for f in files.values()))
+			results.append((
+				dict((sample, sorted((r.id, str(r.seq)) for r in 
+					SeqIO.parse(f, 'fastq'))) for sample,f in files.iteritems()),
+				statistics.values(),
+				dict((k, v.tolist()) for k,v in statistics.lengths('clean').items()),))
+
+		self.assertEqual(results[0][1][0][0], 'split_by_barcode')
+		self.assertEqual(results[1], results[0])
+		self.assertEqual(results[2], results[0])
+
+	def test_run_max_memory(self):
+		"""Test that a budget is shared between every sample when fused, and
+		that one too small to share splits the samples first"""
+		import random, itertools
+		rand = random.Random(4)
+		barcodes = dict(("barcode_{}".format(i), "TC" + ''.join(b))
+				for i,b in enumerate(itertools.product('ACGT', repeat=2)))
+		codes = barcodes.values()
+		reads = pjoin(self.tempdir, 'max_memory_in.fq')
+		with open(reads, 'wb') as f:
+			for i in range(40000):
+				code = rand.choice(codes)
+				seq = code[:3] + "AA" + code[3] + ''.join(rand.choice('ACGT') 
+						for j in range(90))
+				f.write("@seq{}\n{}\n+\n{}\n".format(i, seq, 'I'*len(seq)))
+		s = settings.Settings({
+			'barcodes': barcodes,
+			'barcode_format': "BBBNNB",
+			'target': 'null',})
+
+		def run(max_memory):
+			"""Return the reads kept, whether they were fused and the bytes
+			written"""
+			outdir = tempfile.mkdtemp(dir=self.tempdir)
+			before = io_written()
+			(files, out) = self.verbose(preprocess.run, reads, s, outdir, False, 1, 
+					max_memory)
+			after = io_written()
+			return (dict((sample, sorted((r.id, str(r.seq)) for r in 
+						SeqIO.parse(f, 'fastq'))) for sample,f in files.iteritems()),
+					'Splitting and Processing' in out,
+					after - before if before is not None else None)
+
+		expected = run(0)
+		self.assertTrue(expected[1])
+		#each sample's share of the budget is far smaller than a block
+		preprocess.min_memory = 0
+		shared = run(len(barcodes) << 16)
+		self.assertEqual(shared[:2], expected[:2])
+		if expected[2] is not None:
+			self.assertTrue(shared[2] < 4 * os.path.getsize(reads),
+					"{} bytes written".format(shared[2]))
+
+		preprocess.min_memory = self.min_memory
+		split = run(len(barcodes) * preprocess.min_memory - 1)
+		self.assertEqual(split[:2], (expected[0], False))
+
+	def test_collapse(self):
+		"""Test that each distinct sequence is written once and counted in each
+		file it's found in"""
+		samples = [['ACGTACGT', 'CCCCGGGG', 'ACGTACGT',], ['CCCCGGGG', 'TTTTAAAA',],
+				[]]
+		files = []
+		for i,seqs in enumerate(samples):
+			files.append(pjoin(self.tempdir, 'collapse_{}.fq'.format(i)))
+			with open(files[-1], 'wb') as f:
+				for j,seq in enumerate(seqs):
+					f.write("@s{}r{}\n{}\n+\n{}\n".format(i, j, seq, 
+						chr(ord('A') + i)*len(seq)))
+
+		for compress in [0, 1]:
+			out = pjoin(self.tempdir, 'collapsed.fq' + ('.gz' if compress else ''))
+			table = pjoin(self.tempdir, 'collapsed.counts')
+			self.assertEqual(preprocess.collapse(files, out, table, compress), 3)
+
+			with (gzip.open if compress else open)(out) as f:
+				reads = [(r.id, str(r.seq), r.letter_annotations['phred_quality'][0])
+						for r in SeqIO.parse(f, 'fastq')]
+			#the first copy of each is kept
+			self.assertEqual(reads, [('0', 'ACGTACGT', 32), ('1', 'CCCCGGGG', 32),
+				('2', 'TTTTAAAA', 33),])
+			self.assertEqual(numpy.fromfile(table, dtype=numpy.uint32).tolist(),
+					[2, 0, 0, 1, 1, 0, 0, 1, 0,])
+
+		self.assertRaises(IOError, preprocess.collapse, 
+				[pjoin(self.tempdir, 'missing.fq'),], out, table)
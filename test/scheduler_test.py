@@ -0,0 +1,70 @@
+import unittest, threading, time
+
+from waistcoat import scheduler
+
+class SchedulerTest(unittest.TestCase):
+	"""Test the core budgeting scheduler"""
+
+	def setUp(self):
+		self.lock = threading.Lock()
+		self.in_use = 0
+		self.max_in_use = 0
+
+	def use_cores(self, cores, value):
+		with self.lock:
+			self.in_use += cores
+			self.max_in_use = max(self.max_in_use, self.in_use)
+		time.sleep(0.05)
+		with self.lock:
+			self.in_use -= cores
+		return value
+
+	def test_budget(self):
+		"""Test that jobs never use more than the available cores"""
+		s = scheduler.Scheduler(cores=4)
+		for i, cores in enumerate([2, 3, 1, 2, 2, 1]):
+			s.add(self.use_cores, (cores, i), cores=cores, name=i)
+
+		results = s.run()
+
+		self.assertEqual(results, dict((i,i) for i in range(6)))
+		self.assertTrue(self.max_in_use <= 4, 
+				"{} cores used at once".format(self.max_in_use))
+		self.assertTrue(self.max_in_use > 2, "Jobs did not run concurrently")
+
+	def test_large_job(self):
+		"""Test that a job needing more cores than are available still runs"""
+		s = scheduler.Scheduler(cores=2)
+		s.add(self.use_cores, (2, 'big'), cores=8, name='big')
+		self.assertEqual(s.run(), {'big': 'big'})
+
+	def test_dependencies(self):
+		"""Test that jobs wait for the jobs they depend on"""
+		order = []
+		def record(name):
+			time.sleep(0.01)
+			with self.lock:
+				order.append(name)
+
+		s = scheduler.Scheduler(cores=4)
+		a = s.add(record, ('a1',), name='a1')
+		b = s.add(record, ('b1',), name='b1')
+		s.add(record, ('a2',), name='a2', after=[a])
+		s.add(record, ('ab',), name='ab', after=[a, b])
+		s.run()
+
+		self.assertEqual(sorted(order), ['a1', 'a2', 'ab', 'b1'])
+		self.assertTrue(order.index('a2') > order.index('a1'))
+		self.assertTrue(order.index('ab') > max(order.index('a1'), 
+			order.index('b1')))
+
+	def test_failure(self):
+		"""Test that exceptions are passed back to the caller"""
+		def fail():
+			raise ValueError("job failed")
+
+		s = scheduler.Scheduler(cores=2)
+		failed = s.add(fail)
+		s.add(self.use_cores, (1, None), after=[failed])
+		self.assertRaises(ValueError, s.run)
+		self.assertEqual(self.max_in_use, 0)
@@ -14,7 +14,9 @@ class SettingsTest(unittest.TestCase):
 	invalid = ['badbarcode.json','badtophat1.json','badtophat3.json',
 			'nobarcodes.json','noindex2.json','settingsnodiscard.json',
 			'badbarcodes.json','badtophat2.json','nobarcode.json','noindex1.json',
-			'notarget.json','unknownsetting.json','wronglength.json',] 
+			'notarget.json','unknownsetting.json','wronglength.json',
+			'badmismatches.json','baddiscardmode.json','longumi.json',
+			'badmapmode.json',] 
 
 	def assertRaisesMsg(self, msg, etype, func, *args, **kwargs):
 		try:
@@ -40,6 +42,8 @@ class SettingsTest(unittest.TestCase):
 			])
 		self.assertEqual(mySettings.target, 
 				('test/data/tophat_data/test_ref', {'max_insertion_length':3,}))
+		self.assertEqual(mySettings.discard_mode, 'tophat')
+		self.assertEqual(mySettings.map_mode, 'tophat')
 
 	def test_invalid(self):
 		for name in self.invalid:
@@ -1,4 +1,4 @@
-import unittest
+import unittest, tempfile, shutil, os.path, csv
 
 from waistcoat import statistics
 
@@ -16,3 +16,47 @@ class StatisticsTest(unittest.TestCase):
 			'sample2': 3,
 			'unknownSample': 4,})
 
+
+	def test_histogram(self):
+		"""test that histograms grow to fit any length"""
+		h = statistics.Histogram()
+		self.assertEqual(list(h.counts), [])
+		for i in range(statistics.Histogram.buffer_size + 5):
+			h.add(i % 3)
+		h.add(1000)
+		h.merge([0, 1, 2])
+		counts = h.counts
+		self.assertEqual(len(counts), 1001)
+		self.assertEqual(counts[0], (statistics.Histogram.buffer_size + 5 + 2) / 3)
+		self.assertEqual(counts[1000], 1)
+		self.assertEqual(counts.sum(), statistics.Histogram.buffer_size + 5 + 4)
+
+	def test_collector(self):
+		"""test collecting read lengths by stage and writing them"""
+		statistics.setUp(['sample1', 'sample2'])
+		statistics.collector('clean', 'sample1').add(20)
+		statistics.collector('clean', 'sample2').add(200)
+		statistics.collector(statistics.FINAL, 'sample1').add(25)
+		self.assertEqual(statistics.collector('clean', 'sample1').counts[20], 1)
+
+		tempdir = tempfile.mkdtemp(prefix='test')
+		try:
+			statistics.write(tempdir)
+			rows = list(csv.reader(open(os.path.join(tempdir, 'lengths_clean.csv')),
+				delimiter=' '))
+			self.assertEqual(len(rows[0]), 202)
+			self.assertEqual(sorted(len(row) for row in rows), [202,]*3)
+			rows = list(csv.reader(open(os.path.join(tempdir, 'lengths.csv')),
+				delimiter=' '))
+			self.assertEqual(rows[1], ['sample1',] + ['0',]*25 + ['1',])
+		finally:
+			shutil.rmtree(tempdir)
+
+	def test_not_recording(self):
+		"""test that collectors keep nothing when not recording"""
+		statistics.recording = False
+		try:
+			statistics.collector('clean', 'sample1').add(20)
+		finally:
+			statistics.recording = True
+		self.assertEqual(statistics.lengths('clean'), {})
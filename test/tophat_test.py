@@ -1,6 +1,6 @@
 from waistcoat import tophat
 tophat.verbose = False
-import unittest, os, os.path, tempfile, shutil, testcases
+import unittest, os, os.path, tempfile, shutil, testcases, pysam
 import simplejson as json
 
 DATA_DIR = os.path.join( os.path.split(__file__)[0], "data/")
@@ -281,3 +281,48 @@ class TophatTestRun(testcases.TestFastQ):
 
 
 		
+class WriteFastQTest(unittest.TestCase):
+	"""Test converting BAM reads to FASTQ"""
+
+	def setUp(self):
+		self.output = tempfile.mkdtemp(prefix='test')
+
+	def tearDown(self):
+		shutil.rmtree(self.output)
+
+	def test_write_fastq(self):
+		"""Test that write_fastq matches the reads in the BAM file"""
+		bam = os.path.join(self.output, 'unmapped.bam')
+		samfile = pysam.Samfile(bam, 'wb', 
+				header = {'HD': {'VN': '1.0'}, 'SQ': [{'SN': 'chr', 'LN': 100}]})
+		bases = ['ACGTN', 'TTGCA', 'GGNCC']
+		reads = [('read{}'.format(i), bases[i % 3]*(i % 5 + 1), 'I#5?!'*(i % 5 + 1))
+				for i in range(tophat.FASTQ_BATCH + 3)]
+		for (qname, seq, qual) in reads:
+			read = pysam.AlignedRead()
+			read.qname = qname
+			read.seq = seq
+			read.qual = qual
+			read.flag = 4
+			read.tid = -1
+			read.pos = -1
+			samfile.write(read)
+		samfile.close()
+
+		actual = os.path.join(self.output, 'actual.fq')
+		samfile = pysam.Samfile(bam, 'rb')
+		with open(actual, 'w') as f:
+			self.assertEqual(tophat.write_fastq(samfile, f), len(reads))
+		samfile.close()
+
+		self.assertEqual(open(actual).read(), 
+				''.join("@{}\n{}\n+\n{}\n".format(*read) for read in reads))
+
+	def test_output_name(self):
+		"""Test naming the reads written by a stage"""
+		self.assertEqual(tophat.output_name('/a/s.clean', '_nomapping'),
+				'/a/s_nomapping.fq')
+		self.assertEqual(tophat.output_name('/a/s.clean.gz', '_nomapping'),
+				'/a/s_nomapping.fq')
+		self.assertEqual(tophat.output_name('/a/s_nomapping.fq.gz', '_x', 1),
+				'/a/s_nomapping_x.fq.gz')
@@ -1,4 +1,4 @@
-import unittest, os.path, tempfile, shutil, testcases
+import unittest, os.path, tempfile, shutil, pysam, testcases
 from waistcoat import waistcoat
 
 waistcoat.verbose = False
@@ -39,7 +39,6 @@ class PipelineTest(testcases.TestSamfile):
 
 		self.assertEqual(output, sorted([
 				'sample 1/accepted_hits.bam',
-				'sample 1/accepted_hits.bam.bai',
 				'sample 1/deletions.bed',
 				'sample 1/insertions.bed',
 				'sample 1/junctions.bed',
@@ -51,7 +50,6 @@ class PipelineTest(testcases.TestSamfile):
 				'sample 1/logs/run.log',
 				'sample 1/logs/tophat.log',
 				'sample 2/accepted_hits.bam',
-				'sample 2/accepted_hits.bam.bai',
 				'sample 2/deletions.bed',
 				'sample 2/insertions.bed',
 				'sample 2/junctions.bed',
@@ -63,11 +61,49 @@ class PipelineTest(testcases.TestSamfile):
 				'sample 2/logs/run.log',
 				'sample 2/logs/tophat.log',
 				'statistics/lengths.csv',
+				'statistics/lengths_clean.csv',
+				'statistics/lengths_discard_rRNA.csv',
 				'statistics/pipeline.csv',
+				'statistics/resources.json',
 				'sample 1.bam',
 				'sample 1.bam.bai',
 				'sample 2.bam',
-				'sample 2.bam.bai']))
+				'sample 2.bam.bai',
+				'checkpoints.json',]))
+
+	def test_resume(self):
+		"""Test that resuming a completed run skips every stage"""
+		with open(os.path.join(self.tempdir, 'statistics/pipeline.csv')) as f:
+			expected = f.read()
+		mtime = os.stat(os.path.join(self.tempdir, 'sample 1.bam')).st_mtime
+
+		waistcoat.run(self.settings_file, self.reads, self.tempdir, 
+				temp_loc=self.tempdir, extend=True, resume=True)
+
+		with open(os.path.join(self.tempdir, 'statistics/pipeline.csv')) as f:
+			self.assertEqual(f.read(), expected)
+		self.assertEqual(
+				os.stat(os.path.join(self.tempdir, 'sample 1.bam')).st_mtime, mtime)
+
+	def test_collapse(self):
+		"""Test that mapping each distinct sequence once gives every sample the
+		same hits and statistics"""
+		outdir = tempfile.mkdtemp(prefix='test_waistcoat.')
+		try:
+			waistcoat.run(self.settings_file, self.reads, outdir, temp_loc=outdir,
+					extend=True, collapse=True)
+			for sample in ['sample 1', 'sample 2',]:
+				hits = [sorted((alg.tid, alg.pos, alg.is_reverse, alg.seq) for alg in
+					pysam.Samfile(os.path.join(d, sample + '.bam'), 'rb')) 
+					for d in [self.tempdir, outdir,]]
+				self.assertEqual(hits[1], hits[0])
+			stats = []
+			for d in [self.tempdir, outdir,]:
+				with open(os.path.join(d, 'statistics/pipeline.csv')) as f:
+					stats.append(f.read())
+			self.assertEqual(stats[1], stats[0])
+		finally:
+			shutil.rmtree(outdir)
 
 	def test_accepted_hits(self):
 		"""Test the outputted hits"""
@@ -0,0 +1,186 @@
+"""Interface with the bowtie2 program"""
+
+import command, tophat, subprocess, tempfile, pysam, os, os.path, re
+
+class Bowtie2(command.Command):
+	"""Class to interface with bowtie2
+			See http://bowtie-bio.sourceforge.net/bowtie2/manual.shtml
+
+			Options share their names with TopHat's so that the same settings can
+			be used for either, e.g. set self.b2_N = 1 for "-N 1"
+	"""
+
+	options = {
+			'num_threads' : '--threads',
+			'solexa_quals' : '--solexa-quals',
+			'integer_quals' : '--int-quals',
+			'b2_very_fast' : '--very-fast',
+			'b2_fast' : '--fast',
+			'b2_sensitive' : '--sensitive',
+			'b2_very_sensitive' : '--very-sensitive',
+			'b2_N' : '-N',
+			'b2_L' : '-L',
+			'b2_i' : '-i',
+			'b2_n_ceil' : '--n-ceil',
+			'b2_gbar' : '--gbar',
+			'b2_mp' : '--mp',
+			'b2_np' : '--np',
+			'b2_rdg' : '--rdg',
+			'b2_rfg' : '--rfg',
+			'b2_score_min' : '--score-min',
+			'b2_D' : '-D',
+			'b2_R' : '-R',}
+
+	cmd = "bowtie2"
+
+	def __init__(self):
+		for o in self.options.iterkeys():
+			setattr(self, o, None)
+
+	def getOptions(self):
+		opts = []
+		for o,o_ in self.options.iteritems():
+			opt = getattr(self, o)
+			#if the option is set
+			if opt is not None:
+				#flags
+				if isinstance(opt, bool):
+					if opt: opts.append(o_)
+				#strings and numbers
+				else:
+					opts += [o_, str(opt),]
+
+		return opts
+
+	def args(self, index_base, reads, unaligned, compress=False, 
+			alignments=None):
+		"""Command line which maps reads to index_base, writes the reads which fail
+		to align to unaligned, gzipped if compress is set, and throws the
+		alignments away. If alignments is given, the reads which align end-to-end
+		are written there as SAM instead"""
+		if alignments is None:
+			out = ['-S', os.devnull,]
+		else:
+			out = ['--end-to-end', '--no-unal', '-S', alignments,]
+		return [self.cmd,] + self.default_args + self.getOptions() + [
+				'-x', index_base,
+				'-U', reads,
+				'--un-gz' if compress else '--un', unaligned,] + out
+
+def bowtie2_from_settings(settings):
+	"""Construct a Bowtie2 object from a dictionary of TopHat settings and return
+	it. Settings which only affect TopHat are ignored
+	Raises ValueError or TypeError if the settings are invalid"""
+
+	#check the settings the same way as TopHat does
+	th = tophat.tophat_from_settings(settings)
+
+	b = Bowtie2()
+	for option in b.options.iterkeys():
+		setattr(b, option, getattr(th, option))
+
+	return b
+
+def discard_mapped(reads_file, indexes, suffix="_nomapping", compress=0):
+	"""Map reads to each index in turn and discard all the reads which map to any
+	of them. The reads which fail to align to one index are piped straight into
+	bowtie2 for the next, so no intermediate files are written.
+	indexes: list of (index_base, tophat_settings)
+	compress: if not 0, gzip the output. bowtie2 picks the level itself
+	Returns the name of the output file and the number of reads left after each
+	index"""
+	if not indexes:
+		raise ValueError("No indexes to discard reads against")
+
+	outfile_name = tophat.output_name(reads_file, suffix, compress)
+
+	commands = []
+	for i,(index_base, settings) in enumerate(indexes):
+		last = (i == len(indexes) - 1)
+		commands.append(bowtie2_from_settings(settings).args(index_base,
+				reads_file if i == 0 else '-',
+				outfile_name if last else '/dev/stdout', compress and last))
+	summaries = _pipeline(commands)
+
+	counts = [_unaligned(summary) for summary in summaries]
+
+	os.remove(reads_file)
+
+	return (outfile_name, counts)
+
+def map_reads(reads_file, index_base, settings, bam, suffix="_unaligned",
+		compress=0):
+	"""Map reads end-to-end to index_base, writing the alignments sorted to bam
+	and the reads which fail to align to a new file, gzipped if compress isn't 0.
+	reads_file is left in place.
+	Returns the name of the file of unaligned reads and how many there are"""
+	outfile_name = tophat.output_name(reads_file, suffix, compress)
+	unsorted = bam + '.unsorted'
+
+	with open(unsorted, 'wb') as out:
+		summaries = _pipeline([
+			bowtie2_from_settings(settings).args(index_base, reads_file, 
+				outfile_name, compress, alignments = '/dev/stdout'),
+			['samtools', 'view', '-bS', '-',],], out)
+
+	pysam.sort(unsorted, bam[:bam.rfind('.')])
+	os.remove(unsorted)
+
+	return (outfile_name, _unaligned(summaries[0]))
+
+def _pipeline(commands, output=None):
+	"""Run commands with each reading the output of the one before, and the last
+	writing to the file output if given. Returns what each wrote to stderr, and 
+	raises CalledProcessError if any of them fail"""
+	procs = []
+	logs = []
+	try:
+		reads_in = None
+		for i,args in enumerate(commands):
+			last = (i == len(commands) - 1)
+			#stderr goes to a file so that a chatty command can't block on it
+			log = tempfile.TemporaryFile(prefix='waistcoat')
+			logs.append(log)
+			p = subprocess.Popen(args,
+					stdin = reads_in,
+					stdout = output if last else subprocess.PIPE,
+					stderr = log)
+			procs.append(p)
+
+			#only the next command should hold the pipe open
+			if reads_in is not None:
+				reads_in.close()
+			reads_in = p.stdout
+
+		for p in procs:
+			command.wait(p)
+	except:
+		for p in procs:
+			if p.poll() is None:
+				p.kill()
+				p.wait()
+		raise
+
+	summaries = []
+	for log in logs:
+		log.seek(0)
+		summaries.append(log.read())
+		log.close()
+
+	#report the last failure, earlier ones are usually a broken pipe
+	for p,args,summary in reversed(zip(procs, commands, summaries)):
+		if p.returncode != 0:
+			raise subprocess.CalledProcessError(p.returncode, args[0],
+					output = summary)
+
+	return summaries
+
+def _unaligned(summary):
+	"""Read the number of reads which failed to align from bowtie2's summary"""
+	m = re.search(r'(\d+) \([\d.]+%\) aligned 0 times', summary)
+	if m:
+		return int(m.group(1))
+	#bowtie2 only reports the total when there were no reads
+	if re.search(r'^0 reads', summary, re.M):
+		return 0
+	raise ValueError("Could not read bowtie2 summary:\n{}".format(summary))
@@ -0,0 +1,157 @@
+"""A cache of stage results shared between runs, so that reads which have
+already been filtered aren't filtered again.
+
+Usage: python -m waistcoat.cache directory list|prune [--max-size GB]"""
+
+import argparse, threading, shutil, time, os, os.path
+import simplejson as json
+
+#default size bound, in bytes
+MAX_SIZE = 20 << 30
+
+RECORD = '.json'
+READS = '.fq'
+
+class Cache(object):
+	"""Results stored in directory by key. Each entry is a JSON record, and
+	optionally a reads file. When the cache grows beyond max_size bytes the
+	least recently used entries are removed"""
+
+	def __init__(self, directory, max_size=MAX_SIZE):
+		self.directory = directory
+		self.max_size = max_size
+		self.lock = threading.Lock()
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	def get(self, key, reads=None):
+		"""Return the record stored with key, or None. If the entry has a reads
+		file, it is linked or copied to reads and the record's 'reads' set to it"""
+		try:
+			with open(self._path(key, RECORD), 'rb') as f:
+				record = json.loads(f.read())
+		except (IOError, ValueError):
+			return None
+
+		if record.get('reads'):
+			if reads is None:
+				return None
+			try:
+				_link(self._path(key, READS), reads)
+			except (IOError, OSError):
+				#evicted since the record was read
+				return None
+			record['reads'] = reads
+
+		#the record's modification time marks when it was last used
+		try:
+			os.utime(self._path(key, RECORD), None)
+		except OSError:
+			pass
+		return record
+
+	def put(self, key, reads=None, **record):
+		"""Store record with key, along with a copy of reads if given. Entries are
+		moved into place once complete, so a reader never sees part of one"""
+		record['reads'] = reads is not None
+		record['time'] = time.time()
+		if reads is not None:
+			temp = self._path(key, READS + '.tmp')
+			_link(reads, temp)
+			os.rename(temp, self._path(key, READS))
+		temp = self._path(key, RECORD + '.tmp')
+		with open(temp, 'wb') as f:
+			f.write(json.dumps(record, sort_keys=True))
+		os.rename(temp, self._path(key, RECORD))
+
+		self.prune()
+
+	def entries(self):
+		"""Return (key, size, last used, record) of every entry, least recently
+		used first"""
+		ret = []
+		for name in os.listdir(self.directory):
+			if not name.endswith(RECORD):
+				continue
+			key = name[:-len(RECORD)]
+			try:
+				last_used = os.path.getmtime(self._path(key, RECORD))
+				with open(self._path(key, RECORD), 'rb') as f:
+					record = json.loads(f.read())
+			except (IOError, OSError, ValueError):
+				continue
+			size = sum(os.path.getsize(p) for p in self._files(key)
+					if os.path.exists(p))
+			ret.append((key, size, last_used, record))
+		return sorted(ret, key=lambda e: e[2])
+
+	def prune(self, max_size=None):
+		"""Remove the least recently used entries until the cache fits in
+		max_size bytes. Returns the keys removed"""
+		max_size = self.max_size if max_size is None else max_size
+		removed = []
+		with self.lock:
+			entries = self.entries()
+			total = sum(e[1] for e in entries)
+			for (key, size, last_used, record) in entries:
+				if total <= max_size:
+					break
+				self.remove(key)
+				total -= size
+				removed.append(key)
+		return removed
+
+	def remove(self, key):
+		"""Remove the entry stored with key, the record first so that it's never
+		seen without its reads"""
+		for path in self._files(key):
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+	def _files(self, key):
+		return [self._path(key, RECORD), self._path(key, READS),]
+
+	def _path(self, key, suffix):
+		return os.path.join(self.directory, key + suffix)
+
+def _link(src, dest):
+	"""Hard link src to dest if possible, otherwise copy it"""
+	if os.path.exists(dest):
+		os.remove(dest)
+	try:
+		os.link(src, dest)
+	except OSError:
+		shutil.copyfile(src, dest)
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="Inspect or prune a waistcoat results cache")
+	parser.add_argument('directory', help='Cache directory')
+	parser.add_argument('action', choices=['list', 'prune',],
+			help='List the entries, or prune the least recently used ones')
+	parser.add_argument('--max-size', type=float, default=None,
+			help='Size in GB to prune the cache to [{}]'.format(MAX_SIZE >> 30))
+	args = parser.parse_args()
+
+	if not os.path.isdir(args.directory):
+		parser.error("\'{}\' is not a directory".format(args.directory))
+	cache = Cache(args.directory)
+
+	if args.action == 'list':
+		total = 0
+		for (key, size, last_used, record) in cache.entries():
+			total += size
+			print "{}  {:>10.1f}MB  {}  {} {}".format(key[:12], size / float(1 << 20),
+					time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used)),
+					record.get('sample', ''), record.get('stage', ''))
+		print "Total: {:.1f}MB".format(total / float(1 << 20))
+	else:
+		max_size = (MAX_SIZE if args.max_size is None
+				else int(args.max_size * (1 << 30)))
+		removed = cache.prune(max_size)
+		print "Removed {} entries".format(len(removed))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,80 @@
+"""Record the pipeline stages which have completed so that an interrupted run
+can be resumed"""
+
+import hashlib, threading, os, os.path
+import simplejson as json
+
+VERSION = 1
+
+class Manifest(object):
+	"""The completed stages of a pipeline run, stored as JSON in path.
+
+	Each stage is recorded with a key which hashes everything its output depends
+	on (its settings and the key of the stage before it), so a stage is only
+	skipped when it would produce the same output again"""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.stages = {}
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				data = json.loads(f.read())
+			if data.get('version') == VERSION:
+				self.stages = data['stages']
+
+	def get(self, stage, key, outputs=True):
+		"""Return the record of stage if it completed with key and, if outputs is
+		True, its outputs are still there. Otherwise return None"""
+		with self.lock:
+			record = self.stages.get(stage)
+		if record is None or record['key'] != key:
+			return None
+		if outputs and not all(unchanged(path, size) 
+				for (path, size) in record['outputs']):
+			return None
+		return record
+
+	def complete(self, stage, key, outputs=(), **data):
+		"""Record that stage completed with key, producing the files outputs.
+		Any other data is stored with the record"""
+		record = dict(data)
+		record['key'] = key
+		record['outputs'] = [(path, os.path.getsize(path)) for path in outputs]
+		with self.lock:
+			self.stages[stage] = record
+			self._save()
+		return record
+
+	def _save(self):
+		"""Write the manifest, replacing the old one only once it's complete"""
+		temp = self.path + '.tmp'
+		with open(temp, 'wb') as f:
+			f.write(json.dumps({'version': VERSION, 'stages': self.stages},
+				indent=1, sort_keys=True))
+		os.rename(temp, self.path)
+
+def key(*parts):
+	"""Hash parts, which must be JSON serialisable"""
+	return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+def file_hash(path, block_size=1 << 20):
+	"""Hash the contents of path"""
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		while True:
+			block = f.read(block_size)
+			if not block:
+				break
+			h.update(block)
+	return h.hexdigest()
+
+def file_id(path):
+	"""Identify path by where it is, its size and when it was last modified,
+	which unlike file_hash doesn't need the whole file read"""
+	st = os.stat(path)
+	return (os.path.abspath(path), st.st_size, st.st_mtime)
+
+def unchanged(path, size):
+	"""Test whether the output path is still there with the recorded size"""
+	return os.path.exists(path) and os.path.getsize(path) == size
@@ -0,0 +1,87 @@
+"""Map each distinct sequence once, however many samples it was found in, then
+expand the alignments back out into a BAM for each sample.
+
+preprocess.collapse writes the distinct sequences of every sample to one FASTQ
+file, naming each by its index, along with a table of the number of times each
+was found in each sample. The reads left after any stage can be counted for
+each sample from their names, and each alignment of a collapsed read is
+repeated once for every time its sequence was found in a sample"""
+
+import gzip, array, os.path, pysam
+import numpy
+
+#hits whose counts are looked up in the table at once
+BLOCK = 1 << 16
+
+class Table(object):
+	"""The number of times each collapsed read was found in each sample, mapped
+	from the table written by preprocess.collapse"""
+
+	def __init__(self, table_file, samples):
+		self.samples = list(samples)
+		if os.path.getsize(table_file) > 0:
+			self.counts = numpy.memmap(table_file, dtype=numpy.uint32, 
+					mode='r').reshape(-1, len(self.samples))
+		else:
+			self.counts = numpy.zeros((0, len(self.samples)), dtype=numpy.uint32)
+
+	def count(self, reads_file):
+		"""Count the reads in the collapsed reads_file for each sample.
+		Returns ({sample: reads}, {sample: counts of read lengths})"""
+		(ids, lengths) = read_ids(reads_file)
+		#look the hits up in order, a block at a time, rather than copying the
+		# row of every hit at once
+		order = numpy.argsort(ids, kind='mergesort')
+		ids = ids[order]
+		lengths = lengths[order]
+		totals = numpy.zeros(len(self.samples), dtype=numpy.int64)
+		dists = numpy.zeros((len(self.samples), 
+				lengths.max() + 1 if len(lengths) else 1), dtype=numpy.int64)
+		for start in xrange(0, len(ids), BLOCK):
+			rows = self.counts[ids[start:start + BLOCK]]
+			totals += rows.sum(axis=0, dtype=numpy.int64)
+			for j in xrange(len(self.samples)):
+				dists[j] += numpy.bincount(lengths[start:start + BLOCK], 
+						weights = rows[:,j], minlength = dists.shape[1]).astype(
+							numpy.int64)
+		return (dict((sample, int(totals[j]))
+					for j,sample in enumerate(self.samples)),
+				dict((sample, dists[j]) for j,sample in enumerate(self.samples)))
+
+	def expand(self, bam, outputs):
+		"""Copy the alignments in bam to outputs, a BAM file for each sample,
+		repeating each once for every time its read was found in the sample. The
+		copies are named [read]_[copy], and are left in the order of bam.
+		Returns the number of alignments written to each output"""
+		instream = pysam.Samfile(bam, 'rb')
+		outstreams = [pysam.Samfile(o, 'wb', template = instream)
+				for o in outputs]
+		written = [0,] * len(outputs)
+		for alg in instream:
+			read = int(alg.qname)
+			for j,(out, n) in enumerate(zip(outstreams, self.counts[read])):
+				for copy in xrange(n):
+					alg.qname = "{}_{}".format(read, copy)
+					out.write(alg)
+				written[j] += int(n)
+		for out in outstreams:
+			out.close()
+		instream.close()
+		return written
+
+def read_ids(reads_file):
+	"""Return arrays of the indexes and lengths of the collapsed reads in
+	reads_file, which may be gzipped"""
+	ids = array.array('l')
+	lengths = array.array('l')
+	with (gzip.open if reads_file.endswith('.gz') else open)(reads_file,
+			'rb') as f:
+		#records are written on four lines
+		for name in f:
+			ids.append(int(name[1:]))
+			lengths.append(len(next(f).rstrip('\r\n')))
+			next(f)
+			next(f)
+	return (numpy.frombuffer(ids, dtype=numpy.dtype(ids.typecode)).astype(
+				numpy.intp),
+			numpy.frombuffer(lengths, dtype=numpy.dtype(lengths.typecode)))
@@ -1,6 +1,20 @@
 """Class to execute an external command after checking arguments etc"""
 
-import subprocess, os, shlex
+import subprocess, os, shlex, select, errno, time, collections
+import instrument
+
+#the most output kept from each stream, older output is dropped
+BUFFER_SIZE = 1 << 20
+READ_SIZE = 1 << 16
+
+class Timeout(Exception):
+	"""Raised when a command runs for longer than its timeout"""
+	def __init__(self, cmd, timeout, output=None):
+		Exception.__init__(self, 
+				"Command \'{}\' timed out after {}s".format(cmd, timeout))
+		self.cmd = cmd
+		self.timeout = timeout
+		self.output = output
 
 class Command:
 	"""A class which calls an external command and checks return values"""
@@ -9,43 +23,200 @@ class Command:
 	cmd = ""
 	default_args = []
 
-	def call(self, args=[], update_fn=None, stderr=False):
+	def call(self, args=[], update_fn=None, stderr=False, timeout=None):
 		"""Call the function with the argument and check return codes
 		update_fn: function to update with each line of output. must not block.
 		stderr: if true, listen to stderr instead of stdout
+		timeout: seconds to wait before killing the command and raising Timeout
+		Returns (stdout, stderr), each limited to the last BUFFER_SIZE bytes
 		"""
+		p = self.start(args, update_fn, stderr, timeout)
+		run([p,])
+		return p.check()
 
+	def start(self, args=[], update_fn=None, stderr=False, timeout=None):
+		"""Start the command and return its Process, without waiting for it.
+		Pass a list of Processes to run() to wait for them all"""
 		if isinstance(args, basestring):
 			args = shlex.split(args)
 
-		p = subprocess.Popen([self.cmd,] + self.default_args + args,
-							stdout = subprocess.PIPE, 
-							stdin  = subprocess.PIPE,
-							stderr = subprocess.PIPE)
+		return Process([self.cmd,] + self.default_args + args, update_fn, stderr,
+				timeout)
+
+class Process(object):
+	"""A running command whose stdout and stderr are collected into RingBuffers
+	by run()"""
+
+	def __init__(self, args, update_fn=None, stderr=False, timeout=None,
+			buffer_size=BUFFER_SIZE):
+		self.cmd = args[0]
+		self.timeout = timeout
+		self.timed_out = False
+		self.out = RingBuffer(buffer_size)
+		self.err = RingBuffer(buffer_size)
 
-		#wait for lines
-		if update_fn:
-			while True:
-				if stderr:
-					nextline = p.stderr.readline()
-				else:
-					nextline = p.stdout.readline()
-				if nextline == '' and p.poll() != None:
-					break
-				update_fn(nextline.rstrip())
-
-		#collect the output
-		out = p.communicate()
-
-		#check returncode
-		if p.returncode != 0:
-			#error
+		with open(os.devnull, 'rb') as devnull:
+			#other threads' pipes must not leak into the command, or they would
+			# never see the end of their output
+			self.popen = subprocess.Popen(args,
+								stdout = subprocess.PIPE, 
+								stdin  = devnull,
+								stderr = subprocess.PIPE,
+								close_fds = True)
+		self.deadline = None if timeout is None else time.time() + timeout
+		self.streams = [
+				_Stream(self.popen.stdout, self.out, None if stderr else update_fn),
+				_Stream(self.popen.stderr, self.err, update_fn if stderr else None),]
+
+	@property
+	def returncode(self):
+		return self.popen.returncode
+
+	@property
+	def reading(self):
+		"""True until all the command's output has been read"""
+		return not all(stream.closed for stream in self.streams)
+
+	def kill(self):
+		"""Kill the command and stop reading its output"""
+		if self.popen.returncode is None:
+			self.popen.kill()
+		for stream in self.streams:
+			stream.close()
+
+	def check(self):
+		"""Raise Timeout or CalledProcessError if the command didn't succeed,
+		otherwise return (stdout, stderr)"""
+		if self.timed_out:
+			raise Timeout(self.cmd, self.timeout, self.err.getvalue())
+		if self.returncode != 0:
 			raise subprocess.CalledProcessError(
-				p.returncode,
+				self.returncode,
 				self.cmd,
-				output = out[1])
+				output = self.err.getvalue())
+		return (self.out.getvalue(), self.err.getvalue())
+
+class RingBuffer(object):
+	"""Keep the last size bytes written"""
+
+	def __init__(self, size):
+		self.size = size
+		self.chunks = collections.deque()
+		self.length = 0
+
+	def write(self, data):
+		self.chunks.append(data)
+		self.length += len(data)
+		while self.length > self.size:
+			extra = self.length - self.size
+			if len(self.chunks[0]) <= extra:
+				self.length -= len(self.chunks.popleft())
+			else:
+				self.chunks[0] = self.chunks[0][extra:]
+				self.length -= extra
 
-		return out
+	def getvalue(self):
+		return ''.join(self.chunks)
+
+class _Stream(object):
+	"""An output pipe of a Process, split into lines for update_fn"""
+
+	def __init__(self, f, buffer, update_fn=None):
+		self.f = f
+		self.buffer = buffer
+		self.update_fn = update_fn
+		self.partial = ''
+
+	def fileno(self):
+		return self.f.fileno()
+
+	@property
+	def closed(self):
+		return self.f.closed
+
+	def write(self, data):
+		self.buffer.write(data)
+		if self.update_fn:
+			lines = (self.partial + data).split('\n')
+			self.partial = lines.pop()
+			for line in lines:
+				self.update_fn(line.rstrip())
+
+	def close(self):
+		if self.closed:
+			return
+		self.f.close()
+		if self.update_fn and self.partial:
+			self.update_fn(self.partial.rstrip())
+		self.partial = ''
+
+def run(processes):
+	"""Read the output of all of processes as it arrives, from a single poll
+	loop, until they have all finished. Processes which run past their
+	timeout are killed"""
+	poller = select.poll()
+	streams = {}
+	for p in processes:
+		for stream in p.streams:
+			if not stream.closed:
+				poller.register(stream.fileno(), select.POLLIN | select.POLLPRI)
+				streams[stream.fileno()] = stream
+
+	while streams:
+		#wake up in time for the next deadline
+		deadlines = [p.deadline for p in processes 
+				if p.deadline is not None and p.reading]
+		timeout = None
+		if deadlines:
+			timeout = max(0, int(1000 * (min(deadlines) - time.time())) + 1)
+		try:
+			events = poller.poll(timeout)
+		except select.error as e:
+			if e.args[0] == errno.EINTR:
+				continue
+			raise
+
+		for (fd, event) in events:
+			stream = streams[fd]
+			data = os.read(fd, READ_SIZE)
+			if data:
+				stream.write(data)
+			else:
+				#end of output
+				poller.unregister(fd)
+				del streams[fd]
+				stream.close()
+
+		now = time.time()
+		for p in processes:
+			if p.deadline is not None and now >= p.deadline and p.reading:
+				p.timed_out = True
+				for stream in p.streams:
+					if not stream.closed:
+						poller.unregister(stream.fileno())
+						del streams[stream.fileno()]
+				p.kill()
+
+	for p in processes:
+		wait(p.popen)
+	return processes
+
+def wait(popen):
+	"""Wait for the subprocess.Popen popen to exit and return its returncode. The
+	resources it used are recorded against the current instrument.Stage"""
+	while popen.returncode is None:
+		try:
+			(pid, status, usage) = os.wait4(popen.pid, 0)
+		except OSError as e:
+			if e.errno == errno.EINTR:
+				continue
+			raise
+		if os.WIFSIGNALED(status):
+			popen.returncode = -os.WTERMSIG(status)
+		else:
+			popen.returncode = os.WEXITSTATUS(status)
+		instrument.child(usage)
+	return popen.returncode
 		
 def isAvailable(command):
 	try:
@@ -0,0 +1,180 @@
+"""Hold a genome as packed bytes with precomputed runs of As"""
+
+import mmap, os, os.path, tempfile, re
+import simplejson as json
+
+CACHE_SUFFIX = ".packed"
+MAGIC = "waistcoat packed genome 1\n"
+
+#run lengths are stored in a byte, longer runs are followed to their end
+RUN_MAX = 255
+DESCENDING = bytearray(range(RUN_MAX, 0, -1))
+ASCENDING = bytearray(range(1, RUN_MAX + 1))
+
+A_RUN = re.compile('A+')
+
+class PackedGenome(object):
+	"""A genome held as uppercase bytes in a memory mapped cache file, along with
+	the length of the run of As starting and ending at each position.
+
+	The cache is written next to the FASTA file and rebuilt whenever the FASTA
+	file changes"""
+
+	def __init__(self, fasta, cache=None):
+		self.fasta = fasta
+		self.cache = cache or fasta + CACHE_SUFFIX
+		self.contigs = {}
+
+		if not self._load(self.cache):
+			try:
+				build(fasta, self.cache)
+				self._load(self.cache)
+			except (IOError, OSError):
+				#can't write next to the genome, use a temporary cache
+				(f, tempname) = tempfile.mkstemp(prefix='waistcoat',
+						suffix=CACHE_SUFFIX)
+				os.close(f)
+				try:
+					build(fasta, tempname)
+					self._load(tempname)
+				finally:
+					os.remove(tempname)
+
+	def __contains__(self, name):
+		return name in self.contigs
+
+	def __getitem__(self, name):
+		return self.contigs[name]
+
+	def close(self):
+		self.contigs = {}
+		self.data.close()
+
+	def _load(self, cache):
+		"""Map the cache if it is up to date with the FASTA file"""
+		try:
+			f = open(cache, 'rb')
+		except IOError:
+			return False
+
+		with f:
+			if f.readline() != MAGIC:
+				return False
+			try:
+				header = json.loads(f.readline())
+			except ValueError:
+				return False
+			if header['source'] != _source_info(self.fasta):
+				return False
+			start = f.tell()
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		for (name, length) in header['contigs']:
+			self.contigs[name] = Contig(self.data, start, length)
+			start += 3 * length
+
+		return True
+
+class Contig(object):
+	"""A single sequence of a PackedGenome. Stored as the bases, then the length
+	of the run of As starting at each base, then the length of the run ending
+	at each base"""
+
+	def __init__(self, data, start, length):
+		self.data = data
+		self.start = start
+		self.length = length
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, p):
+		if p < 0 or p >= self.length:
+			raise IndexError("Position {} outside contig".format(p))
+		return self.data[self.start + p]
+
+	def a_after(self, p):
+		"""Number of As in the run starting at p"""
+		return self._run(self.start + self.length, p, 1)
+
+	def a_before(self, p):
+		"""Number of As in the run ending at p"""
+		return self._run(self.start + 2 * self.length, p, -1)
+
+	def _run(self, runs, p, step):
+		n = 0
+		while 0 <= p < self.length:
+			r = ord(self.data[runs + p])
+			n += r
+			if r != RUN_MAX:
+				break
+			p += step * RUN_MAX
+		return n
+
+def build(fasta, cache):
+	"""Write the packed cache of fasta. The cache is written to a temporary file
+	and moved into place so that readers never see a partial cache"""
+	(f, tempname) = tempfile.mkstemp(prefix='.waistcoat',
+			dir=os.path.dirname(os.path.abspath(cache)))
+	try:
+		with os.fdopen(f, 'wb') as out:
+			#contig data goes to the body, the header is only known at the end
+			body = tempfile.TemporaryFile(prefix='waistcoat')
+			contigs = []
+			for (name, seq) in read_fasta(fasta):
+				(after, before) = a_runs(seq)
+				body.write(seq)
+				body.write(after)
+				body.write(before)
+				contigs.append((name, len(seq)))
+
+			out.write(MAGIC)
+			out.write(json.dumps({'source': _source_info(fasta),
+				'contigs': contigs,}) + '\n')
+			body.seek(0)
+			while True:
+				chunk = body.read(1 << 20)
+				if not chunk:
+					break
+				out.write(chunk)
+			body.close()
+		os.rename(tempname, cache)
+	except:
+		os.remove(tempname)
+		raise
+
+def read_fasta(fasta):
+	"""Yield (name, uppercase sequence) for each record in fasta"""
+	name = None
+	lines = []
+	with open(fasta, 'rb') as f:
+		for line in f:
+			if line.startswith('>'):
+				if name is not None:
+					yield (name, ''.join(lines).upper())
+				name = (line[1:].split(None, 1) or ['',])[0]
+				lines = []
+			else:
+				lines.append(line.strip())
+	if name is not None:
+		yield (name, ''.join(lines).upper())
+
+def a_runs(seq):
+	"""Return the length of the run of As starting and ending at each position of
+	seq, capped at RUN_MAX"""
+	after = bytearray(len(seq))
+	before = bytearray(len(seq))
+	for m in A_RUN.finditer(seq):
+		(s, e) = m.span()
+		l = e - s
+		if l <= RUN_MAX:
+			after[s:e] = DESCENDING[RUN_MAX - l:]
+			before[s:e] = ASCENDING[:l]
+		else:
+			after[s:e] = bytearray([RUN_MAX]) * (l - RUN_MAX) + DESCENDING
+			before[s:e] = ASCENDING + bytearray([RUN_MAX]) * (l - RUN_MAX)
+	return (after, before)
+
+def _source_info(fasta):
+	st = os.stat(fasta)
+	return [st.st_size, st.st_mtime]
@@ -0,0 +1,142 @@
+"""Measure the time and resources each stage of the pipeline uses"""
+
+import resource, threading, time, os, os.path
+import simplejson as json
+
+#Linux only, and not named in Python 2's resource module
+RUSAGE_THREAD = 1
+
+recording = True
+
+#completed stages, in the order they finished
+stages = []
+_lock = threading.Lock()
+_local = threading.local()
+
+class Stage(object):
+	"""The resources used by one stage of one sample. A stage measures the thread
+	it runs in, plus the external commands it waits for, so that stages running
+	side by side are counted separately. whole_process stages measure every
+	thread instead, for stages which run on their own"""
+
+	def __init__(self, name, sample=None, whole_process=False):
+		self.name = name
+		self.sample = sample
+		self.whole_process = whole_process
+		self.reads = None
+		self.children = {'cpu_s': 0.0, 'peak_rss_kb': 0, 'count': 0,
+				'block_read_bytes': 0, 'block_write_bytes': 0,}
+
+	def __enter__(self):
+		self.outer = getattr(_local, 'stage', None)
+		_local.stage = self
+		self._wall = time.time()
+		self._usage = self._getrusage()
+		self._io = _io(self._io_file())
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		_local.stage = self.outer
+		wall = time.time() - self._wall
+		usage = self._getrusage()
+		io = _io(self._io_file())
+
+		self.record = {
+				'stage': self.name,
+				'sample': self.sample,
+				'ok': exc_type is None,
+				'wall_s': wall,
+				'cpu_s': (usage.ru_utime - self._usage.ru_utime) +
+					(usage.ru_stime - self._usage.ru_stime),
+				'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+				'read_bytes': _delta(io, self._io, 'rchar'),
+				'write_bytes': _delta(io, self._io, 'wchar'),
+				'reads': self.reads,
+				'reads_per_s': self.reads / wall if self.reads and wall else None,
+				'children': self.children,}
+		if recording:
+			with _lock:
+				stages.append(self.record)
+		return False
+
+	def child(self, usage):
+		"""Add the resource usage of a child process which has been waited for"""
+		self.children['count'] += 1
+		self.children['cpu_s'] += usage.ru_utime + usage.ru_stime
+		self.children['peak_rss_kb'] = max(self.children['peak_rss_kb'],
+				usage.ru_maxrss)
+		self.children['block_read_bytes'] += 512 * usage.ru_inblock
+		self.children['block_write_bytes'] += 512 * usage.ru_oublock
+
+	def _getrusage(self):
+		if not self.whole_process:
+			try:
+				return resource.getrusage(RUSAGE_THREAD)
+			except (ValueError, resource.error):
+				pass
+		return resource.getrusage(resource.RUSAGE_SELF)
+
+	def _io_file(self):
+		return '/proc/self/io' if self.whole_process else '/proc/thread-self/io'
+
+def stage(name, sample=None, whole_process=False):
+	"""Return a Stage to measure a with block. Set its reads attribute to the
+	number of reads handled to get the rate"""
+	return Stage(name, sample, whole_process)
+
+def child(usage):
+	"""Record the usage of a child process against the current thread's stage"""
+	current = getattr(_local, 'stage', None)
+	if current is not None:
+		current.child(usage)
+
+def _now():
+	return (time.time(), resource.getrusage(resource.RUSAGE_SELF),
+			resource.getrusage(resource.RUSAGE_CHILDREN), _io('/proc/self/io'))
+
+def clear():
+	"""Clear recorded stages and start measuring the totals again"""
+	with _lock:
+		del stages[0:len(stages)]
+	_start[0] = _now()
+
+def totals():
+	"""Return the resources used by the whole process and its children since
+	clear() was called. Peak RSS is the peak since the process started"""
+	(wall, me, children, io) = _now()
+	(wall_0, me_0, children_0, io_0) = _start[0]
+	return {
+			'wall_s': wall - wall_0,
+			'cpu_s': (me.ru_utime - me_0.ru_utime) + (me.ru_stime - me_0.ru_stime),
+			'peak_rss_kb': me.ru_maxrss,
+			'read_bytes': _delta(io, io_0, 'rchar'),
+			'write_bytes': _delta(io, io_0, 'wchar'),
+			'children_cpu_s': (children.ru_utime - children_0.ru_utime) + 
+				(children.ru_stime - children_0.ru_stime),
+			'children_peak_rss_kb': children.ru_maxrss,}
+
+def write(directory):
+	"""Write the stages and totals to directory/resources.json"""
+	if not os.path.exists(directory):
+		os.mkdir(directory)
+	with _lock:
+		data = {'stages': list(stages), 'total': totals(),}
+	with open(os.path.join(directory, 'resources.json'), 'wb') as f:
+		f.write(json.dumps(data, indent=1, sort_keys=True))
+
+def _io(path):
+	"""Read the I/O counters from a /proc io file, or {} if there isn't one"""
+	try:
+		with open(path) as f:
+			return dict((k.strip(), int(v)) for (k,v) in
+					(line.split(':') for line in f if ':' in line))
+	except (IOError, ValueError):
+		return {}
+
+def _delta(after, before, key):
+	if key in after and key in before:
+		return after[key] - before[key]
+	return None
+
+#totals are measured from when the module is loaded, until clear() is called
+_start = [_now(),]
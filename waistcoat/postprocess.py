@@ -1,88 +1,253 @@
 
-import pysam, os.path, os, shutil, tempfile, statistics
-from Bio import SeqIO
+import pysam, os.path, os, shutil, tempfile, statistics, genome as packed
+import heapq, sys, command
+import simplejson as json
 
-def run(outdir, sample, genome, target_length = 28, extend=False):
-	"""extend hits by adding As up until target length where possible"""
+#number of shards given to each process, so that they finish at similar times
+SHARDS_PER_PROCESS = 4
+#the region holding reads without a position, as samtools names it
+UNMAPPED = '*'
+
+def run(outdir, sample, genome, target_length = 28, extend=False, 
+		processes=1):
+	"""extend hits by adding As up until target length where possible, writing
+	them sorted and indexed to outdir/sample.bam and recording their lengths
+	processes: extend regions of the genome in this many processes at once"""
 
 	samfile = os.path.join(outdir, sample, 'accepted_hits.bam')
-	pysam.index(samfile)
-	if extend:
-		count = extend_short_reads(samfile, genome, target_length)
+	outsam = os.path.join(outdir, '{}.bam'.format(sample))
+	lengths = statistics.collector(statistics.FINAL, sample)
+	if extend and processes > 1:
+		count = extend_sharded(samfile, genome, target_length, processes, outsam,
+				lengths)
 	else:
-		count = count_reads(samfile)
+		count = postprocess_hits(samfile, outsam, genome if extend else None, 
+				target_length, lengths)
+	pysam.index(outsam)
 
+	return count
 
-	# sort and index
-	outsam = os.path.join(outdir, '{}'.format(sample))
-	pysam.sort(samfile, outsam)
-	outsam = "{}.bam".format(outsam)
-	pysam.index(outsam)
+def postprocess_hits(samfile, outsam, genome=None, target_length=28, 
+		lengths=None):
+	"""Copy the hits in samfile to outsam in a single pass, extending them if
+	genome is given. Returns the number of mapped reads and adds their lengths to
+	the statistics.Histogram lengths.
+
+	TopHat leaves samfile sorted, so outsam is too: extended reverse reads are
+	only held back until no later read can be moved in front of them"""
+	targets = packed.PackedGenome(genome) if genome else None
+	instream = pysam.Samfile(samfile, 'rb')
+	outstream = pysam.Samfile(outsam, 'wb', template = instream)
+
+	count = 0
+	if lengths is None:
+		lengths = statistics.Histogram()
+	held = []
+	tid = None
+	target = None
+	last = None
+	in_order = True
+	for i,alg in enumerate(instream):
+		#unmapped reads come last
+		key = (alg.tid if alg.tid >= 0 else sys.maxint, alg.pos)
+		if key < last:
+			in_order = False
+		last = key
+
+		if alg.tid != tid:
+			while held:
+				outstream.write(heapq.heappop(held)[2])
+			tid = alg.tid
+			target = None
+			if targets is not None and tid >= 0:
+				rname = instream.getrname(tid)
+				if rname in targets:
+					target = targets[rname]
+
+		count += _record(alg, lengths)
+
+		if target is None:
+			outstream.write(alg)
+			continue
+
+		#no later read can be moved further back than this
+		pos = alg.pos
+		bound = min(pos - target.a_before(pos - 1), pos - target_length)
+		extend_read(alg, target, target_length)
+		heapq.heappush(held, (alg.pos, i, alg))
+		while held and held[0][0] <= bound:
+			outstream.write(heapq.heappop(held)[2])
+
+	while held:
+		outstream.write(heapq.heappop(held)[2])
+
+	instream.close()
+	outstream.close()
+	if targets is not None:
+		targets.close()
+
+	if not in_order:
+		#samfile wasn't sorted after all
+		prefix = outsam[:outsam.rfind('.')] + '.unsorted'
+		shutil.move(outsam, prefix + '.bam')
+		pysam.sort(prefix + '.bam', outsam[:outsam.rfind('.')])
+		os.remove(prefix + '.bam')
 
 	return count
-			
-def count_reads(samfile):
+
+def _record(alg, lengths):
+	"""Add the read to the length histogram, return 1 if it is mapped"""
+	if alg.alen is not None:
+		lengths.add(alg.alen)
+	return 0 if alg.is_unmapped else 1
+
+def extend_sharded(samfile, genome, target_length, processes, outsam, 
+		lengths=None):
+	"""Extend the reads in samfile a region at a time in processes separate
+	interpreters, merging the sorted regions into outsam. Returns the number of
+	mapped reads and adds their lengths to the statistics.Histogram lengths.
+
+	The pipeline runs stages in threads, so the workers are started as new
+	programs rather than forked, which could copy a lock another thread holds"""
+	pysam.index(samfile)
 	instream = pysam.Samfile(samfile, 'rb')
-	count = instream.mapped
+	shards = split_regions(instream.references, instream.lengths, 
+			processes * SHARDS_PER_PROCESS)
 	instream.close()
+	#unmapped reads are copied through, as postprocess_hits does
+	shards.append([(UNMAPPED, 0, 0),])
+
+	#make sure the genome cache exists before the workers look for it
+	packed.PackedGenome(genome).close()
+
+	tempd = tempfile.mkdtemp(prefix='postprocess')
+	try:
+		jobs = [(samfile, genome, target_length, regions, 
+			os.path.join(tempd, 'shard{}'.format(i))) 
+			for i,regions in enumerate(shards)]
+
+		#each worker takes every processes'th shard, so that the shards of any
+		# densely covered reference are shared out
+		workers = []
+		try:
+			for i in range(min(processes, len(jobs))):
+				job_file = os.path.join(tempd, 'worker{}.json'.format(i))
+				with open(job_file, 'wb') as f:
+					f.write(json.dumps(jobs[i::processes]))
+				workers.append(command.Process([sys.executable, _script(), 
+					job_file]))
+			command.run(workers)
+		except:
+			for w in workers:
+				w.kill()
+				command.wait(w.popen)
+			raise
+
+		count = 0
+		for w in workers:
+			(out, err) = w.check()
+			for (c, counts) in json.loads(out):
+				count += c
+				if lengths is not None:
+					lengths.merge(counts)
+
+		shards = ["{}.bam".format(job[-1]) for job in jobs]
+		if len(shards) > 1:
+			pysam.merge(outsam, *shards)
+		else:
+			shutil.move(shards[0], outsam)
+	finally:
+		shutil.rmtree(tempd)
+		#the index was only needed to fetch the regions
+		os.remove(samfile + ".bai")
+
 	return count
 
-def extend_short_reads(samfile, genome, target_length):
-	#load the targets into RAM
-	targets = {}
-	for seq in SeqIO.parse(genome, 'fasta'):
-		targets[seq.name] = seq
+def split_regions(references, lengths, n):
+	"""Split the references into about n shards of similar total length. Each
+	shard is a list of (reference, start, end) regions"""
+	size = max(1, sum(lengths) / n + 1)
+	shards = [[]]
+	filled = 0
+	for name,length in zip(references, lengths):
+		start = 0
+		while start < length:
+			end = min(length, start + size - filled)
+			shards[-1].append((name, start, end))
+			filled += end - start
+			start = end
+			if filled >= size:
+				shards.append([])
+				filled = 0
+	return [shard for shard in shards if shard] or [[]]
+
+def _script():
+	"""The path of this module, which extend_sharded runs as a program"""
+	return os.path.splitext(os.path.abspath(__file__))[0] + '.py'
 
-	#touch the temporary file
-	(temp, tempname) = tempfile.mkstemp('w', prefix='postprocess')
-	os.close(temp)
+def _extend_shards(job_file):
+	"""Extend each of the shards listed in job_file, returning the number of
+	reads and counts of their lengths for each"""
+	with open(job_file, 'rb') as f:
+		jobs = json.loads(f.read())
+	return [(c, [int(x) for x in counts]) for (c, counts) in 
+			(_extend_regions(*job) for job in jobs)]
 
-	#open the files
+def _extend_regions(samfile, genome, target_length, regions, prefix):
+	"""Extend the reads which start in the regions and write them sorted to
+	prefix.bam"""
+	targets = packed.PackedGenome(genome)
 	instream = pysam.Samfile(samfile, 'rb')
-	outstream = pysam.Samfile(tempname, 'wb', template = instream)
+	outstream = pysam.Samfile(prefix + ".unsorted.bam", 'wb', template = instream)
 
 	count = 0
-	for alg in instream.fetch():
-		rname = instream.getrname(alg.tid)
-		if targets.has_key(rname):
-			extend_limit = count_a(alg, targets[rname])
-			extend = max(extend_limit, target_length - alg.alen)
-			if not alg.is_reverse:
-				qual = alg.qual
-				alg.seq = alg.seq + ('A' * extend)
-				alg.qual = qual + ('!' * extend)
-			else:
-				qual = alg.qual
-				alg.seq = ('T' * extend) + alg.seq
-				alg.qual = ('T' * extend) + qual
-				alg.pos = alg.pos - extend
-		outstream.write(alg)
-		count += 1
-	
-	#close up
+	lengths = statistics.Histogram()
+	for (rname, start, end) in regions:
+		target = targets[rname] if rname in targets else None
+		if rname == UNMAPPED:
+			algs = instream.fetch(UNMAPPED)
+		else:
+			#reads overlapping the start belong to the previous region
+			algs = (alg for alg in instream.fetch(rname, start, end) 
+					if alg.pos >= start)
+		for alg in algs:
+			count += _record(alg, lengths)
+			if target is not None:
+				extend_read(alg, target, target_length)
+			outstream.write(alg)
+
 	instream.close()
 	outstream.close()
+	targets.close()
 
-	#move to original location
-	shutil.move(tempname, samfile)
+	#extending reverse reads moves them back, so the shard needs sorting
+	pysam.sort(prefix + ".unsorted.bam", prefix)
+	os.remove(prefix + ".unsorted.bam")
 
-	#rebuild index
-	os.remove(samfile + ".bai")
-	pysam.index(samfile)
+	return (count, lengths.counts)
 
-	return count
+def extend_read(alg, target, target_length):
+	"""Extend a read with As, target is the genome.Contig it maps to"""
+	extend_limit = count_a(alg, target)
+	extend = max(extend_limit, target_length - alg.alen)
+	if not alg.is_reverse:
+		qual = alg.qual
+		alg.seq = alg.seq + ('A' * extend)
+		alg.qual = qual + ('!' * extend)
+	else:
+		qual = alg.qual
+		alg.seq = ('T' * extend) + alg.seq
+		alg.qual = ('T' * extend) + qual
+		alg.pos = alg.pos - extend
 
 def count_a(alg, target):
-	"""Count the number of As after the read"""
+	"""Count the number of As after the read, target is a genome.Contig"""
 	
 	if not alg.is_reverse:
-		p = int(alg.aend)
-		while str(target[p+1]).upper() == 'A':
-			p += 1
-		return p - alg.aend
+		return target.a_after(alg.aend + 1)
 	else:
-		p = int(alg.pos)
-		while str(target[p-1]).upper() == 'A':
-			p -= 1
-		return alg.pos - p
+		return target.a_before(alg.pos - 1)
 
+if __name__ == '__main__':
+	#run by extend_sharded, results go back on stdout
+	sys.stdout.write(json.dumps(_extend_shards(sys.argv[1])))
@@ -13,7 +13,20 @@ PyObject *os, *os_path, *settings, *stats, *tempfile, *the_module;
 const float BOOST_FACTOR = 2.0;
 const float MATCH_THRESHOLD = 0.04;
 const size_t MIN_LENGTH = 15;
-const size_t LENGTH_DIST = 512;
+//zlib buffer size for reading (optionally gzipped) input and writing output
+const unsigned int GZ_BUFFER = 128 * 1024;
+//allocation size for reads kept during deduplication
+const size_t ARENA_BLOCK = 4 * 1024 * 1024;
+//the smallest allocation size, for reads kept in a small memory budget
+const size_t ARENA_MIN_BLOCK = 4 * 1024;
+//the least memory a sample may be deduplicated in, exposed as min_memory
+const size_t MIN_MEMORY = 4 * 1024 * 1024;
+//counts of collapsed reads are copied into the table this many at a time
+const size_t COLLAPSE_BLOCK = 1024 * 1024;
+//runs spilled to disk are merged into one when there are this many
+#define MAX_RUNS 64
+//buffer size for writing and reading runs
+const size_t RUN_BUFFER = 256 * 1024;
 
 // ****************************************************************
 // -------------------------- Functions from modules --------------
@@ -34,14 +47,14 @@ const char* os_path_join2(const char* lhs, const char* rhs)
     return ret;
 }
 
-FILE *tempfile_mkstemp3(const char* dir, const char* prefix, const char* suffix,
-        const char** filename)
+int tempfile_mkstemp_fd(const char* dir, const char* prefix, 
+        const char* suffix, const char** filename)
 {
     PyObject *mkstemp = PyObject_GetAttrString(tempfile, "mkstemp");
     PyObject *out = PyObject_CallFunction(mkstemp, "sss", suffix, prefix, dir);
     if (out == NULL)
     {
-        return NULL;
+        return -1;
     }
 
     int ret;
@@ -50,7 +63,61 @@ FILE *tempfile_mkstemp3(const char* dir, const char* prefix, const char* suffix,
     Py_DECREF(mkstemp);
     Py_DECREF(out);
 
-    return fdopen(ret, "w");
+    return ret;
+}
+
+FILE *tempfile_mkstemp3(const char* dir, const char* prefix, const char* suffix,
+        const char** filename)
+{
+    int fd = tempfile_mkstemp_fd(dir, prefix, suffix, filename);
+    return (fd < 0) ? NULL : fdopen(fd, "w");
+}
+
+//the mode to open reads for writing with, compressed at level. mode must hold
+// 16 characters
+const char *write_mode(int level, char *mode)
+{
+    //"T" writes without compressing
+    if(level > 0)
+        sprintf(mode, "wb%d", level);
+    else
+        sprintf(mode, "wbT");
+    return mode;
+}
+
+//open a temporary file to write reads to, gzip compressed at level with ".gz"
+// added to suffix, or uncompressed if level is 0. Returns NULL with an
+// exception set on error
+gzFile tempfile_reads(const char* dir, const char* prefix, const char* suffix,
+        int level, const char** filename)
+{
+    char gz_suffix[strlen(suffix) + 4], mode[16];
+    sprintf(gz_suffix, "%s%s", suffix, (level > 0) ? ".gz" : "");
+    int fd = tempfile_mkstemp_fd(dir, prefix, gz_suffix, filename);
+    if(fd < 0) return NULL;
+
+    gzFile f = gzdopen(fd, write_mode(level, mode));
+    if(f == NULL)
+    {
+        close(fd);
+        PyErr_NoMemory();
+        return NULL;
+    }
+    gzbuffer(f, GZ_BUFFER);
+    return f;
+}
+
+//check that level is a gzip compression level or 0 for none. Returns 0 with an
+// exception set if it isn't
+int check_level(int level)
+{
+    if(level < 0 || level > 9)
+    {
+        PyErr_SetString(PyExc_ValueError, 
+                "compress must be a gzip level from 1 to 9, or 0");
+        return 0;
+    }
+    return 1;
 }
 
 FILE *tempfile_mkstemp2(const char* dir, const char* prefix,
@@ -73,7 +140,43 @@ int stats_addvalues(const char* name, PyObject* values)
     if(addValues == NULL) return 0;
 
     PyObject* ret = PyObject_CallFunction(addValues, "sO", name, values);
+    Py_DECREF(addValues);
+    if(ret == NULL) return 0;
+    Py_DECREF(ret);
+
+    return 1;
+}
+
+//add the histogram dist of read lengths to the statistics collector for
+// sample at stage
+int stats_addlengths(const char* stage, PyObject* sample, long *dist, 
+        size_t size)
+{
+    size_t i;
+    PyObject *counts = PyList_New(size);
+    if(counts == NULL) return 0;
+    for(i = 0; i < size; i++)
+    {
+        PyObject *count = PyInt_FromLong(dist[i]);
+        if(count == NULL)
+        {
+            Py_DECREF(counts);
+            return 0;
+        }
+        PyList_SET_ITEM(counts, i, count);
+    }
+
+    PyObject *collector = PyObject_CallMethod(stats, "collector", "sO", stage,
+            sample);
+    PyObject *ret = NULL;
+    if(collector != NULL)
+    {
+        ret = PyObject_CallMethod(collector, "merge", "O", counts);
+        Py_DECREF(collector);
+    }
+    Py_DECREF(counts);
     if(ret == NULL) return 0;
+    Py_DECREF(ret);
 
     return 1;
 }
@@ -82,6 +185,38 @@ int stats_addvalues(const char* name, PyObject* values)
 // -------------------------- Utility funcs --------------------------
 // ****************************************************************
 
+//open a FASTQ file for reading. gzip files, including multi-member and BGZF 
+// files, are decompressed as they are read and other files are read as-is.
+// On failure returns NULL and describes the error in error[ERROR_SIZE]
+gzFile open_reads(const char* fname, char *error)
+{
+    gzFile f = gzopen(fname, "rb");
+    if(f == NULL)
+    {
+        snprintf(error, ERROR_SIZE, "Could not open file \"%s\"", fname);
+        return NULL;
+    }
+    gzbuffer(f, GZ_BUFFER);
+    return f;
+}
+
+//close a file opened by open_reads, returning 0 and describing the error in
+// error[ERROR_SIZE] if there was an error reading from it
+int close_reads(gzFile f, const char* fname, char *error)
+{
+    int errnum = Z_OK;
+    const char *msg = gzerror(f, &errnum);
+    if(errnum != Z_OK)
+    {
+        snprintf(error, ERROR_SIZE, "Error reading from file \"%s\": %s", 
+                fname, msg);
+        gzclose(f);
+        return 0;
+    }
+    gzclose(f);
+    return 1;
+}
+
 int is_verbose(void)
 {
     PyObject *v = PyObject_GetAttrString(the_module, "verbose");
@@ -90,19 +225,13 @@ int is_verbose(void)
     return r;
 }
 
-size_t write_lines(const char* out, size_t width, FILE *ofile)
+//the least memory each sample may be deduplicated in, from min_memory
+size_t get_min_memory(void)
 {
-    size_t len = strlen(out), pos = 0, written = 0, tmp = 0;
-
-    while(pos < len)
-    {
-        tmp = fwrite(out + pos, sizeof(char), 
-                (width < (len-pos)) ? width : (len-pos), ofile);
-        fputc('\n', ofile);
-        written += tmp + 1;
-        pos += tmp;
-    }
-    return written;
+    PyObject *v = PyObject_GetAttrString(the_module, "min_memory");
+    Py_ssize_t r = PyInt_AsSsize_t(v);
+    Py_DECREF(v);
+    return (r > 0) ? (size_t) r : 0;
 }
 
 void _extract(const FastQSeq* s, const char* barcode_format, char extract,
@@ -130,6 +259,17 @@ void get_umi(const FastQSeq* s, const char* barcode_format, char* barcode)
     _extract(s,barcode_format,'N',barcode);
 }
 
+int get_barcode_length(const char* barcode_format)
+{
+    int l = 0, i;
+    for(i=0; i < strlen(barcode_format); i++)
+    {
+        if(barcode_format[i] == 'B')
+            l++;
+    }
+    return l;
+}
+
 int get_umi_length(const char* barcode_format)
 {
     int l = 0, i;
@@ -141,34 +281,65 @@ int get_umi_length(const char* barcode_format)
     return l;
 }
 
-long get_umi_long(const char* umi)
+void get_umi_code(const char* umi, unsigned long long *code,
+        unsigned long long *n_mask)
 {
-    int i;
-    long r = 0;
-    char c;
-    for(i = 0; i < strlen(umi); i++)
+    size_t i;
+    *code = 0ULL;
+    *n_mask = 0ULL;
+    for(i = 0; umi[i] != '\0'; i++)
     {
-        c = toupper(umi[i]);
-        r = r * 4;
-        switch(c)
+        *code <<= 2;
+        *n_mask <<= 1;
+        switch(toupper(umi[i]))
         {
             case 'A':
-                r += VAL_A;
+                *code += VAL_A;
                 break;
             case 'T':
-                r += VAL_T;
+                *code += VAL_T;
                 break;
             case 'C':
-                r += VAL_C;
+                *code += VAL_C;
                 break;
             case 'G':
-                r += VAL_G;
+                *code += VAL_G;
+                break;
+            default:
+                //Ns only match Ns, so they can't be mistaken for a base
+                *n_mask |= 1ULL;
                 break;
         }
     }
-    return r;
 }
 
+int encode_bases(const char* seq, size_t length, unsigned long long *code)
+{
+    size_t i;
+    *code = 0ULL;
+    for(i = 0; i < length; i++)
+    {
+        *code *= 4;
+        switch(toupper(seq[i]))
+        {
+            case 'A':
+                *code += VAL_A;
+                break;
+            case 'T':
+                *code += VAL_T;
+                break;
+            case 'C':
+                *code += VAL_C;
+                break;
+            case 'G':
+                *code += VAL_G;
+                break;
+            default:
+                return 0;
+        }
+    }
+    return 1;
+}
 
 void print_read_count(PyObject* count, long total, int indent)
 {
@@ -186,6 +357,31 @@ void print_read_count(PyObject* count, long total, int indent)
     }
 }
 
+int grow_dist(long **dist, size_t *size, size_t length)
+{
+    if(length >= *size)
+    {
+        size_t new_size = (*size > 0) ? *size : LENGTH_DIST;
+        while(new_size <= length)
+            new_size *= 2;
+        long *new_dist = realloc(*dist, new_size * sizeof(long));
+        if(new_dist == NULL)
+            return 0;
+        memset(new_dist + *size, 0, (new_size - *size) * sizeof(long));
+        *dist = new_dist;
+        *size = new_size;
+    }
+    return 1;
+}
+
+int add_length(long **dist, size_t *size, size_t length)
+{
+    if(!grow_dist(dist, size, length))
+        return 0;
+    (*dist)[length] += 1;
+    return 1;
+}
+
 void print_read_dist(long *dist, size_t length, int width, int indent)
 {
     //find max and start and end points
@@ -225,302 +421,890 @@ void print_read_dist(long *dist, size_t length, int width, int indent)
 // -------------------------- Structures --------------------------
 // ****************************************************************
 
-FastQSeq *FastQSeq_New(void)
+// -------------------------- FastQSeq
+
+int FastQSeq_Write(FastQSeq *s, gzFile f)
 {
-    FastQSeq *ret = malloc(sizeof(FastQSeq));
-    ret->name = NULL;
-    ret->seq = NULL;
-    ret->qual = NULL;
-    ret->low = ret->high = 0LL;
-    return ret;
+    //sequence and quality each on one line, which readers handle fastest
+    size_t name_length = strlen(s->name);
+    return gzputc(f, '@') >= 0 &&
+        gzwrite(f, s->name, name_length) == (int) name_length &&
+        gzputc(f, '\n') >= 0 &&
+        gzwrite(f, s->seq, s->length) == (int) s->length &&
+        gzwrite(f, "\n+\n", 3) == 3 &&
+        gzwrite(f, s->qual, s->length) == (int) s->length &&
+        gzputc(f, '\n') >= 0;
 }
 
-void FastQSeq_Free(FastQSeq *s)
+void FastQSeq_RemoveA(FastQSeq *self)
 {
-    if(s == NULL) return;
-    free(s->name);
-    free(s->seq);
-    free(s->qual);
-    s->name = NULL;
-    s->seq = NULL;
-    s->qual = NULL;
-    free(s);
+    size_t i = self->length;
+    while(i > 0 && toupper(self->seq[i-1]) == 'A')
+        i--;
+    self->seq[i] = '\0';
+    self->qual[i] = '\0';
+    self->length = i;
 }
 
-size_t FastQSeq_Read(FILE * f, FastQSeq **s)
+void FastQSeq_RemoveBarcode(FastQSeq *self, int barcode_length)
 {
-    if(feof(f)) {return 0;}
-    size_t read = 0, buffsize = 1024, pos, len;
-    char * buff = malloc(buffsize);
+    if(barcode_length < 0) return;
+    if(barcode_length > self->length) return;
 
-    //read the name - find the next line begining with @
-    buff[0] = '0'; //something that's not '@'
-    while(buff[0] != '@')
-    {
-        if(fgets(buff, buffsize, f) == NULL) {return 0;}
-        read += strlen(buff);
-    }
-    char* name = malloc(strlen(buff));
-    strcpy(name, buff+1); 
-    name[strlen(name)-1] = '\0';
+    //the strings may be views, so move the start rather than the data
+    self->seq += barcode_length;
+    self->qual += barcode_length;
+    self->length -= barcode_length;
+}
 
-    //read the seq
-    pos = 0;
-    buff[0] = '\n';
-    buff[1] = '\0';
-    while(buff[pos] != '+')
-    {
-        //rewind over the newline
-        pos = strlen(buff) - 1;
-        if(fgets(buff+pos, buffsize-pos, f) == NULL) {return 0;};
-    }
-    //clean off the '+'
-    buff[pos] = '\0';
-    len = strlen(buff);
-    read += len;
-    char *seq = malloc(len+1);
-    strcpy(seq, buff);
-
-    //read the quality
-    pos = 0;
-    while(pos < len)
+size_t FastQSeq_BitsWords(size_t length)
+{
+    return (length + 31) / 32 + (length + 63) / 64;
+}
+
+void FastQSeq_SetBits(FastQSeq *self, unsigned long long *bits)
+{
+    size_t pos, 
+           len = self->length,
+           packed = (len + 31) / 32;
+
+    memset(bits, 0, FastQSeq_BitsWords(len) * sizeof(unsigned long long));
+    self->bits = bits;
+    self->has_n = 0;
+    //space for the N mask is always there, but only compared if there are Ns
+    self->words = packed;
+    unsigned long long *nmask = self->bits + packed;
+
+    for(pos = 0; pos < len; pos++)
     {
-      if(fgets(buff+pos, buffsize-pos, f) == NULL) {return 0;}
-      //reverse over the \n
-      pos = strlen(buff) - 1;
+        unsigned long long v = VAL_A;
+        switch(toupper(self->seq[pos]))
+        {
+            case 'A':
+                v = VAL_A;
+                break;
+            case 'T':
+                v = VAL_T;
+                break;
+            case 'C':
+                v = VAL_C;
+                break;
+            case 'G':
+                v = VAL_G;
+                break;
+            default:
+                nmask[pos / 64] |= 1ULL << (pos % 64);
+                self->has_n = 1;
+                break;
+        }
+        self->bits[pos / 32] |= v << (2 * (pos % 32));
     }
-    //null-terminate
-    buff[len] = '\0';
-    read += pos;
-    char* qual = malloc(len+1);
-    strcpy(qual, buff);
 
-    free(buff);
+    if(self->has_n)
+        self->words = FastQSeq_BitsWords(len);
+}
 
-    //create the object
-    *s = FastQSeq_New();
-    (*s)->name = name;
-    (*s)->seq = seq;
-    (*s)->qual = qual;
-    return read;
+int FastQSeq_Equal(const FastQSeq *lhs, const FastQSeq *rhs)
+{
+    if(lhs->length != rhs->length || lhs->has_n != rhs->has_n)
+        return 0;
+    //words is equal given equal length and has_n
+    return memcmp(lhs->bits, rhs->bits, 
+            lhs->words * sizeof(unsigned long long)) == 0;
 }
 
-size_t FastQSeq_Write(FastQSeq *s, FILE *f)
+FastQSeq *FastQSeq_Copy(Arena *arena, const FastQSeq *src)
 {
-    size_t written = 0;
-    written += fprintf(f, "@%s\n", s->name);
-    written += write_lines(s->seq, 80, f);
-    written += fprintf(f, "+\n");
-    written += write_lines(s->qual, 80, f);
+    size_t name_len = strlen(src->name), 
+           len = src->length,
+           words = FastQSeq_BitsWords(len);
+
+    //one allocation holds the struct, packed sequence then the strings
+    FastQSeq *r = Arena_Alloc(arena, sizeof(FastQSeq) + 
+            words * sizeof(unsigned long long) + name_len + 2 * len + 3);
+    if(r == NULL) return NULL;
+
+    unsigned long long *bits = (unsigned long long *) (r + 1);
+    r->name = (char *) (bits + words);
+    r->seq = r->name + name_len + 1;
+    r->qual = r->seq + len + 1;
+    memcpy(r->name, src->name, name_len + 1);
+    memcpy(r->seq, src->seq, len);
+    memcpy(r->qual, src->qual, len);
+    r->seq[len] = '\0';
+    r->qual[len] = '\0';
+    r->length = len;
+
+    FastQSeq_SetBits(r, bits);
+    return r;
+}
+
+// -------------------------- Arena
+
+#define ARENA_ALIGN 8
 
-    return written;
+Arena *Arena_New(size_t block_size)
+{
+    Arena *r = malloc(sizeof(Arena));
+    if(r == NULL) return NULL;
+    r->head = r->spare = NULL;
+    r->block_size = block_size;
+    r->total = 0;
+    return r;
 }
 
-void FastQSeq_RemoveA(FastQSeq *self)
+void Arena_Free(Arena *self)
 {
-    int len = strlen(self->seq), i=0;
-    for(i = len-1; i >=0; i--)
-    {
-        if(toupper(self->seq[i]) != 'A')
-            break;
-    }
-    if(i < len-1)
+    if(self == NULL) return;
+    ArenaBlock *b;
+    while(self->head != NULL)
     {
-        self->seq[i+1] = '\0';
-        self->qual[i+1] = '\0';
+        b = self->head;
+        self->head = b->prev;
+        free(b);
     }
+    free(self->spare);
+    free(self);
 }
 
-void FastQSeq_RemoveBarcode(FastQSeq *self, int barcode_length)
+void *Arena_Alloc(Arena *self, size_t size)
 {
-    size_t len = strlen(self->seq);
-    if(barcode_length < 0) return;
-    if(barcode_length > len) return;
+    size = (size + ARENA_ALIGN - 1) & ~((size_t) ARENA_ALIGN - 1);
+    ArenaBlock *b = self->head;
 
-    int i;
-    for(i = 0; i < len - barcode_length; i++)
+    if(b == NULL || b->used + size > b->size)
     {
-        self->seq[i] = self->seq[i+barcode_length];
-        self->qual[i] = self->qual[i+barcode_length];
+        //reuse the block released by the last rewind if it's big enough
+        b = self->spare;
+        self->spare = NULL;
+        if(b != NULL && b->size < size)
+        {
+            self->total -= b->size;
+            free(b);
+            b = NULL;
+        }
+        if(b == NULL)
+        {
+            size_t bsize = (size > self->block_size) ? size : self->block_size;
+            b = malloc(sizeof(ArenaBlock) + bsize);
+            if(b == NULL) return NULL;
+            b->size = bsize;
+            self->total += bsize;
+        }
+        b->used = 0;
+        b->prev = self->head;
+        self->head = b;
     }
-    self->seq[i] = '\0';
-    self->qual[i]= '\0';
+
+    void *r = b->data + b->used;
+    b->used += size;
+    return r;
 }
 
-void FastQSeq_SetBits(FastQSeq *self)
+ArenaMark Arena_Mark(Arena *self)
 {
-    self->high = self->low = 0LL;
-    size_t pos, 
-           len = strlen(self->seq),
-           max_high = (len > 32L) ? 32L : len,
-           max_low  = (len > 64L) ? 64L : len;
-    max_low = (max_low < 32L) ? 0L : max_low - 32L;
+    ArenaMark m;
+    m.block = self->head;
+    m.used = (self->head == NULL) ? 0 : self->head->used;
+    return m;
+}
 
-    for(pos = 0; pos < max_high; pos++)
+void Arena_Rewind(Arena *self, ArenaMark mark)
+{
+    ArenaBlock *b;
+    while(self->head != mark.block)
     {
-        self->high *= 4LL;
-        switch(toupper(self->seq[pos]))
+        b = self->head;
+        self->head = b->prev;
+        if(self->spare == NULL)
         {
-            case 'A':
-                self->high += VAL_A;
-                break;
-            case 'T':
-                self->high += VAL_T;
-                break;
-            case 'C':
-                self->high += VAL_C;
-                break;
-            case 'G':
-                self->high += VAL_G;
-                break;
+            self->spare = b;
         }
-    }
-
-    for(pos = 0; pos < max_low; pos++)
-    {
-        self->low *= 4LL;
-        switch(toupper(self->seq[pos+32]))
+        else
         {
-            case 'A':
-                self->low += VAL_A;
-                break;
-            case 'T':
-                self->low += VAL_T;
-                break;
-            case 'C':
-                self->low += VAL_C;
-                break;
-            case 'G':
-                self->low += VAL_G;
-                break;
+            self->total -= b->size;
+            free(b);
         }
     }
+    if(self->head != NULL)
+        self->head->used = mark.used;
+}
 
+void Arena_Trim(Arena *self)
+{
+    if(self->spare == NULL) return;
+    self->total -= self->spare->size;
+    free(self->spare);
+    self->spare = NULL;
 }
 
-// -------------------------- SeqItem
+// -------------------------- FastQReader
 
+#define READER_BLOCK (1024 * 1024)
 
-SeqItem *SeqItem_New(FastQSeq *seq)
+FastQReader *FastQReader_New(gzFile f)
 {
-    SeqItem *r = malloc(sizeof(SeqItem));
-    r->the_seq = seq;
-    r->next = NULL;
-    r->prev = NULL;
+    FastQReader *r = malloc(sizeof(FastQReader));
+    if(r == NULL) return NULL;
+    //leave room to terminate a final line with no newline
+    r->buffer = malloc(READER_BLOCK + 1);
+    if(r->buffer == NULL)
+    {
+        free(r);
+        return NULL;
+    }
+    r->f = f;
+    r->size = READER_BLOCK;
+    r->start = r->end = 0;
+    r->eof = 0;
     return r;
 }
 
-void SeqItem_Free(SeqItem *self)
+void FastQReader_Free(FastQReader *self)
 {
     if(self == NULL) return;
-    FastQSeq_Free(self->the_seq);
-    SeqItem_Free(self->next);
+    free(self->buffer);
     free(self);
-    return;
 }
 
-void SeqItem_Append(SeqItem* self, SeqItem* rhs)
+//move the unparsed data to the start of the buffer and read the next block.
+// Returns 1 if there is new data, 0 at the end of the file or -1 on error
+int FastQReader_Fill(FastQReader *self)
 {
-    //links with self->next
-    rhs->next = self->next;
-    if(rhs->next != NULL)
+    if(self->eof) return 0;
+
+    size_t remaining = self->end - self->start;
+    if(self->start > 0)
+    {
+        memmove(self->buffer, self->buffer + self->start, remaining);
+        self->start = 0;
+        self->end = remaining;
+    }
+    //a single record is bigger than the buffer
+    if(self->end == self->size)
+    {
+        char *b = realloc(self->buffer, 2 * self->size + 1);
+        if(b == NULL) return -1;
+        self->buffer = b;
+        self->size *= 2;
+    }
+
+    int n = gzread(self->f, self->buffer + self->end, 
+            (unsigned int) (self->size - self->end));
+    if(n < 0) return -1;
+    if(n == 0)
     {
-        rhs->next->prev = rhs;
+        self->eof = 1;
+        //terminate the last line
+        if(self->end > self->start && self->buffer[self->end-1] != '\n')
+        {
+            self->buffer[self->end++] = '\n';
+            return 1;
+        }
+        return 0;
     }
-    //links with self
-    rhs->prev = self;
-    self->next = rhs;
+    self->end += n;
+    return 1;
 }
 
-void SeqItem_Prepend(SeqItem **head, SeqItem* self, SeqItem* rhs)
+//remove the newlines from buffer[from:to] in place and NUL terminate after 
+// length characters
+void join_lines(char *buffer, size_t from, size_t to, size_t length)
 {
-    //links with self->prev
-    rhs->prev = self->prev;
-    if(self->prev != NULL)
+    char *nl = memchr(buffer + from, '\n', to - from);
+    size_t src = from, dst = from;
+    //single line, nothing to move
+    if(nl == NULL || (nl - buffer) >= from + length)
     {
-        self->prev->next = rhs;
+        buffer[from + length] = '\0';
+        return;
     }
-    else
+    while(src < to && dst < from + length)
     {
-        //we replaced head
-        (*head) = rhs;
+        if(buffer[src] != '\n')
+            buffer[dst++] = buffer[src];
+        src++;
     }
-    //links with self
-    rhs->next = self;
-    self->prev = rhs;
+    buffer[from + length] = '\0';
 }
 
-int SeqItem_Next(SeqItem **next)
+//parse a record at self->start. Returns 0 if the record is not yet wholly in
+// the buffer, in which case the buffer is left unchanged
+int FastQReader_Parse(FastQReader *self, FastQSeq *seq)
 {
-    if((*next) == NULL) return 0;
-    if((*next)->next == NULL)
-        return 0;
-    (*next) = (*next)->next;
+    char *buf = self->buffer, *nl;
+    size_t pos = self->start, end = self->end;
+
+    //skip to the next line begining with @
+    while(pos < end && buf[pos] != '@')
+    {
+        nl = memchr(buf + pos, '\n', end - pos);
+        if(nl == NULL) break;
+        pos = nl - buf + 1;
+    }
+    self->start = pos;
+    if(pos >= end || buf[pos] != '@') return 0;
+
+    //name
+    size_t name = pos + 1, name_end;
+    nl = memchr(buf + pos, '\n', end - pos);
+    if(nl == NULL) return 0;
+    name_end = nl - buf;
+    pos = name_end + 1;
+
+    //sequence lines until the '+' line
+    size_t seq_start = pos, len = 0;
+    while(pos >= end || buf[pos] != '+')
+    {
+        if(pos >= end) return 0;
+        nl = memchr(buf + pos, '\n', end - pos);
+        if(nl == NULL) return 0;
+        len += (nl - buf) - pos;
+        pos = nl - buf + 1;
+    }
+    size_t seq_end = pos;
+    nl = memchr(buf + pos, '\n', end - pos);
+    if(nl == NULL) return 0;
+    pos = nl - buf + 1;
+
+    //quality lines until there are as many as bases
+    size_t qual_start = pos, qlen = 0;
+    while(qlen < len)
+    {
+        if(pos >= end) return 0;
+        nl = memchr(buf + pos, '\n', end - pos);
+        if(nl == NULL) return 0;
+        qlen += (nl - buf) - pos;
+        pos = nl - buf + 1;
+    }
+
+    //the whole record is here, terminate the strings in place
+    self->start = pos;
+    buf[name_end] = '\0';
+    join_lines(buf, seq_start, seq_end, len);
+    join_lines(buf, qual_start, pos, len);
+
+    seq->name = buf + name;
+    seq->seq = buf + seq_start;
+    seq->qual = buf + qual_start;
+    seq->length = len;
+    seq->bits = NULL;
+    seq->words = 0;
+    seq->has_n = 0;
     return 1;
 }
 
-size_t SeqItem_Length(SeqItem *s)
+int FastQReader_Next(FastQReader *self, FastQSeq *seq)
 {
-    if(s == NULL) return 0;
-    size_t r = 1;
-    while(SeqItem_Next(&s))
-        r++;
-    return r;
+    int r;
+    while(1)
+    {
+        if(FastQReader_Parse(self, seq)) return 1;
+        r = FastQReader_Fill(self);
+        if(r <= 0) return r;
+    }
 }
 
-// ****************************************************************
-// -------------------------- Module Functions --------------------
-// ****************************************************************
+// -------------------------- BarcodeTable
 
+unsigned long long mix_hash(unsigned long long h)
+{
+    //finaliser from splitmix64
+    h ^= h >> 30;
+    h *= 0xbf58476d1ce4e5b9ULL;
+    h ^= h >> 27;
+    h *= 0x94d049bb133111ebULL;
+    h ^= h >> 31;
+    return h;
+}
 
-PyObject* split_by_barcode(PyObject *self, PyObject *args)
+//find the slot for code
+size_t BarcodeTable_Slot(const BarcodeTable *self, unsigned long long code)
 {
-    if(is_verbose())
+    if(self->direct) return (size_t) code;
+
+    size_t mask = self->capacity - 1, i = mix_hash(code) & mask;
+    while(self->values[i] != BARCODE_NONE && self->keys[i] != code)
+        i = (i + 1) & mask;
+    return i;
+}
+
+BarcodeTable *BarcodeTable_New(const char **barcodes, int num_barcodes,
+        size_t length, int mismatches)
+{
+    int i, v;
+    size_t j, k, slot, neighbours = 1 + (mismatches ? 3 * length : 0);
+    unsigned long long codes[num_barcodes], code, base;
+
+    BarcodeTable *r = malloc(sizeof(BarcodeTable));
+    if(r == NULL) return NULL;
+    r->length = length;
+    r->direct = (length <= BARCODE_DIRECT_MAX);
+    r->keys = NULL;
+    if(r->direct)
     {
-        printf("Splitting Sequence by Barcode\n");
+        r->capacity = 1ULL << (2 * length);
     }
-    const char* in_file = NULL, * out_dir = NULL;
-    PyObject* my_settings = NULL, * files, * barcodes, * count;
-    int remove_input = 0;
-    int ok = PyArg_ParseTuple(args, "sOs|i", &in_file, &my_settings, &out_dir,
-            &remove_input);
-    if(!ok){
+    else
+    {
+        //keep the load factor below one quarter
+        r->capacity = 64;
+        while(r->capacity < 4 * num_barcodes * neighbours)
+            r->capacity *= 2;
+        r->keys = malloc(r->capacity * sizeof(unsigned long long));
+    }
+    r->values = malloc(r->capacity * sizeof(int));
+    if(r->values == NULL || (!r->direct && r->keys == NULL))
+    {
+        BarcodeTable_Free(r);
         return NULL;
     }
+    for(j = 0; j < r->capacity; j++)
+        r->values[j] = BARCODE_NONE;
 
-    if(is_verbose())
+    //exact matches, the first sample wins if a barcode is given twice
+    for(i = 0; i < num_barcodes; i++)
     {
-        printf("Reading from \"%s\"\n", in_file);
+        if(!encode_bases(barcodes[i], length, codes + i))
+        {
+            PyErr_Format(PyExc_ValueError, "Invalid barcode \"%s\"", 
+                    barcodes[i]);
+            BarcodeTable_Free(r);
+            return NULL;
+        }
+        slot = BarcodeTable_Slot(r, codes[i]);
+        if(r->values[slot] == BARCODE_NONE)
+        {
+            if(!r->direct) r->keys[slot] = codes[i];
+            r->values[slot] = i;
+        }
     }
 
-    
-    //get sample names & barcodes
-    int num_samples = 0;
-    barcodes = PyObject_GetAttrString(my_settings, "barcodes");
-    if (barcodes == NULL){ return NULL; }
-    if (!PyDict_Check(barcodes)){
-        PyErr_SetString(PyExc_TypeError, "settings.barcodes must be a dict");
-        return NULL;
-    }
-    num_samples = PyDict_Size(barcodes);
+    if(!mismatches) return r;
 
-    if(is_verbose())
+    //every sequence one substitution away from a barcode, unless it's nearer
+    // to another barcode or equally near to two
+    for(i = 0; i < num_barcodes; i++)
     {
-        printf("Processing \"%d\" samples\n", num_samples);
+        for(j = 0; j < length; j++)
+        {
+            base = (codes[i] >> (2 * j)) & 3ULL;
+            for(k = 0; k < 4; k++)
+            {
+                if(k == base) continue;
+                code = (codes[i] & ~(3ULL << (2 * j))) | (k << (2 * j));
+                slot = BarcodeTable_Slot(r, code);
+                v = r->values[slot];
+                if(v == BARCODE_NONE)
+                {
+                    if(!r->direct) r->keys[slot] = code;
+                    r->values[slot] = i;
+                }
+                else if(v >= 0 && v != i && codes[v] != code)
+                {
+                    r->values[slot] = BARCODE_AMBIGUOUS;
+                }
+            }
+        }
     }
 
-    //get barcode format
-    PyObject *bfmt = PyObject_GetAttrString(my_settings, "barcode_format");
-    if(bfmt == NULL) return NULL;
-    const char* barcode_format = PyString_AsString(bfmt);
-    Py_DECREF(bfmt);
-
+    return r;
+}
 
-    //open output files
-    files = PyDict_New();
+void BarcodeTable_Free(BarcodeTable *self)
+{
+    if(self == NULL) return;
+    free(self->keys);
+    free(self->values);
+    free(self);
+}
+
+int BarcodeTable_Lookup(const BarcodeTable *self, const char *barcode)
+{
+    unsigned long long code;
+    if(!encode_bases(barcode, self->length, &code)) return BARCODE_NONE;
+
+    int v = self->values[BarcodeTable_Slot(self, code)];
+    return (v < 0) ? BARCODE_NONE : v;
+}
+
+// -------------------------- SeqSet
+
+#define SEQSET_MIN_CAPACITY 1024
+
+unsigned long long FastQSeq_Hash(const FastQSeq *self)
+{
+    size_t i;
+    unsigned long long h = mix_hash(self->length);
+    for(i = 0; i < self->words; i++)
+        h = mix_hash(h ^ self->bits[i]);
+    return h;
+}
+
+unsigned long long SeqSet_Hash(unsigned long long umi, unsigned long long umi_n,
+        const FastQSeq *seq)
+{
+    return mix_hash(mix_hash(FastQSeq_Hash(seq) ^ umi) ^ umi_n);
+}
+
+SeqSet *SeqSet_New(size_t size_hint)
+{
+    //keep the load factor below one half
+    size_t capacity = SEQSET_MIN_CAPACITY;
+    while(capacity < 2 * size_hint)
+        capacity *= 2;
+
+    SeqSet *r = malloc(sizeof(SeqSet));
+    if(r == NULL) return NULL;
+    r->entries = calloc(capacity, sizeof(SeqSetEntry));
+    if(r->entries == NULL)
+    {
+        free(r);
+        return NULL;
+    }
+    r->size = 0;
+    r->capacity = capacity;
+    return r;
+}
+
+void SeqSet_Free(SeqSet *self)
+{
+    if(self == NULL) return;
+    free(self->entries);
+    free(self);
+}
+
+int SeqSet_Grow(SeqSet *self)
+{
+    size_t i, j, mask, capacity = self->capacity * 2;
+    SeqSetEntry *entries = calloc(capacity, sizeof(SeqSetEntry));
+    if(entries == NULL) return 0;
+
+    mask = capacity - 1;
+    for(i = 0; i < self->capacity; i++)
+    {
+        if(self->entries[i].seq == NULL) continue;
+        j = self->entries[i].hash & mask;
+        while(entries[j].seq != NULL)
+            j = (j + 1) & mask;
+        entries[j] = self->entries[i];
+    }
+
+    free(self->entries);
+    self->entries = entries;
+    self->capacity = capacity;
+    return 1;
+}
+
+SeqSetEntry *SeqSet_Insert(SeqSet *self, unsigned long long umi, 
+        unsigned long long umi_n, FastQSeq *seq, int *added)
+{
+    *added = 0;
+    if(2 * (self->size + 1) > self->capacity)
+    {
+        if(!SeqSet_Grow(self)) return NULL;
+    }
+
+    unsigned long long hash = SeqSet_Hash(umi, umi_n, seq);
+    size_t mask = self->capacity - 1, i = hash & mask;
+    SeqSetEntry *e;
+
+    //linear probe until we find the read or an empty slot
+    while(self->entries[i].seq != NULL)
+    {
+        e = self->entries + i;
+        if(e->hash == hash && 
+                e->umi == umi &&
+                e->umi_n == umi_n &&
+                FastQSeq_Equal(e->seq, seq))
+        {
+            return e;
+        }
+        i = (i + 1) & mask;
+    }
+
+    e = self->entries + i;
+    e->hash = hash;
+    e->umi = umi;
+    e->umi_n = umi_n;
+    e->seq = seq;
+    self->size += 1;
+    *added = 1;
+    return e;
+}
+
+int SeqSet_Add(SeqSet *self, unsigned long long umi, unsigned long long umi_n,
+        FastQSeq *seq)
+{
+    int added;
+    if(SeqSet_Insert(self, umi, umi_n, seq, &added) == NULL) return -1;
+    return added;
+}
+
+FastQSeq *SeqSet_Next(SeqSet *self, size_t *pos)
+{
+    while(*pos < self->capacity)
+    {
+        FastQSeq *r = self->entries[*pos].seq;
+        *pos += 1;
+        if(r != NULL) return r;
+    }
+    return NULL;
+}
+
+void SeqSet_Clear(SeqSet *self)
+{
+    memset(self->entries, 0, self->capacity * sizeof(SeqSetEntry));
+    self->size = 0;
+}
+
+int SeqSet_Shrink(SeqSet *self)
+{
+    self->size = 0;
+    if(self->capacity <= SEQSET_MIN_CAPACITY)
+    {
+        SeqSet_Clear(self);
+        return 1;
+    }
+    SeqSetEntry *entries = calloc(SEQSET_MIN_CAPACITY, sizeof(SeqSetEntry));
+    if(entries == NULL)
+    {
+        SeqSet_Clear(self);
+        return 0;
+    }
+    free(self->entries);
+    self->entries = entries;
+    self->capacity = SEQSET_MIN_CAPACITY;
+    return 1;
+}
+
+int SeqKey_Compare(unsigned long long lumi, unsigned long long lumi_n,
+        const FastQSeq *lhs, unsigned long long rumi, unsigned long long rumi_n,
+        const FastQSeq *rhs)
+{
+    size_t i;
+    if(lumi != rumi) 
+        return (lumi < rumi) ? -1 : 1;
+    if(lumi_n != rumi_n) 
+        return (lumi_n < rumi_n) ? -1 : 1;
+    if(lhs->length != rhs->length) 
+        return (lhs->length < rhs->length) ? -1 : 1;
+    if(lhs->has_n != rhs->has_n) 
+        return (lhs->has_n < rhs->has_n) ? -1 : 1;
+    //words is equal given equal length and has_n
+    for(i = 0; i < lhs->words; i++)
+    {
+        if(lhs->bits[i] != rhs->bits[i])
+            return (lhs->bits[i] < rhs->bits[i]) ? -1 : 1;
+    }
+    return 0;
+}
+
+int SeqSetEntry_Compare(const void *lhs, const void *rhs)
+{
+    const SeqSetEntry *l = lhs, *r = rhs;
+    return SeqKey_Compare(l->umi, l->umi_n, l->seq, r->umi, r->umi_n, r->seq);
+}
+
+int SeqSet_Spill(SeqSet *self, FILE *f)
+{
+    size_t i, n = 0;
+    int ok = 1;
+
+    //move the reads to the start of the table and sort them there
+    for(i = 0; i < self->capacity; i++)
+    {
+        if(self->entries[i].seq != NULL)
+            self->entries[n++] = self->entries[i];
+    }
+    qsort(self->entries, n, sizeof(SeqSetEntry), SeqSetEntry_Compare);
+
+    for(i = 0; i < n && ok; i++)
+    {
+        ok = Run_Write(f, self->entries[i].umi, self->entries[i].umi_n,
+                self->entries[i].seq);
+    }
+
+    SeqSet_Clear(self);
+    return ok;
+}
+
+// -------------------------- Runs
+
+//each read in a run is a RunHeader followed by its name, sequence and quality
+typedef struct {
+    unsigned long long umi, umi_n;
+    size_t name_length, length;
+} RunHeader;
+
+int Run_Write(FILE *f, unsigned long long umi, unsigned long long umi_n,
+        const FastQSeq *seq)
+{
+    RunHeader h;
+    h.umi = umi;
+    h.umi_n = umi_n;
+    h.name_length = strlen(seq->name);
+    h.length = seq->length;
+    return fwrite(&h, sizeof(RunHeader), 1, f) == 1 &&
+        fwrite(seq->name, 1, h.name_length, f) == h.name_length &&
+        fwrite(seq->seq, 1, h.length, f) == h.length &&
+        fwrite(seq->qual, 1, h.length, f) == h.length;
+}
+
+int RunReader_Next(RunReader *self)
+{
+    RunHeader h;
+    if(fread(&h, sizeof(RunHeader), 1, self->f) != 1)
+        return ferror(self->f) ? -1 : 0;
+
+    //grow the buffers to fit
+    size_t size = h.name_length + 2 * h.length + 3,
+           words = FastQSeq_BitsWords(h.length);
+    if(size > self->buffer_size)
+    {
+        char *buffer = realloc(self->buffer, size);
+        if(buffer == NULL) return -1;
+        self->buffer = buffer;
+        self->buffer_size = size;
+    }
+    if(words > self->bits_size)
+    {
+        unsigned long long *bits = realloc(self->bits, 
+                words * sizeof(unsigned long long));
+        if(bits == NULL) return -1;
+        self->bits = bits;
+        self->bits_size = words;
+    }
+
+    FastQSeq *s = &self->seq;
+    s->name = self->buffer;
+    s->seq = s->name + h.name_length + 1;
+    s->qual = s->seq + h.length + 1;
+    s->length = h.length;
+    if(fread(s->name, 1, h.name_length, self->f) != h.name_length ||
+            fread(s->seq, 1, h.length, self->f) != h.length ||
+            fread(s->qual, 1, h.length, self->f) != h.length)
+    {
+        return -1;
+    }
+    s->name[h.name_length] = '\0';
+    s->seq[h.length] = '\0';
+    s->qual[h.length] = '\0';
+    FastQSeq_SetBits(s, self->bits);
+
+    self->umi = h.umi;
+    self->umi_n = h.umi_n;
+    return 1;
+}
+
+void RunReader_Close(RunReader *self)
+{
+    if(self->f != NULL)
+        fclose(self->f);
+    free(self->buffer);
+    free(self->bits);
+    memset(self, 0, sizeof(RunReader));
+}
+
+//order runs by their current read, then by when they were written
+int RunReader_Compare(const RunReader *lhs, const RunReader *rhs)
+{
+    int c = SeqKey_Compare(lhs->umi, lhs->umi_n, &lhs->seq, 
+            rhs->umi, rhs->umi_n, &rhs->seq);
+    if(c != 0) return c;
+    return lhs->index - rhs->index;
+}
+
+void RunHeap_Down(RunReader **heap, int size, int i)
+{
+    int child;
+    RunReader *r = heap[i];
+    while((child = 2 * i + 1) < size)
+    {
+        if(child + 1 < size && RunReader_Compare(heap[child + 1], heap[child]) < 0)
+            child++;
+        if(RunReader_Compare(r, heap[child]) <= 0)
+            break;
+        heap[i] = heap[child];
+        i = child;
+    }
+    heap[i] = r;
+}
+
+// ****************************************************************
+// -------------------------- Module Functions --------------------
+// ****************************************************************
+
+
+//get the number of mismatches allowed in a barcode from my_settings, 0 if it
+// isn't set. Returns 0 with an exception set on error
+int get_mismatches(PyObject *my_settings, int *mismatches)
+{
+    *mismatches = 0;
+    if(PyObject_HasAttrString(my_settings, "barcode_mismatches"))
+    {
+        PyObject *pmis = PyObject_GetAttrString(my_settings, 
+                "barcode_mismatches");
+        if(pmis == NULL) return 0;
+        *mismatches = (int) PyInt_AsLong(pmis);
+        Py_DECREF(pmis);
+        if(PyErr_Occurred()) return 0;
+    }
+    return 1;
+}
+
+PyObject* split_by_barcode(PyObject *self, PyObject *args)
+{
+    if(is_verbose())
+    {
+        printf("Splitting Sequence by Barcode\n");
+    }
+    const char* in_file = NULL, * out_dir = NULL;
+    PyObject* my_settings = NULL, * files, * barcodes, * count;
+    int remove_input = 0, compress = 0;
+    int ok = PyArg_ParseTuple(args, "sOs|ii", &in_file, &my_settings, &out_dir,
+            &remove_input, &compress);
+    if(!ok || !check_level(compress)){
+        return NULL;
+    }
+
+    if(is_verbose())
+    {
+        printf("Reading from \"%s\"\n", in_file);
+    }
+
+    
+    //get sample names & barcodes
+    int num_samples = 0;
+    barcodes = PyObject_GetAttrString(my_settings, "barcodes");
+    if (barcodes == NULL){ return NULL; }
+    if (!PyDict_Check(barcodes)){
+        PyErr_SetString(PyExc_TypeError, "settings.barcodes must be a dict");
+        return NULL;
+    }
+    num_samples = PyDict_Size(barcodes);
+
+    if(is_verbose())
+    {
+        printf("Processing \"%d\" samples\n", num_samples);
+    }
+
+    //get barcode format
+    PyObject *bfmt = PyObject_GetAttrString(my_settings, "barcode_format");
+    if(bfmt == NULL) return NULL;
+    const char* barcode_format = PyString_AsString(bfmt);
+    Py_DECREF(bfmt);
+
+    //get the number of mismatches allowed in the barcode
+    int mismatches = 0;
+    if(!get_mismatches(my_settings, &mismatches)) return NULL;
+
+
+    //open output files
+    files = PyDict_New();
     const char* barcode_seqs[num_samples];
     PyObject* sample_names[num_samples];
-    FILE *open_files[num_samples];
+    gzFile open_files[num_samples];
     Py_ssize_t pos = 0;
     int i = 0;
     PyObject *isample, *ibarcode;
@@ -539,9 +1323,9 @@ PyObject* split_by_barcode(PyObject *self, PyObject *args)
         const char* ssample = PyString_AsString(isample);
         char sample_dot[strlen(ssample) + 2];
         sprintf(sample_dot, "%s.", ssample);
-        open_files[i] = tempfile_mkstemp3(out_dir, sample_dot, ".barcode", 
-                &filename);
-        if(open_files[i] <= 0)
+        open_files[i] = tempfile_reads(out_dir, sample_dot, ".barcode", 
+                compress, &filename);
+        if(open_files[i] == NULL)
         {
             Py_DECREF(barcodes);
             Py_DECREF(files);
@@ -555,446 +1339,1474 @@ PyObject* split_by_barcode(PyObject *self, PyObject *args)
 
         i = i + 1;
     }
-    Py_DECREF(barcodes);
-
-    //open input file
-    FILE *in = fopen(in_file, "rb");
-    if(in == NULL)
+    Py_DECREF(barcodes);
+
+    //build the barcode lookup table
+    char barcode[strlen(barcode_format)+1];
+    BarcodeTable *table = BarcodeTable_New(barcode_seqs, num_samples,
+            get_barcode_length(barcode_format), mismatches);
+    if(table == NULL)
+    {
+        if(!PyErr_Occurred()) PyErr_NoMemory();
+        Py_DECREF(files);
+        return NULL;
+    }
+
+    //open input file
+    char error[ERROR_SIZE];
+    gzFile in = open_reads(in_file, error);
+    if(in == NULL)
+    {
+        PyErr_SetString(PyExc_IOError, error);
+        BarcodeTable_Free(table);
+        Py_DECREF(files);
+        return NULL;
+    }
+
+    FastQReader *reader = FastQReader_New(in);
+    if(reader == NULL)
+    {
+        BarcodeTable_Free(table);
+        gzclose(in);
+        Py_DECREF(files);
+        return PyErr_NoMemory();
+    }
+
+    //for each seq
+    FastQSeq seq;
+    long total = 0;
+    long ccount[num_samples];
+    for(i=0; i<num_samples; i++)
+        ccount[i] = 0L;
+
+    while((ok = FastQReader_Next(reader, &seq)) > 0)
+    {
+        //extract barcode
+        //write it to the correct file
+
+        get_barcode(&seq, barcode_format, barcode);
+
+        i = BarcodeTable_Lookup(table, barcode);
+        if(i >= 0)
+        {
+            if(!FastQSeq_Write(&seq, open_files[i]))
+            {
+                ok = -2;
+                break;
+            }
+            ccount[i] += 1;
+            total += 1;
+        }
+    }
+    FastQReader_Free(reader);
+    BarcodeTable_Free(table);
+    //close files and fill in count and filename
+    count = PyDict_New();
+    const char *failed = NULL;
+    for(i=0; i < num_samples; i++)
+    {
+        PyObject *f = PyDict_GetItem(files, sample_names[i]);
+        if(gzclose(open_files[i]) != Z_OK || ok == -2)
+            failed = PyString_AsString(f);
+        PyObject *c = PyInt_FromLong(ccount[i]);
+        PyDict_SetItem(count, sample_names[i], c);
+        
+        PyObject *t = PyTuple_Pack(2, f, c);
+        PyDict_SetItem(files, sample_names[i], t);
+
+        Py_DECREF(t);
+        Py_DECREF(c);
+        Py_DECREF(sample_names[i]);
+    }
+    //check for error
+    if(failed != NULL && ok != -1)
+        snprintf(error, ERROR_SIZE, "Error writing to file \"%s\"", failed);
+    if(!close_reads(in, in_file, error) || ok < 0 || failed != NULL)
+    {
+        if(ok == -1) 
+            PyErr_NoMemory();
+        else
+            PyErr_SetString(PyExc_IOError, error);
+        Py_DECREF(count);
+        Py_DECREF(files);
+        return NULL;
+    }
+
+    if(is_verbose())
+    {
+        printf("Found %ld reads:-\n", total);
+        print_read_count(count, total, 1);
+    }
+
+    //store statistics
+    if(!stats_addvalues("split_by_barcode",count))
+    {
+        Py_DECREF(count);
+        Py_DECREF(files);
+        return NULL;
+    }
+    Py_DECREF(count);
+
+    //delete input file if requested
+    if(remove_input)
+    {
+        if(remove(in_file))
+        {
+            char e[64+strlen(in_file)];
+            sprintf(e, "Could not remove input file \"%s\"", in_file);
+            PyErr_SetString(PyExc_IOError, e);
+            return NULL;
+        }
+    }
+
+    return files;
+}
+
+int dedup_sample(DedupJob *job)
+{
+    int ok = 0;
+
+    if(job->verbose)
+    {
+        printf("Sample \"%s\"\n", job->sample);
+        printf("\tReading from \"%s\"\n", job->in_name);
+    }
+
+    //open input file
+    gzFile in = open_reads(job->in_name, job->message);
+    if(in == NULL)
+    {
+        job->error = JOB_IO_ERROR;
+        return 0;
+    }
+
+    FastQReader *reader = FastQReader_New(in);
+    if(reader == NULL || !dedup_open(job, job->max_memory))
+    {
+        FastQReader_Free(reader);
+        gzclose(in);
+        job->error = JOB_MEMORY_ERROR;
+        return 0;
+    }
+
+    //load in all seqs
+    FastQSeq view;
+    long count = 0;
+    while((ok = FastQReader_Next(reader, &view)) > 0)
+    {
+        count += 1;
+        if(job->verbose && count % 1000 == 0)
+        {
+            printf("\rReading %ld/%ld (%3.1f%%)         ", 
+                count, job->length,
+                100.0 * (float)((double)count / (double)job->length));
+            fflush(stdout);
+        }
+        if(!dedup_add(job, &view))
+        {
+            ok = -1;
+            break;
+        }
+    }
+    FastQReader_Free(reader);
+    //check for error and close input
+    if(!close_reads(in, job->in_name, job->message) || ok < 0)
+    {
+        if(!job->error)
+            job->error = (ok < 0) ? JOB_MEMORY_ERROR : JOB_IO_ERROR;
+        dedup_free(job);
+        return 0;
+    }
+
+    if(!dedup_write(job))
+        return 0;
+
+    //delete input
+    if(job->remove_input)
+    {
+        if(remove(job->in_name))
+        {
+            snprintf(job->message, ERROR_SIZE, "Failed to remove file \"%s\"", 
+                    job->in_name);
+            job->error = JOB_IO_ERROR;
+            return 0;
+        }
+    }
+    return 1;
+}
+
+int dedup_open(DedupJob *job, size_t budget)
+{
+    //leave room for the reads when memory is limited, and take it for them in
+    // blocks small enough that a whole one doesn't overshoot the budget much
+    size_t hint = job->length, block = ARENA_BLOCK;
+    if(budget > 0 && hint > budget / (8 * sizeof(SeqSetEntry)))
+        hint = budget / (8 * sizeof(SeqSetEntry));
+    if(budget > 0 && block > budget / 8)
+        block = (budget / 8 > ARENA_MIN_BLOCK) ? budget / 8 : ARENA_MIN_BLOCK;
+    job->barcode_length = strlen(job->barcode_format);
+    job->unique = SeqSet_New(hint);
+    job->arena = Arena_New(block);
+    if(job->unique == NULL || job->arena == NULL)
+    {
+        dedup_free(job);
+        job->error = JOB_MEMORY_ERROR;
+        return 0;
+    }
+    return 1;
+}
+
+int dedup_add(DedupJob *job, FastQSeq *view)
+{
+    char umi[MAX_UMI_LENGTH + 1];
+    unsigned long long umi_code, umi_n;
+
+    FastQSeq_RemoveA(view);
+    if(view->length < job->barcode_length + MIN_LENGTH)
+    {
+        return 1;
+    }
+    get_umi(view, job->barcode_format, umi);
+    //Trim the barcode
+    FastQSeq_RemoveBarcode(view, job->barcode_length);
+
+    //copy and pack the read, and keep it only if we haven't seen it
+    // with the same UMI
+    ArenaMark mark = Arena_Mark(job->arena);
+    FastQSeq *seq = FastQSeq_Copy(job->arena, view);
+    get_umi_code(umi, &umi_code, &umi_n);
+    int ok = (seq == NULL) ? -1 : SeqSet_Add(job->unique, umi_code, umi_n, seq);
+    if(ok < 0)
+    {
+        job->error = JOB_MEMORY_ERROR;
+        return 0;
+    }
+    if(ok == 0)
+    {
+        Arena_Rewind(job->arena, mark);
+    }
+    else if(job->max_memory > 0 && dedup_held(job) > job->max_memory)
+    {
+        return dedup_spill(job);
+    }
+    return 1;
+}
+
+size_t dedup_held(const DedupJob *job)
+{
+    return job->arena->total + job->unique->capacity * sizeof(SeqSetEntry);
+}
+
+int dedup_write(DedupJob *job)
+{
+    FastQSeq *seq;
+    int ok = 1;
+
+    if(job->verbose)
+    {
+        printf("\r                                                       \r");
+        printf("\t\tWriting to \"%s\"\n", job->out_name);
+    }
+
+    if(job->num_runs > 0)
+    {
+        //the reads left in memory are the last run, then merge them all
+        ok = dedup_spill(job) && dedup_merge(job, NULL);
+    }
+    else
+    {
+        //save each item
+        size_t it = 0;
+        while((seq = SeqSet_Next(job->unique, &it)) != NULL)
+        {
+            //write
+            if(!FastQSeq_Write(seq, job->out))
+            {
+                ok = 0;
+                break;
+            }
+
+            //statistics
+            if(!add_length(&job->length_dist, &job->dist_size, seq->length))
+            {
+                ok = 0;
+                job->error = JOB_MEMORY_ERROR;
+                break;
+            }
+            job->count += 1;
+        }
+    }
+    dedup_free(job);
+    //close output
+    int closed = (gzclose(job->out) == Z_OK);
+    job->out = NULL;
+    if(!ok || !closed)
+    {
+        if(!job->error)
+        {
+            snprintf(job->message, ERROR_SIZE, "Error writing to file \"%s\"", 
+                    job->out_name);
+            job->error = JOB_IO_ERROR;
+        }
+        return 0;
+    }
+
+    if(job->verbose)
+    {
+        printf("\t\tWritten %ld reads\n", job->count);
+    }
+    return 1;
+}
+
+void dedup_free(DedupJob *job)
+{
+    SeqSet_Free(job->unique);
+    job->unique = NULL;
+    Arena_Free(job->arena);
+    job->arena = NULL;
+    dedup_close_runs(job);
+}
+
+//open an anonymous file in the job's scratch directory for a run
+FILE *dedup_run_file(DedupJob *job)
+{
+    char name[strlen(job->scratch_dir) + 32];
+    sprintf(name, "%s/waistcoat.run.XXXXXX", job->scratch_dir);
+    int fd = mkstemp(name);
+    FILE *f = NULL;
+    if(fd >= 0)
+    {
+        //the file is removed as soon as it's closed
+        unlink(name);
+        f = fdopen(fd, "w+b");
+        if(f == NULL)
+            close(fd);
+    }
+    if(f == NULL)
+    {
+        snprintf(job->message, ERROR_SIZE, 
+                "Failed to create a temporary file in \"%s\"", job->scratch_dir);
+        job->error = JOB_IO_ERROR;
+        return NULL;
+    }
+    setvbuf(f, NULL, _IOFBF, RUN_BUFFER);
+    return f;
+}
+
+int dedup_spill(DedupJob *job)
+{
+    if(job->runs == NULL)
+    {
+        job->runs = calloc(MAX_RUNS, sizeof(RunReader));
+        if(job->runs == NULL)
+        {
+            job->error = JOB_MEMORY_ERROR;
+            return 0;
+        }
+    }
+
+    //write the run and free the reads in it
+    FILE *f = dedup_run_file(job);
+    if(f == NULL) return 0;
+    RunReader *run = job->runs + job->num_runs;
+    run->f = f;
+    run->index = job->num_runs++;
+    if(!SeqSet_Spill(job->unique, f) || fflush(f))
+    {
+        snprintf(job->message, ERROR_SIZE, "Error writing to a temporary file "
+                "in \"%s\"", job->scratch_dir);
+        job->error = JOB_IO_ERROR;
+        return 0;
+    }
+    //give back the memory, so that the job doesn't go on counting against the
+    // budget while it holds few reads
+    ArenaMark empty = {NULL, 0};
+    Arena_Rewind(job->arena, empty);
+    Arena_Trim(job->arena);
+    if(!SeqSet_Shrink(job->unique))
+    {
+        job->error = JOB_MEMORY_ERROR;
+        return 0;
+    }
+    if(job->verbose)
+    {
+        printf("\r\t\tSpilled run %d to disk                               \n", 
+                run->index + 1);
+    }
+
+    //keep the number of open runs down by merging them
+    if(job->num_runs == MAX_RUNS)
+    {
+        f = dedup_run_file(job);
+        if(f == NULL) return 0;
+        if(!dedup_merge(job, f) || fflush(f))
+        {
+            fclose(f);
+            return 0;
+        }
+        dedup_close_runs(job);
+        job->runs[0].f = f;
+        job->runs[0].index = 0;
+        job->num_runs = 1;
+    }
+    return 1;
+}
+
+int dedup_merge(DedupJob *job, FILE *out)
+{
+    int i, size = 0, ok = 1;
+    RunReader *heap[job->num_runs];
+
+    //start reading each run from the beginning
+    for(i = 0; i < job->num_runs && ok; i++)
+    {
+        RunReader *run = job->runs + i;
+        rewind(run->f);
+        ok = RunReader_Next(run);
+        if(ok > 0)
+            heap[size++] = run;
+        ok = (ok >= 0);
+    }
+    for(i = size / 2 - 1; i >= 0; i--)
+        RunHeap_Down(heap, size, i);
+
+    //the last read written, to drop later copies of it
+    FastQSeq last;
+    unsigned long long last_umi = 0, last_umi_n = 0, *last_bits = NULL;
+    size_t last_size = 0;
+    int have_last = 0;
+
+    while(size > 0 && ok)
+    {
+        RunReader *top = heap[0];
+        if(!have_last || SeqKey_Compare(top->umi, top->umi_n, &top->seq,
+                    last_umi, last_umi_n, &last) != 0)
+        {
+            if(out != NULL)
+            {
+                if(!Run_Write(out, top->umi, top->umi_n, &top->seq))
+                    ok = 0;
+            }
+            else
+            {
+                if(!FastQSeq_Write(&top->seq, job->out))
+                {
+                    snprintf(job->message, ERROR_SIZE, 
+                            "Error writing to file \"%s\"", job->out_name);
+                    job->error = JOB_IO_ERROR;
+                    ok = 0;
+                    break;
+                }
+                if(!add_length(&job->length_dist, &job->dist_size, 
+                            top->seq.length))
+                {
+                    job->error = JOB_MEMORY_ERROR;
+                    ok = 0;
+                    break;
+                }
+                job->count += 1;
+            }
+
+            //remember the read's key
+            if(top->seq.words > last_size)
+            {
+                unsigned long long *bits = realloc(last_bits, 
+                        top->seq.words * sizeof(unsigned long long));
+                if(bits == NULL)
+                {
+                    job->error = JOB_MEMORY_ERROR;
+                    ok = 0;
+                    break;
+                }
+                last_bits = bits;
+                last_size = top->seq.words;
+            }
+            last = top->seq;
+            last.bits = last_bits;
+            memcpy(last_bits, top->seq.bits, 
+                    top->seq.words * sizeof(unsigned long long));
+            last_umi = top->umi;
+            last_umi_n = top->umi_n;
+            have_last = 1;
+        }
+
+        //move on to the run's next read
+        int next = RunReader_Next(top);
+        if(next < 0)
+            ok = 0;
+        else if(next == 0)
+            heap[0] = heap[--size];
+        if(size > 0)
+            RunHeap_Down(heap, size, 0);
+    }
+    free(last_bits);
+
+    if(!ok && !job->error)
+    {
+        snprintf(job->message, ERROR_SIZE, "Error merging temporary files in "
+                "\"%s\"", job->scratch_dir);
+        job->error = JOB_IO_ERROR;
+    }
+    return ok;
+}
+
+void dedup_close_runs(DedupJob *job)
+{
+    int i;
+    if(job->runs == NULL) return;
+    for(i = 0; i < job->num_runs; i++)
+        RunReader_Close(job->runs + i);
+    job->num_runs = 0;
+}
+
+//run jobs from the queue until there are none left
+void *dedup_worker(void *arg)
+{
+    JobQueue *queue = (JobQueue *) arg;
+    int i;
+    while(1)
+    {
+        pthread_mutex_lock(&queue->lock);
+        i = queue->next++;
+        pthread_mutex_unlock(&queue->lock);
+        if(i >= queue->num_jobs) break;
+        queue->fn(queue->jobs + i);
+    }
+    return NULL;
+}
+
+//run all the jobs in the queue using up to workers threads
+void run_jobs(JobQueue *queue, int workers)
+{
+    int i, started = 0;
+    if(workers > queue->num_jobs) workers = queue->num_jobs;
+    pthread_t threads[workers > 1 ? workers - 1 : 1];
+
+    pthread_mutex_init(&queue->lock, NULL);
+    queue->next = 0;
+    //this thread is also a worker
+    for(i = 0; i < workers - 1; i++)
+    {
+        if(pthread_create(threads + i, NULL, dedup_worker, queue) != 0)
+            break;
+        started++;
+    }
+    dedup_worker(queue);
+    for(i = 0; i < started; i++)
+        pthread_join(threads[i], NULL);
+    pthread_mutex_destroy(&queue->lock);
+}
+
+//get the barcode format from my_settings, checking that its UMI isn't too long
+// to pack. Returns NULL with an exception set on error
+const char *get_barcode_format(PyObject *my_settings)
+{
+    PyObject *ptemp = PyObject_GetAttrString(my_settings, "barcode_format");
+    if(ptemp == NULL) return NULL;
+    const char* barcode_format = PyString_AsString(ptemp);
+    Py_DECREF(ptemp);
+    if(barcode_format == NULL) return NULL;
+    if(get_umi_length(barcode_format) > MAX_UMI_LENGTH)
+    {
+        PyErr_Format(PyExc_ValueError, "UMIs can be at most %d bases long", 
+                MAX_UMI_LENGTH);
+        return NULL;
+    }
+    return barcode_format;
+}
+
+//create job's output file for isample in out_dir, compressed at level, and
+// store its name in out_files. Returns 0 with an exception set on error
+int open_job(DedupJob *job, PyObject *isample, const char *out_dir, int level,
+        PyObject *out_files)
+{
+    job->sample = PyString_AsString(isample);
+    if(job->sample == NULL) return 0;
+
+    const char* ssample = job->sample;
+    char sample_dot[strlen(ssample)+2];
+    sprintf(sample_dot, "%s.", ssample);
+    job->out = tempfile_reads(out_dir, sample_dot, ".clean", level,
+            &job->out_name);
+    if(job->out == NULL) return 0;
+
+    //store output file, which also keeps the name alive
+    PyObject *ptemp = PyString_FromString(job->out_name);
+    PyDict_SetItem(out_files, isample, ptemp);
+    job->out_name = PyString_AsString(ptemp);
+    Py_DECREF(ptemp);
+    return 1;
+}
+
+//collect the results of the jobs for samples, record them as the "clean"
+// statistics and release the jobs and samples. Returns 0 with an exception set
+// if ok is 0 or any of the jobs failed
+int finish_jobs(DedupJob *jobs, PyObject **samples, int num_jobs, int ok)
+{
+    int i, verbose = is_verbose();
+    long total = 0;
+    long *length_dist = NULL;
+    size_t dist_size = 0, k;
+    PyObject *ptemp, *PyCount = PyDict_New();
+    for(i = 0; i < num_jobs; i++)
+    {
+        DedupJob *job = jobs + i;
+        if(job->out != NULL)
+            gzclose(job->out);
+        dedup_free(job);
+        free(job->runs);
+        if(ok && job->error)
+        {
+            ok = 0;
+            if(job->error == JOB_MEMORY_ERROR)
+                PyErr_NoMemory();
+            else
+                PyErr_SetString(PyExc_IOError, job->message);
+        }
+
+        //jobs which weren't verbose themselves are reported here
+        if(verbose && !job->verbose && !job->error)
+        {
+            printf("Sample \"%s\"\n", job->sample);
+            printf("\t\tWritten %ld reads to \"%s\"\n", job->count, 
+                    job->out_name);
+        }
+
+        //store the count
+        ptemp = PyInt_FromLong(job->count);
+        PyDict_SetItem(PyCount, samples[i], ptemp);
+        Py_DECREF(ptemp);
+        total += job->count;
+        if(ok && job->dist_size > 0)
+        {
+            if(grow_dist(&length_dist, &dist_size, job->dist_size - 1))
+            {
+                for(k = 0; k < job->dist_size; k++)
+                    length_dist[k] += job->length_dist[k];
+            }
+            else
+            {
+                ok = 0;
+                PyErr_NoMemory();
+            }
+        }
+        if(ok && !stats_addlengths("clean", samples[i], job->length_dist,
+                    job->dist_size))
+            ok = 0;
+        free(job->length_dist);
+
+        Py_DECREF(samples[i]);
+    }
+
+    if(!ok)
+    {
+        free(length_dist);
+        Py_DECREF(PyCount);
+        return 0;
+    }
+    
+    //print summary
+    if(verbose)
+    {
+        printf("Found %ld reads :-\n", total);
+        print_read_count(PyCount, total, 1);
+        if(dist_size > 0)
+        {
+            printf("Length Distribution :-\n");
+            print_read_dist(length_dist, dist_size, 50, 1);
+        }
+    }
+    free(length_dist);
+
+    //save statistics
+    ok = stats_addvalues("clean", PyCount);
+    Py_DECREF(PyCount);
+    return ok;
+}
+
+PyObject *process_sample(PyObject* self, PyObject *args)
+{
+    int verbose = is_verbose();
+    if(verbose)
+    {
+        printf("Processing Samples\n");
+    }
+    //parse arguments
+    PyObject *in_files = NULL, *my_settings = NULL;
+    const char* out_dir = NULL;
+    int remove_input = 1, workers = 1, compress = 0, i;
+    Py_ssize_t max_memory = 0;
+    int ok = PyArg_ParseTuple(args, "O!Os|iini", &PyDict_Type, &in_files,
+            &my_settings, &out_dir, &remove_input, &workers, &max_memory,
+            &compress);
+    if(!ok || !check_level(compress))
+    {
+        return NULL;
+    }
+    if(max_memory < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "max_memory must not be negative");
+        return NULL;
+    }
+    //check dict
+    Py_ssize_t pos = 0;
+    PyObject *isample = NULL, *ifile = NULL;
+    while(PyDict_Next(in_files, &pos, &isample, &ifile))
+    {
+        if(!PyString_Check(isample))
+        {
+            PyErr_SetString(PyExc_ValueError, "Sample name must be a string");
+            return NULL;
+        }
+        const char *fname = NULL;
+        long length = 1;
+        int ok = PyArg_ParseTuple(ifile, "sl", &fname, &length);
+        if(!ok)
+        {
+            return NULL;
+        }
+    }
+
+    //extract barcode format
+    const char* barcode_format = get_barcode_format(my_settings);
+    if(barcode_format == NULL) return NULL;
+
+    //share the memory budget between the jobs running at once
+    int num_jobs = (int) PyDict_Size(in_files);
+    int running = (workers < num_jobs) ? workers : num_jobs;
+    size_t job_memory = (size_t) max_memory / (running > 1 ? running : 1);
+    if(max_memory > 0 && job_memory < get_min_memory())
+    {
+        PyErr_Format(PyExc_ValueError, "max_memory must be at least %zu bytes "
+                "for each of the %d samples deduplicated at once", 
+                get_min_memory(), running);
+        return NULL;
+    }
+
+    //a job for each sample, holding references to the names while the jobs 
+    // run without the GIL
+    DedupJob *jobs = calloc(num_jobs > 0 ? num_jobs : 1, sizeof(DedupJob));
+    PyObject *job_samples[num_jobs > 0 ? num_jobs : 1], 
+             *job_files[num_jobs > 0 ? num_jobs : 1];
+    if(jobs == NULL) return PyErr_NoMemory();
+
+    //prepare output dict
+    PyObject* out_files = PyDict_New();
+
+    //create the jobs and their output files
+    pos = 0;
+    i = 0;
+    ok = 1;
+    while(PyDict_Next(in_files, &pos, &isample, &ifile))
+    {
+        DedupJob *job = jobs + i;
+        PyArg_ParseTuple(ifile, "sl", &job->in_name, &job->length);
+        job->barcode_format = barcode_format;
+        job->remove_input = remove_input;
+        job->verbose = verbose && (workers <= 1);
+        job->max_memory = job_memory;
+        job->scratch_dir = out_dir;
+        if(!open_job(job, isample, out_dir, compress, out_files))
+        {
+            ok = 0;
+            break;
+        }
+
+        Py_INCREF(isample);
+        Py_INCREF(ifile);
+        job_samples[i] = isample;
+        job_files[i] = ifile;
+        i++;
+    }
+    num_jobs = i;
+
+    //deduplicate each sample
+    if(ok)
+    {
+        JobQueue queue;
+        queue.jobs = jobs;
+        queue.fn = dedup_sample;
+        queue.num_jobs = num_jobs;
+        Py_BEGIN_ALLOW_THREADS
+        run_jobs(&queue, workers);
+        Py_END_ALLOW_THREADS
+    }
+
+    //collect the results
+    ok = finish_jobs(jobs, job_samples, num_jobs, ok);
+    for(i = 0; i < num_jobs; i++)
+        Py_DECREF(job_files[i]);
+    free(jobs);
+    if(!ok)
+    {
+        Py_DECREF(out_files);
+        return NULL;
+    }
+
+    return out_files;
+}
+
+//return the job holding the most memory
+DedupJob *largest_job(DedupJob *jobs, int num_jobs)
+{
+    int i;
+    DedupJob *ret = jobs;
+    for(i = 1; i < num_jobs; i++)
+    {
+        if(dedup_held(jobs + i) > dedup_held(ret))
+            ret = jobs + i;
+    }
+    return ret;
+}
+
+PyObject *split_and_process(PyObject* self, PyObject *args)
+{
+    int verbose = is_verbose();
+    if(verbose)
+    {
+        printf("Splitting and Processing Samples\n");
+    }
+    PyObject *my_settings = NULL, *barcodes = NULL;
+    const char *in_file = NULL, *out_dir = NULL;
+    int remove_input = 0, workers = 1, compress = 0, i;
+    Py_ssize_t max_memory = 0;
+    int ok = PyArg_ParseTuple(args, "sOs|iini", &in_file, &my_settings, 
+            &out_dir, &remove_input, &workers, &max_memory, &compress);
+    if(!ok || !check_level(compress))
+    {
+        return NULL;
+    }
+    if(max_memory < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "max_memory must not be negative");
+        return NULL;
+    }
+    if(verbose)
+    {
+        printf("Reading from \"%s\"\n", in_file);
+    }
+
+    //get sample names & barcodes
+    barcodes = PyObject_GetAttrString(my_settings, "barcodes");
+    if (barcodes == NULL){ return NULL; }
+    if (!PyDict_Check(barcodes)){
+        PyErr_SetString(PyExc_TypeError, "settings.barcodes must be a dict");
+        Py_DECREF(barcodes);
+        return NULL;
+    }
+    int num_jobs = (int) PyDict_Size(barcodes);
+    if(max_memory > 0 && (size_t) max_memory / 
+            (num_jobs > 1 ? num_jobs : 1) < get_min_memory())
+    {
+        PyErr_Format(PyExc_ValueError, "max_memory must be at least %zu bytes "
+                "for each of the %d samples", get_min_memory(), num_jobs);
+        Py_DECREF(barcodes);
+        return NULL;
+    }
+
+    const char* barcode_format = get_barcode_format(my_settings);
+    int mismatches = 0;
+    if(barcode_format == NULL || !get_mismatches(my_settings, &mismatches))
+    {
+        Py_DECREF(barcodes);
+        return NULL;
+    }
+
+    //a job for each sample, given its reads as they're found
+    DedupJob *jobs = calloc(num_jobs > 0 ? num_jobs : 1, sizeof(DedupJob));
+    PyObject *job_samples[num_jobs > 0 ? num_jobs : 1];
+    const char *barcode_seqs[num_jobs > 0 ? num_jobs : 1];
+    long ccount[num_jobs > 0 ? num_jobs : 1];
+    if(jobs == NULL)
+    {
+        Py_DECREF(barcodes);
+        return PyErr_NoMemory();
+    }
+    PyObject* out_files = PyDict_New();
+
+    Py_ssize_t pos = 0;
+    PyObject *isample, *ibarcode;
+    i = 0;
+    while(PyDict_Next(barcodes, &pos, &isample, &ibarcode))
+    {
+        DedupJob *job = jobs + i;
+        barcode_seqs[i] = PyString_AsString(ibarcode);
+        if(barcode_seqs[i] == NULL)
+        {
+            ok = 0;
+            break;
+        }
+        job->barcode_format = barcode_format;
+        job->scratch_dir = out_dir;
+        if(!open_job(job, isample, out_dir, compress, out_files))
+        {
+            ok = 0;
+            break;
+        }
+        Py_INCREF(isample);
+        job_samples[i] = isample;
+        ccount[i] = 0L;
+        i++;
+        //the memory budget is shared between all samples below, so the jobs
+        // don't limit themselves, but hold their reads in blocks sized for
+        // their share of it
+        if(!dedup_open(job, 
+                    (size_t) max_memory / (num_jobs > 1 ? num_jobs : 1)))
+        {
+            PyErr_NoMemory();
+            ok = 0;
+            break;
+        }
+    }
+    num_jobs = i;
+
+    //build the barcode lookup table
+    BarcodeTable *table = NULL;
+    if(ok)
+    {
+        table = BarcodeTable_New(barcode_seqs, num_jobs, 
+                get_barcode_length(barcode_format), mismatches);
+        if(table == NULL)
+        {
+            if(!PyErr_Occurred()) PyErr_NoMemory();
+            ok = 0;
+        }
+    }
+    Py_DECREF(barcodes);
+
+    //open input file
+    char error[ERROR_SIZE];
+    gzFile in = NULL;
+    if(ok)
+    {
+        in = open_reads(in_file, error);
+        if(in == NULL)
+        {
+            PyErr_SetString(PyExc_IOError, error);
+            ok = 0;
+        }
+    }
+    FastQReader *reader = NULL;
+    if(ok)
     {
-        char e[32+strlen(in_file)];
-        sprintf(e, "could not open input file \"%s\"", in_file);
-        PyErr_SetString(PyExc_IOError, e);
-        Py_DECREF(files);
-        return NULL;
+        reader = FastQReader_New(in);
+        if(reader == NULL)
+        {
+            gzclose(in);
+            PyErr_NoMemory();
+            ok = 0;
+        }
     }
 
-
-    char barcode[strlen(barcode_format)+1];
-
-    //for each seq
-    FastQSeq * seq = NULL;
+    //send each read to its sample's job
     long total = 0;
-    long ccount[num_samples];
-    for(i=0; i<num_samples; i++)
-        ccount[i] = 0L;
-
-    while(FastQSeq_Read(in, &seq))
+    if(ok)
     {
-        //extract barcode
-        //write it to the correct file
-
-        get_barcode(seq, barcode_format, barcode);
-
-        for(i=0; i < num_samples; i++)
+        int read_ok;
+        FastQSeq seq;
+        char barcode[strlen(barcode_format)+1];
+        size_t held = 0, before;
+        Py_BEGIN_ALLOW_THREADS
+        while((read_ok = FastQReader_Next(reader, &seq)) > 0)
         {
-            if(strcmp(barcode, barcode_seqs[i]) == 0)
+            get_barcode(&seq, barcode_format, barcode);
+            i = BarcodeTable_Lookup(table, barcode);
+            if(i < 0)
+                continue;
+            ccount[i] += 1;
+            total += 1;
+
+            DedupJob *job = jobs + i;
+            before = dedup_held(job);
+            if(!dedup_add(job, &seq))
             {
-                FastQSeq_Write(seq, open_files[i]);
-                ccount[i] += 1;
-                total += 1;
+                read_ok = -1;
                 break;
             }
-        }
+            held += dedup_held(job) - before;
 
-        FastQSeq_Free(seq);
-        seq = NULL;
+            //make room by spilling the sample holding the most reads
+            if(max_memory > 0 && held > (size_t) max_memory)
+            {
+                job = largest_job(jobs, num_jobs);
+                before = dedup_held(job);
+                if(!dedup_spill(job))
+                {
+                    read_ok = -1;
+                    break;
+                }
+                held -= before - dedup_held(job);
+            }
+        }
+        FastQReader_Free(reader);
+        Py_END_ALLOW_THREADS
+        if(!close_reads(in, in_file, error) || read_ok < 0)
+        {
+            ok = 0;
+            for(i = 0; i < num_jobs && !jobs[i].error; i++);
+            if(i < num_jobs && jobs[i].error == JOB_IO_ERROR)
+                PyErr_SetString(PyExc_IOError, jobs[i].message);
+            else if(read_ok < 0) 
+                PyErr_NoMemory();
+            else
+                PyErr_SetString(PyExc_IOError, error);
+        }
     }
-    //close files and fill in count and filename
-    count = PyDict_New();
-    for(i=0; i < num_samples; i++)
-    {
-        fclose(open_files[i]);
-        PyObject *c = PyInt_FromLong(ccount[i]);
-        PyDict_SetItem(count, sample_names[i], c);
-        
-        PyObject *f = PyDict_GetItem(files, sample_names[i]);
-        PyObject *t = PyTuple_Pack(2, f, c);
-        PyDict_SetItem(files, sample_names[i], t);
+    BarcodeTable_Free(table);
 
-        Py_DECREF(t);
-        Py_DECREF(c);
-        Py_DECREF(sample_names[i]);
-    }
-    //check for error
-    if(ferror(in))
+    //record the reads found for each sample
+    if(ok)
     {
-        char err[64+strlen(in_file)];
-        sprintf(err, "Error reading from file \"%s\"", in_file);
-        PyErr_SetString(PyExc_IOError, err);
+        PyObject *count = PyDict_New(), *c;
+        for(i = 0; i < num_jobs; i++)
+        {
+            c = PyInt_FromLong(ccount[i]);
+            PyDict_SetItem(count, job_samples[i], c);
+            Py_DECREF(c);
+        }
+        if(verbose)
+        {
+            printf("Found %ld reads:-\n", total);
+            print_read_count(count, total, 1);
+        }
+        ok = stats_addvalues("split_by_barcode", count);
         Py_DECREF(count);
-        Py_DECREF(files);
-        return NULL;
     }
-    fclose(in);
 
-    if(is_verbose())
+    //write out each sample
+    if(ok)
     {
-        printf("Found %ld reads:-\n", total);
-        print_read_count(count, total, 1);
+        JobQueue queue;
+        queue.jobs = jobs;
+        queue.fn = dedup_write;
+        queue.num_jobs = num_jobs;
+        Py_BEGIN_ALLOW_THREADS
+        run_jobs(&queue, workers);
+        Py_END_ALLOW_THREADS
     }
 
-    //store statistics
-    if(!stats_addvalues("split_by_barcode",count))
+    //collect the results
+    ok = finish_jobs(jobs, job_samples, num_jobs, ok);
+    free(jobs);
+    if(!ok)
     {
-        Py_DECREF(count);
-        Py_DECREF(files);
+        Py_DECREF(out_files);
         return NULL;
     }
-    Py_DECREF(count);
 
     //delete input file if requested
-    if(remove_input)
+    if(remove_input && remove(in_file))
     {
-        if(remove(in_file))
-        {
-            char e[64+strlen(in_file)];
-            sprintf(e, "Could not remove input file \"%s\"", in_file);
-            PyErr_SetString(PyExc_IOError, e);
-            return NULL;
-        }
+        PyErr_Format(PyExc_IOError, "Could not remove input file \"%s\"", 
+                in_file);
+        Py_DECREF(out_files);
+        return NULL;
     }
 
-    return files;
+    return out_files;
 }
 
-PyObject *process_sample(PyObject* self, PyObject *args)
+PyObject* run(PyObject *self, PyObject *args)
 {
-    if(is_verbose())
-    {
-        printf("Processing Samples\n");
-    }
-    //parse arguments
-    PyObject *in_files = NULL, *my_settings = NULL, *ptemp;
-    const char* out_dir = NULL;
-    int remove_input = 1, i;
-    int ok = PyArg_ParseTuple(args, "O!Os|i", &PyDict_Type, &in_files,
-            &my_settings, &out_dir, &remove_input);
+    PyObject *my_settings = NULL, 
+             *files1      = NULL, 
+             *files2      = NULL, 
+             *the_args    = NULL;
+    const char *in_file   = NULL, 
+               *out_dir    = NULL;
+    int remove_input = 0, workers = 1, fused = 1, compress = 0;
+    Py_ssize_t max_memory = 0;
+    int ok = PyArg_ParseTuple(args, "sOs|iinii", &in_file, &my_settings, 
+            &out_dir, &remove_input, &workers, &max_memory, &fused, &compress);
     if(!ok)
     {
         return NULL;
     }
-    //check dict
-    Py_ssize_t pos = 0;
-    PyObject *isample = NULL, *ifile = NULL;
-    while(PyDict_Next(in_files, &pos, &isample, &ifile))
+
+    //test that in_file exists?
+
+    //every sample holds reads at once when fused, so a budget too small to
+    // share between them is split between the samples running at once instead
+    if(fused && max_memory > 0)
     {
-        if(!PyString_Check(isample))
-        {
-            PyErr_SetString(PyExc_ValueError, "Sample name must be a string");
-            return NULL;
-        }
-        const char *fname = NULL;
-        long length = 1;
-        int ok = PyArg_ParseTuple(ifile, "sl", &fname, &length);
-        if(!ok)
+        PyObject *barcodes = PyObject_GetAttrString(my_settings, "barcodes");
+        if(barcodes == NULL) return NULL;
+        Py_ssize_t num_samples = PyObject_Size(barcodes);
+        Py_DECREF(barcodes);
+        if(num_samples < 0) return NULL;
+        if((size_t) max_memory / (num_samples > 1 ? num_samples : 1) < 
+                get_min_memory())
         {
-            return NULL;
+            fused = 0;
+            if(is_verbose())
+            {
+                printf("max_memory is too small to share between %ld samples, "
+                        "splitting them first\n", (long) num_samples);
+            }
         }
     }
 
-    long length_dist[LENGTH_DIST];
-    for(i = 0; i < LENGTH_DIST; i++)
-        length_dist[i] = 0;
-
-
+    if(fused)
+    {
+        the_args = Py_BuildValue("sOsiini", in_file, my_settings, out_dir, 
+                remove_input, workers, max_memory, compress);
+        files2 = split_and_process(self, the_args);
+        Py_DECREF(the_args);
+        return files2;
+    }
 
-    //extract barcode format
-    ptemp = PyObject_GetAttrString(my_settings, "barcode_format");
-    if(ptemp == NULL) return NULL;
-    const char* barcode_format = PyString_AsString(ptemp);
-    if(barcode_format == NULL) return NULL;
-    Py_DECREF(ptemp);
-    size_t barcode_length = strlen(barcode_format);
-    long umi_length = get_umi_length(barcode_format);
-    long num_umi = pow(4, umi_length);
+    the_args = Py_BuildValue("sOsii", in_file, my_settings, out_dir, 
+            remove_input, compress);
+    //call split_by_barcode
+    files1 = split_by_barcode(self, the_args);
+    Py_DECREF(the_args);
+    if(files1 == NULL) return NULL;
 
+    //call process_sample -- always remove_input for internal tempfiles
+    the_args = Py_BuildValue("OOsiini", files1, my_settings, out_dir, 1, 
+            workers, max_memory, compress);
+    Py_DECREF(files1);
+    files2 = process_sample(self, the_args);
+    Py_DECREF(the_args);
+    if(files2 == NULL) return NULL;
 
-    //prepare output dict
-    PyObject* out_files = PyDict_New();
+    return files2;
+}
 
-    //for each sample and file
-    pos = 0;
-    long count, total = 0;
-    PyObject *PyCount = PyDict_New();
-    SeqItem **UMI = malloc(num_umi * sizeof(SeqItem*));
-    for(i=0; i < num_umi; i++)
-        UMI[i] = NULL;
-    while(PyDict_Next(in_files, &pos, &isample, &ifile))
+//copy the counts of each file, written one after another to columns, into
+// table as a row of num_files for each of the size reads. Only counts for the
+// first col_len[j] reads were written for file j, the rest are 0
+int collapse_table(FILE *columns, const size_t *col_len, int num_files, 
+        size_t size, FILE *table)
+{
+    size_t rows = COLLAPSE_BLOCK / (num_files > 0 ? num_files : 1), 
+           start, offset, k, n, m;
+    if(rows == 0) rows = 1;
+    unsigned int *row = malloc(rows * (num_files > 0 ? num_files : 1) * 
+                sizeof(unsigned int)),
+                 *col = malloc(rows * sizeof(unsigned int));
+    int j, ret = (row == NULL || col == NULL) ? JOB_MEMORY_ERROR : 0;
+
+    for(start = 0; start < size && ret == 0; start += rows)
     {
-        const char *in_name = NULL, *out_name = NULL;
-        long length = 1;
-        int ok = PyArg_ParseTuple(ifile, "sl", &in_name, &length);
-        if(!ok)
+        n = (size - start < rows) ? size - start : rows;
+        memset(row, 0, n * num_files * sizeof(unsigned int));
+        offset = 0;
+        for(j = 0; j < num_files && ret == 0; j++)
         {
-            Py_DECREF(out_files);
-            Py_DECREF(PyCount);
-            return NULL;
+            if(col_len[j] > start)
+            {
+                m = (col_len[j] - start < n) ? col_len[j] - start : n;
+                if(fseeko(columns, 
+                            (off_t) ((offset + start) * sizeof(unsigned int)), 
+                            SEEK_SET) ||
+                        fread(col, sizeof(unsigned int), m, columns) != m)
+                {
+                    ret = JOB_IO_ERROR;
+                    break;
+                }
+                for(k = 0; k < m; k++)
+                    row[k * num_files + j] = col[k];
+            }
+            offset += col_len[j];
         }
+        if(ret == 0 && 
+                fwrite(row, sizeof(unsigned int), n * num_files, table) != 
+                n * num_files)
+            ret = JOB_IO_ERROR;
+    }
+    free(row);
+    free(col);
+    return ret;
+}
 
-        if(is_verbose())
+//write the first copy of each distinct sequence in the num_files files to out,
+// named by its index, and the number of times it was found in each file to
+// table as a row of num_files native unsigned ints. Only the counts for the
+// file being read are held, the others are written to the scratch file columns
+// until the table is written. Doesn't touch any python objects so can be run 
+// without the GIL. Returns 0 or JOB_IO_ERROR, with the error described in 
+// error[ERROR_SIZE], or JOB_MEMORY_ERROR
+int collapse_files(const char **files, int num_files, gzFile out, FILE *table,
+        FILE *columns, long *total, long *distinct, char *error)
+{
+    SeqSet *seqs = SeqSet_New(0);
+    Arena *arena = Arena_New(ARENA_BLOCK);
+    unsigned int *counts = NULL;
+    size_t size = 0, capacity = 0, index, 
+           col_len[num_files > 0 ? num_files : 1];
+    char name[32];
+    int i, ok = 1, 
+        ret = (seqs == NULL || arena == NULL) ? JOB_MEMORY_ERROR : 0;
+
+    *total = 0;
+    for(i = 0; i < num_files && ret == 0; i++)
+    {
+        gzFile in = open_reads(files[i], error);
+        if(in == NULL)
         {
-            const char *sample_name = PyString_AsString(isample);
-            printf("Sample \"%s\"\n", sample_name);
-            printf("\tReading from \"%s\"\n", in_name);
+            ret = JOB_IO_ERROR;
+            break;
         }
-
-        //open input file
-        FILE *in = fopen(in_name, "rb");
-        if(in == NULL)
+        FastQReader *reader = FastQReader_New(in);
+        if(reader == NULL)
         {
-            char e[32+strlen(in_name)];
-            sprintf(e, "Could not open file \"%s\"", in_name);
-            PyErr_SetString(PyExc_IOError, e);
-            Py_DECREF(PyCount);
-            Py_DECREF(out_files);
-            return NULL;
+            gzclose(in);
+            ret = JOB_MEMORY_ERROR;
+            break;
         }
 
-        //load in all seqs
-        FastQSeq *seq = NULL;
-        SeqItem *item;
-        char umi[umi_length];
-        long lumi = 0;
-        count = 0;
-        while(FastQSeq_Read(in, &seq))
+        FastQSeq view;
+        while((ok = FastQReader_Next(reader, &view)) > 0)
         {
-            count += 1;
-            if(count % 1000 == 0)
-            {
-                if(is_verbose())
-                {
-                    printf("\rReading %ld/%ld (%3.1f%%)         ", 
-                        count, length,
-                        100.0 * (float)((double)count / (double)length));
-                    fflush(stdout);
-                }
-            }
-            FastQSeq_RemoveA(seq);
-            if((strlen(seq->seq)-barcode_length) < MIN_LENGTH)
+            *total += 1;
+            //copy the read under the name it takes if it's new
+            sprintf(name, "%lu", (unsigned long) size);
+            view.name = name;
+            ArenaMark mark = Arena_Mark(arena);
+            FastQSeq *seq = FastQSeq_Copy(arena, &view);
+            int added = 0;
+            SeqSetEntry *e = (seq == NULL) ? NULL : 
+                SeqSet_Insert(seqs, 0, 0, seq, &added);
+            if(e == NULL)
             {
-                FastQSeq_Free(seq);
-                seq = NULL;
-                continue;
+                ret = JOB_MEMORY_ERROR;
+                break;
             }
-            get_umi(seq, barcode_format, umi);
-            //Trim the barcode
-            FastQSeq_RemoveBarcode(seq, barcode_length);
-            //set seq->high and seq->low
-            FastQSeq_SetBits(seq);
-
-
-            //check sequences with the same UMI
-            lumi = get_umi_long(umi);
-            item = UMI[lumi];
-
-            //first case
-            if(item == NULL)
+            if(!added)
             {
-                UMI[lumi] = SeqItem_New(seq);
-                continue;
+                Arena_Rewind(arena, mark);
+                index = strtoul(e->seq->name, NULL, 10);
             }
-            //for each seq with the same UMI
-            while(1)
+            else
             {
-                //compare high
-                if(seq->high == item->the_seq->high)
+                if(size == capacity)
                 {
-                    if(seq->low == item->the_seq->low)
-                    {
-                        //we have a match
-                        FastQSeq_Free(seq);
-                        seq = NULL;
-                        break;
-                    }
-                    else if(seq->low > item->the_seq->low)
+                    size_t c = capacity ? 2 * capacity : SEQSET_MIN_CAPACITY;
+                    unsigned int *grown = realloc(counts, 
+                            c * sizeof(unsigned int));
+                    if(grown == NULL)
                     {
-                        //greater than
-                        SeqItem_Prepend(UMI+lumi, item, SeqItem_New(seq));
+                        ret = JOB_MEMORY_ERROR;
                         break;
                     }
-
-                }
-                else if(seq->high > item->the_seq->high)
-                {
-                    //greater than
-                    SeqItem *new = SeqItem_New(seq);
-                    SeqItem_Prepend(UMI+lumi, item, new);
-                    break;
+                    memset(grown + capacity, 0, 
+                            (c - capacity) * sizeof(unsigned int));
+                    counts = grown;
+                    capacity = c;
                 }
-                // if less than, we need to compare with the next seq
-                //move to the next seq
-                if(item->next != NULL)
-                    item = item->next;
-                else
+                if(!FastQSeq_Write(seq, out))
                 {
-                    //seq is less than the last item
-                    SeqItem_Append(item, SeqItem_New(seq));
+                    snprintf(error, ERROR_SIZE, "Error writing collapsed reads");
+                    ret = JOB_IO_ERROR;
                     break;
                 }
+                index = size++;
             }
+            counts[index] += 1;
         }
-        //check for error
-        if(ferror(in))
-        {
-            char err[64+strlen(in_name)];
-            sprintf(err, "Error reading from file \"%s\"", in_name);
-            PyErr_SetString(PyExc_IOError, err);
-            Py_DECREF(PyCount);
-            Py_DECREF(out_files);
-            return NULL;
-        }
-
-        //close input
-        fclose(in);
-        
-        //create and open output file
-        const char* ssample = PyString_AsString(isample);
-        char sample_dot[strlen(ssample)+1];
-        sprintf(sample_dot, "%s.", ssample);
-        FILE *out = tempfile_mkstemp3(out_dir, sample_dot, ".clean", &out_name);
-        
-        //store output file
-        ptemp = PyString_FromString(out_name);
-        PyDict_SetItem(out_files, isample, ptemp);
-        Py_DECREF(ptemp);
-
-        if(is_verbose())
-        {
-            printf("\r                                                       \r");
-            printf("\t\tWriting to \"%s\"\n", out_name);
-        }
-
-        //save each item
-        count = 0;
-        ok = 0;
-        for(i=0; i < num_umi; i++)
+        FastQReader_Free(reader);
+        if(!close_reads(in, files[i], error))
+            ret = JOB_IO_ERROR;
+        else if(ok < 0 && ret == 0)
+            ret = JOB_MEMORY_ERROR;
+
+        //put the file's counts aside and start again for the next
+        if(ret == 0)
         {
-            item = UMI[i];
-            while(item != NULL)
+            col_len[i] = size;
+            if(fwrite(counts, sizeof(unsigned int), size, columns) != size)
             {
-                //write
-                FastQSeq_Write(item->the_seq, out);
-
-                //statistics
-                int len = strlen(item->the_seq->seq);
-                if(len < LENGTH_DIST)
-                    length_dist[len] += 1;
-                count += 1;
-                total += 1;
-
-                item = item->next;
+                snprintf(error, ERROR_SIZE, "Error writing read counts");
+                ret = JOB_IO_ERROR;
             }
-            //free all items in this UMI
-            SeqItem_Free(UMI[i]);
-            UMI[i] = NULL;
+            else if(size > 0)
+                memset(counts, 0, size * sizeof(unsigned int));
         }
+    }
 
-        //close output
-        fclose(out);
-
-        //delete input
-        if(remove_input)
+    if(ret == 0 && (fflush(columns) || 
+                (ret = collapse_table(columns, col_len, num_files, size, 
+                                      table)) != 0))
+    {
+        if(ret != JOB_MEMORY_ERROR)
         {
-            if(remove(in_name))
-            {
-                char e[32+strlen(in_name)];
-                sprintf(e, "Failed to remove file \"%s\"", in_name);
-                PyErr_SetString(PyExc_IOError, e);
-                Py_DECREF(out_files);
-                Py_DECREF(PyCount);
-                return NULL;
-            }
+            snprintf(error, ERROR_SIZE, "Error writing read counts");
+            ret = JOB_IO_ERROR;
         }
+    }
+    *distinct = (long) size;
 
-        //store the count
-        ptemp = PyInt_FromLong(count);
-        PyDict_SetItem(PyCount, isample, ptemp);
-        Py_DECREF(ptemp);
+    free(counts);
+    SeqSet_Free(seqs);
+    Arena_Free(arena);
+    return ret;
+}
 
-        if(is_verbose())
-        {
-            printf("\t\tWritten %ld reads\n", count);
-        }
-    }
-    free(UMI);
-    
-    //print summary
-    if(is_verbose())
+PyObject *collapse(PyObject *self, PyObject *args)
+{
+    PyObject *in_files = NULL;
+    const char *out_name = NULL, *table_name = NULL;
+    int compress = 0, i;
+    int ok = PyArg_ParseTuple(args, "O!ss|i", &PyList_Type, &in_files, 
+            &out_name, &table_name, &compress);
+    if(!ok || !check_level(compress))
     {
-        printf("Found %ld reads :-\n", total);
-        print_read_count(PyCount, total, 1);
-        printf("Length Distribution :-\n");
-        print_read_dist(length_dist, LENGTH_DIST, 50, 1);
+        return NULL;
     }
 
-    //save statistics
-    if(!stats_addvalues("clean", PyCount))
+    int num_files = (int) PyList_Size(in_files);
+    const char *files[num_files > 0 ? num_files : 1];
+    for(i = 0; i < num_files; i++)
     {
-        Py_DECREF(out_files);
-        return NULL;
+        files[i] = PyString_AsString(PyList_GET_ITEM(in_files, i));
+        if(files[i] == NULL) return NULL;
     }
 
+    int verbose = is_verbose();
+    if(verbose)
+    {
+        printf("Collapsing %d files to \"%s\"\n", num_files, out_name);
+    }
 
-    return out_files;
-}
-
-PyObject* run(PyObject *self, PyObject *args)
-{
-    PyObject *my_settings = NULL, 
-             *files1      = NULL, 
-             *files2      = NULL, 
-             *the_args    = NULL;
-    const char *in_file   = NULL, 
-               *out_dir    = NULL;
-    int remove_input = 0;
-    int ok = PyArg_ParseTuple(args, "sOs|i", &in_file, &my_settings, &out_dir,
-            &remove_input);
-    if(!ok)
+    //open the outputs
+    char mode[16];
+    gzFile out = gzopen(out_name, write_mode(compress, mode));
+    if(out == NULL)
     {
+        PyErr_Format(PyExc_IOError, "Could not open file \"%s\"", out_name);
         return NULL;
     }
+    gzbuffer(out, GZ_BUFFER);
+    FILE *table = fopen(table_name, "wb");
+    if(table == NULL)
+    {
+        gzclose(out);
+        PyErr_Format(PyExc_IOError, "Could not open file \"%s\"", table_name);
+        return NULL;
+    }
+    //the counts of each file are kept next to the table until it's written,
+    // and removed as soon as they're closed
+    char columns_name[strlen(table_name) + 8];
+    sprintf(columns_name, "%s.XXXXXX", table_name);
+    int fd = mkstemp(columns_name);
+    FILE *columns = NULL;
+    if(fd >= 0)
+    {
+        unlink(columns_name);
+        columns = fdopen(fd, "w+b");
+        if(columns == NULL)
+            close(fd);
+    }
+    if(columns == NULL)
+    {
+        gzclose(out);
+        fclose(table);
+        PyErr_Format(PyExc_IOError, "Failed to create a temporary file next "
+                "to \"%s\"", table_name);
+        return NULL;
+    }
+    setvbuf(columns, NULL, _IOFBF, RUN_BUFFER);
 
-    //test that in_file exists?
-
-    the_args = Py_BuildValue("sOsi", in_file, my_settings, out_dir, remove_input);
-    //call split_by_barcode
-    files1 = split_by_barcode(self, the_args);
-    Py_DECREF(the_args);
-    if(files1 == NULL) return NULL;
-
-    //call process_sample -- always remove_input for internal tempfiles
-    the_args = Py_BuildValue("OOsi", files1, my_settings, out_dir, 1);
-    Py_DECREF(files1);
-    files2 = process_sample(self, the_args);
-    Py_DECREF(the_args);
-    if(files2 == NULL) return NULL;
+    long total = 0, distinct = 0;
+    char error[ERROR_SIZE];
+    int ret;
+    Py_BEGIN_ALLOW_THREADS
+    ret = collapse_files(files, num_files, out, table, columns, &total, 
+            &distinct, error);
+    Py_END_ALLOW_THREADS
+
+    //the files are closed whatever happened
+    fclose(columns);
+    if(gzclose(out) != Z_OK && ret == 0)
+    {
+        snprintf(error, ERROR_SIZE, "Error writing to file \"%s\"", out_name);
+        ret = JOB_IO_ERROR;
+    }
+    if(fclose(table) != 0 && ret == 0)
+    {
+        snprintf(error, ERROR_SIZE, "Error writing to file \"%s\"", table_name);
+        ret = JOB_IO_ERROR;
+    }
+    if(ret == JOB_MEMORY_ERROR)
+        return PyErr_NoMemory();
+    if(ret != 0)
+    {
+        PyErr_SetString(PyExc_IOError, error);
+        return NULL;
+    }
 
-    return files2;
+    if(verbose)
+    {
+        printf("\tCollapsed %ld reads to %ld distinct sequences\n", total, 
+                distinct);
+    }
+    return PyInt_FromLong(distinct);
 }
 
 // Function table
 static PyMethodDef
 module_functions[] = {
     {"run", run, METH_VARARGS,
-        "run(in_file, my_settings, out_dir, remove_input=True)\n"
+        "run(in_file, my_settings, out_dir, remove_input=False, workers=1, "
+            "max_memory=0, fused=True, compress=0)\n"
             "  Run the preprocess pipeline\n"
-            "   in_file: input file (fastQ format)\n"
+            "   in_file: input file (fastQ format, optionally gzipped)\n"
             "   my_settings: Settings object\n"
             "   out_dir: directory to write output and temp files\n"
             "   remove_input: whether or not to remove in_file\n"
+            "   workers: number of samples to deduplicate at once\n"
+            "   max_memory: bytes of reads to hold while deduplicating, "
+            "0 for no limit,\n"
+            "     at least min_memory for each sample. A budget too small to "
+            "share\n"
+            "     between every sample isn't fused\n"
+            "   fused: split and deduplicate in one pass over in_file, rather "
+            "than\n"
+            "     through split_by_barcode and process_sample\n"
+            "   compress: gzip level for the output and temp files, 0 for "
+            "plain FASTQ\n"
             "Returns:\n"
             "   dictionary mapping sample name to file name"},
     {"process_sample", process_sample, METH_VARARGS,
-        "process_sample(files, my_settings, out_dir, remove_input=True)\n"
+        "process_sample(files, my_settings, out_dir, remove_input=True, "
+            "workers=1, max_memory=0, compress=0)\n"
             "  Clean samples and remove duplicates\n"
-            "    files: dict mapping sample names to files\n"
+            "    files: dict mapping sample names to (file, read count)\n"
             "    my_settings: settings.Settings object\n"
             "    out_dir: directory to output to\n"
-            "    remove_input: whether to remove the input files [True]"},
+            "    remove_input: whether to remove the input files [True]\n"
+            "    workers: number of threads deduplicating samples at once [1]\n"
+            "    max_memory: bytes of reads the threads may hold between them, "
+            "beyond which\n"
+            "      sorted runs are spilled to out_dir and merged, 0 for no "
+            "limit [0]\n"
+            "      Must be at least min_memory for each thread\n"
+            "    compress: gzip level for the output, 0 for plain FASTQ [0]"},
+    {"collapse", collapse, METH_VARARGS,
+        "collapse(files, out_file, table_file, compress=0)\n"
+            "  Write each distinct sequence in files once, to map it once "
+            "whichever\n"
+            "  samples it was found in\n"
+            "    files: list of FASTQ files, optionally gzipped\n"
+            "    out_file: file to write the first copy of each sequence to, "
+            "named by\n"
+            "      its index\n"
+            "    table_file: file to write the number of times each sequence "
+            "was\n"
+            "      found in each of files to, as a row of len(files) uint32 "
+            "per\n"
+            "      sequence in native byte order\n"
+            "    compress: gzip level for out_file, 0 for plain FASTQ [0]\n"
+            "Returns:\n"
+            "   the number of distinct sequences"},
     {"split_by_barcode", split_by_barcode, METH_VARARGS,
-        "split_by_barcode(filename, my_settings, out_dir, remove_input=False)"
+        "split_by_barcode(filename, my_settings, out_dir, remove_input=False,"
+        " compress=0)"
         " Split the fastq sequences found in filename into seperate files"
-        " defined by my_settings, saving the files in out_dir"},
+        " defined by my_settings, saving the files in out_dir. filename may"
+        " be gzip compressed, and the files are compressed at gzip level"
+        " compress unless it's 0"},
     { NULL } //sentinel
 };
 
@@ -1031,6 +2843,12 @@ initpreprocess(void)
     if(PyModule_AddObject(the_module, "verbose", verbose) < 0) return;
     Py_DECREF(verbose);
 
+    //expose the least memory a sample may be deduplicated in. Smaller budgets
+    // only spill runs so short that merging them rewrites the same reads over
+    // and over
+    PyObject *min_memory = PyInt_FromSsize_t((Py_ssize_t) MIN_MEMORY);
+    if(PyModule_AddObject(the_module, "min_memory", min_memory) < 0) return;
+
 }
 
 
@@ -1,43 +1,242 @@
 
 #include "Python.h"
+#include <zlib.h>
+#include <pthread.h>
+
+#define LENGTH_DIST 512
+#define ERROR_SIZE 1024
+//UMIs are packed two bits per base into 64 bits
+#define MAX_UMI_LENGTH 32
 
 //utilities
 void print_read_count(PyObject* count, long total, int indent);
 void print_read_dist(long *dist, size_t length, int width, int indent);
+//make sure the histogram *dist of *size entries can count reads of length,
+// growing it if needed. Returns 0 if memory could not be allocated
+int grow_dist(long **dist, size_t *size, size_t length);
+//count a read of length in the histogram *dist, growing it if needed
+int add_length(long **dist, size_t *size, size_t length);
 
 
 //structs
+//A FASTQ record. name, seq and qual are NUL terminated, seq and qual are
+// length long. A record from FastQReader_Next is a view into the reader's
+// buffer, use FastQSeq_Copy to keep it.
+//bits is a 2-bit packed copy of the sequence, 32 bases per word. Bases other
+// than A, T, C or G are packed as A and flagged in a 1-bit per base N mask 
+// which follows the packed words, and which is only present if has_n is set
 typedef struct {
     char *name, *seq, *qual;
-    unsigned long long high, low;
+    unsigned long long *bits;
+    size_t length, words;
+    int has_n;
 } FastQSeq;
 
-FastQSeq *FastQSeq_New(void);
-size_t FastQSeq_Write(FastQSeq *s, FILE *f);
-size_t FastQSeq_Read(FILE * f, FastQSeq **s);
-void FastQSeq_Free(FastQSeq *s);
+//write the record on four lines. Returns 0 if the write failed
+int FastQSeq_Write(FastQSeq *s, gzFile f);
 void FastQSeq_RemoveA(FastQSeq *self);
 void FastQSeq_RemoveBarcode(FastQSeq *self, int barcode_length);
-void FastQSeq_SetBits(FastQSeq *self);
+//number of words needed by FastQSeq_SetBits
+size_t FastQSeq_BitsWords(size_t length);
+//pack the sequence into bits, which must hold FastQSeq_BitsWords words
+void FastQSeq_SetBits(FastQSeq *self, unsigned long long *bits);
+//compare the packed sequences of two reads, 1 if identical
+int FastQSeq_Equal(const FastQSeq *lhs, const FastQSeq *rhs);
+unsigned long long FastQSeq_Hash(const FastQSeq *self);
+
+//bump allocator for reads which are kept, everything is freed at once
+typedef struct ArenaBlock ArenaBlock;
+
+struct ArenaBlock {
+    ArenaBlock *prev;
+    size_t size, used;
+    char data[];
+};
+
+typedef struct {
+    ArenaBlock *head, *spare;
+    size_t block_size, total;
+} Arena;
+
+typedef struct {
+    ArenaBlock *block;
+    size_t used;
+} ArenaMark;
+
+Arena *Arena_New(size_t block_size);
+void Arena_Free(Arena *self);
+void *Arena_Alloc(Arena *self, size_t size);
+//undo all allocations made since mark was taken
+ArenaMark Arena_Mark(Arena *self);
+void Arena_Rewind(Arena *self, ArenaMark mark);
+//free the block the last rewind kept for reuse
+void Arena_Trim(Arena *self);
+
+//copy a read, and its packed sequence, into the arena
+FastQSeq *FastQSeq_Copy(Arena *arena, const FastQSeq *src);
+
+//read FASTQ records by parsing large blocks in place
+typedef struct {
+    gzFile f;
+    char *buffer;
+    size_t size, start, end;
+    int eof;
+} FastQReader;
+
+FastQReader *FastQReader_New(gzFile f);
+void FastQReader_Free(FastQReader *self);
+//read the next record into seq, which is valid until the next call. Returns 1
+// on success, 0 at the end of the file or -1 on error
+int FastQReader_Next(FastQReader *self, FastQSeq *seq);
 
 void get_barcode(const FastQSeq* s, const char* barcode_format, char* barcode);
 void get_umi(const FastQSeq* s, const char* barcode_format, char* barcode);
+int get_barcode_length(const char* barcode_format);
 int get_umi_length(const char* barcode_format);
-long get_umi_long(const char* umi);
+//pack a UMI of up to MAX_UMI_LENGTH bases into code, with a bit set in n_mask
+// for each base which isn't A, C, G or T
+void get_umi_code(const char* umi, unsigned long long *code,
+        unsigned long long *n_mask);
 
 
-typedef struct SeqItem SeqItem;
+//2-bit encode length bases of seq into code, returns 0 if there are any bases
+// other than A, T, C or G
+int encode_bases(const char* seq, size_t length, unsigned long long *code);
 
-struct SeqItem {
-    FastQSeq *the_seq;
-    SeqItem *next, *prev;
-};
+//map barcodes to sample indexes. Short barcodes are indexed directly by their
+// 2-bit code, longer ones are hashed. Reads within Hamming distance one of a
+// barcode can be precomputed into the same table
+#define BARCODE_NONE -1
+#define BARCODE_AMBIGUOUS -2
+#define BARCODE_DIRECT_MAX 10
+
+typedef struct {
+    size_t length, capacity;
+    int direct;
+    unsigned long long *keys;
+    int *values;
+} BarcodeTable;
+
+BarcodeTable *BarcodeTable_New(const char **barcodes, int num_barcodes,
+        size_t length, int mismatches);
+void BarcodeTable_Free(BarcodeTable *self);
+//return the sample index of barcode, or a negative value if it doesn't match
+int BarcodeTable_Lookup(const BarcodeTable *self, const char *barcode);
+
+//open-addressing hash set of reads, keyed on UMI and packed sequence
+typedef struct {
+    unsigned long long hash, umi, umi_n;
+    FastQSeq *seq;
+} SeqSetEntry;
+
+typedef struct {
+    SeqSetEntry *entries;
+    size_t size, capacity;
+} SeqSet;
+
+SeqSet *SeqSet_New(size_t size_hint);
+void SeqSet_Free(SeqSet *self);
+//add seq to the set unless an identical read is already present, setting
+// *added if it was. Returns the entry holding the read, or NULL if memory could
+// not be allocated
+SeqSetEntry *SeqSet_Insert(SeqSet *self, unsigned long long umi, 
+        unsigned long long umi_n, FastQSeq *seq, int *added);
+//add seq to the set, return 1 if it was added or 0 if an identical read is
+// already present. Returns -1 if memory could not be allocated. The set never
+// owns the reads
+int SeqSet_Add(SeqSet *self, unsigned long long umi, unsigned long long umi_n,
+        FastQSeq *seq);
+//iterate through the set, pos should start at 0. Returns NULL when done
+FastQSeq *SeqSet_Next(SeqSet *self, size_t *pos);
+//empty the set, keeping its capacity
+void SeqSet_Clear(SeqSet *self);
+//empty the set and shrink it back to its smallest capacity. Returns 0 if
+// memory could not be allocated, in which case it's emptied but not shrunk
+int SeqSet_Shrink(SeqSet *self);
+//write the reads in the set to f sorted by UMI then sequence, and empty the
+// set. Returns 0 if the write failed
+int SeqSet_Spill(SeqSet *self, FILE *f);
+
+//order reads by UMI then packed sequence, 0 if they're duplicates
+int SeqKey_Compare(unsigned long long lumi, unsigned long long lumi_n,
+        const FastQSeq *lhs, unsigned long long rumi, unsigned long long rumi_n,
+        const FastQSeq *rhs);
+
+//a sorted run of reads spilled to disk. Runs are numbered in the order they
+// were written, so that the first copy of a read can be kept when they're
+// merged
+typedef struct {
+    FILE *f;
+    int index;
+    unsigned long long umi, umi_n;
+    FastQSeq seq;
+    char *buffer;
+    unsigned long long *bits;
+    size_t buffer_size, bits_size;
+} RunReader;
+
+//write a read with its UMI to a run
+int Run_Write(FILE *f, unsigned long long umi, unsigned long long umi_n,
+        const FastQSeq *seq);
+//read the next read of the run into self->seq. Returns 1 on success, 0 at the
+// end of the run or -1 on error
+int RunReader_Next(RunReader *self);
+void RunReader_Close(RunReader *self);
+
+//deduplicate a single sample. Doesn't touch any python objects so can be run
+// without the GIL. Errors are reported in error and message. A job either reads
+// its sample from in_name, or is given the reads one at a time by dedup_add
+#define JOB_IO_ERROR 1
+#define JOB_MEMORY_ERROR 2
+
+typedef struct {
+    const char *sample, *in_name, *out_name, *barcode_format;
+    size_t barcode_length;
+    gzFile out;
+    long length, count;
+    //length_dist[i] is the number of reads of length i, grown as needed
+    long *length_dist;
+    size_t dist_size;
+    int remove_input, verbose, error;
+    char message[ERROR_SIZE];
+    //if max_memory isn't 0, reads are spilled to sorted runs in scratch_dir
+    // whenever the reads held in memory would take more than max_memory bytes
+    size_t max_memory;
+    const char *scratch_dir;
+    RunReader *runs;
+    int num_runs;
+    //the reads kept so far
+    SeqSet *unique;
+    Arena *arena;
+} DedupJob;
+
+//deduplicate the reads in job->in_name. Returns 0 on error
+int dedup_sample(DedupJob *job);
+//allocate the job's set of reads, sized for job->length reads and for budget
+// bytes of them, 0 for no limit. Returns 0 if memory could not be allocated
+int dedup_open(DedupJob *job, size_t budget);
+//trim a read and keep it if it isn't a duplicate. Returns 0 on error
+int dedup_add(DedupJob *job, FastQSeq *view);
+//the memory taken by the reads the job holds, counting its arena's blocks whole
+size_t dedup_held(const DedupJob *job);
+//write the reads kept to the job's output and close it. Returns 0 on error
+int dedup_write(DedupJob *job);
+//free the reads and runs the job holds
+void dedup_free(DedupJob *job);
+//spill the reads held to a new run and free them, along with the memory which
+// held them. Returns 0 on error
+int dedup_spill(DedupJob *job);
+//merge the job's runs into one. Reads go to out as a new run, or to the job's
+// output if out is NULL. Returns 0 on error
+int dedup_merge(DedupJob *job, FILE *out);
+void dedup_close_runs(DedupJob *job);
+
+typedef struct {
+    DedupJob *jobs;
+    //called on each job
+    int (*fn)(DedupJob *job);
+    int num_jobs, next;
+    pthread_mutex_t lock;
+} JobQueue;
 
-SeqItem *SeqItem_New(FastQSeq *seq);
-void SeqItem_Free(SeqItem *self);
-void SeqItem_Append(SeqItem* self, SeqItem* rhs);
-void SeqItem_Prepend(SeqItem **head, SeqItem* self, SeqItem* rhs);
-//iterate through the list, return True if there is a next, otherwise
-// next is unchanged
-int SeqItem_Next(SeqItem **next);
-size_t SeqItem_Length(SeqItem *s);
+void run_jobs(JobQueue *queue, int workers);
@@ -0,0 +1,103 @@
+"""Run jobs concurrently within a budget of CPU cores"""
+
+import threading, sys
+
+class Job(object):
+	"""A function to call, the number of cores it will use and the jobs which
+	must finish before it can start"""
+
+	def __init__(self, fn, args, kwargs, cores, name, after):
+		self.fn = fn
+		self.args = args
+		self.kwargs = kwargs
+		self.cores = cores
+		self.name = name
+		self.after = list(after)
+		self.done = False
+		self.result = None
+		self.error = None
+
+	def __call__(self):
+		try:
+			self.result = self.fn(*self.args, **self.kwargs)
+		except Exception:
+			self.error = sys.exc_info()
+
+	def ready(self):
+		"""True if all the jobs this one depends on have finished successfully"""
+		return all(job.done and not job.error for job in self.after)
+
+class Scheduler(object):
+	"""Run jobs in threads, never running jobs needing more than cores at once
+
+	Jobs are expected to spend their time waiting on external programs, such as
+	TopHat, so threads are enough to keep all the cores busy
+	"""
+
+	def __init__(self, cores=1):
+		if cores < 1:
+			raise ValueError("cores must be at least 1, not {}".format(cores))
+		self.cores = cores
+		self.jobs = []
+
+	def add(self, fn, args=(), kwargs=None, cores=1, name=None, after=()):
+		"""Add fn(*args, **kwargs) as a job which uses cores cores and can only
+		start once the jobs in after have finished. A job which needs more than 
+		the total number of cores runs on its own. Returns the job"""
+		if name is None:
+			name = len(self.jobs)
+		for job in after:
+			if job not in self.jobs:
+				raise ValueError("Job {} depends on unknown job {}".format(name,
+					job.name))
+		job = Job(fn, args, kwargs or {}, max(1, min(cores, self.cores)), name,
+				after)
+		self.jobs.append(job)
+		return job
+
+	def run(self):
+		"""Run all the jobs, starting them in the order they were added whenever
+		their dependencies have finished and enough cores are free. A ready job
+		which doesn't fit holds back the ready jobs added after it. Returns a 
+		dictionary mapping job names to return values. If any job raises, no more
+		are started and the first exception is re-raised once the running jobs 
+		have finished"""
+		jobs, self.jobs = self.jobs, []
+		pending = list(jobs)
+		running = []
+		free = [self.cores]
+		finished = threading.Condition()
+		error = None
+
+		def target(job):
+			job()
+			with finished:
+				free[0] += job.cores
+				running.remove(job)
+				job.done = True
+				finished.notify()
+
+		with finished:
+			while running or (pending and error is None):
+				#start every ready job we have room for, in order
+				for job in [j for j in pending if j.ready()]:
+					if error is not None or job.cores > free[0]:
+						break
+					pending.remove(job)
+					free[0] -= job.cores
+					running.append(job)
+					t = threading.Thread(target=target, args=(job,), 
+							name=str(job.name))
+					t.daemon = True
+					t.start()
+
+				#time out so that KeyboardInterrupt is delivered
+				finished.wait(1)
+
+				if error is None:
+					error = next((j.error for j in jobs if j.error), None)
+
+		if error is not None:
+			raise error[0], error[1], error[2]
+
+		return dict((job.name, job.result) for job in jobs)
@@ -5,6 +5,9 @@ Read and validate settings for waistcoat
 import simplejson as json
 import os.path, tophat
 
+#must match MAX_UMI_LENGTH in preprocess.h
+MAX_UMI_LENGTH = 32
+
 def loadf(fname):
 	"""Read settings from a JSON formatted file"""
 	try:
@@ -32,6 +35,8 @@ class Settings(object):
 
 		self.barcode_format = valid_data['barcode_format'].upper()
 		self.barcodes = valid_data['barcodes']
+		self.barcode_mismatches = valid_data.get('barcode_mismatches', 0)
+		self.discard_mode = valid_data.get('discard_mode', 'tophat')
 
 		self.discard = []
 		if valid_data.has_key('discard'):
@@ -49,6 +54,7 @@ class Settings(object):
 
 		self.target = (get_index(valid_data['target'], fname), 
 				valid_data.get('target_settings',{}),)
+		self.map_mode = valid_data.get('map_mode', 'tophat')
 
 
 	def strip_header(self, record):
@@ -100,6 +106,15 @@ def validate(data, fname='./settings.json'):
 			'Required key \'{}\' not found'.format(
 				e.message))
 
+	if data.has_key('barcode_mismatches'):
+		validate_barcode_mismatches(data['barcode_mismatches'])
+
+	if data.has_key('discard_mode'):
+		validate_discard_mode(data['discard_mode'])
+
+	if data.has_key('map_mode'):
+		validate_map_mode(data['map_mode'])
+
 	#test discard
 	if data.has_key('discard'):
 		validate_discard(data['discard'], fname)
@@ -113,8 +128,9 @@ def validate(data, fname='./settings.json'):
 			data['target_settings'])
 
 	#check for unused settings
-	known_settings = ['barcode_format', 'barcodes', 'target', 'target_settings',
-			'discard', 'discard_settings',]
+	known_settings = ['barcode_format', 'barcodes', 'barcode_mismatches', 
+			'target', 'target_settings', 'map_mode', 'discard', 'discard_mode', 
+			'discard_settings',]
 	known_settings += [os.path.basename(index) + '_settings' for index in 
 			data.get('discard', [])]
 	for setting in data.iterkeys():
@@ -222,6 +238,12 @@ def validate_barcode_format(barcode_fmt):
 	for char in barcode_fmt.upper():
 		if char not in "BN":
 			raise SettingsError('\'barcode_fmt\' characters must be B or N')
+
+	#UMIs are packed into 64 bits
+	if barcode_fmt.upper().count('N') > MAX_UMI_LENGTH:
+		raise SettingsError(
+				'\'barcode_fmt\' UMIs can be at most {} bases long'.format(
+					MAX_UMI_LENGTH))
 	
 def validate_barcodes(barcodes, barcode_fmt):
 	length = sum([1 for b in barcode_fmt.upper() if b == 'B'])
@@ -253,6 +275,26 @@ def validate_barcodes(barcodes, barcode_fmt):
 					', barcode = {}, format	= {}'.format(len(barcode), length)))
 			break
 
+def validate_barcode_mismatches(mismatches):
+	"""Check the number of mismatches allowed when matching barcodes"""
+	if isinstance(mismatches, bool) or mismatches not in (0, 1):
+		raise SettingsError(
+				'\'barcode_mismatches\' should be 0 or 1, not {}'.format(mismatches))
+
+def validate_discard_mode(mode):
+	"""Check the program used to discard reads"""
+	if mode not in ('tophat', 'bowtie2'):
+		raise SettingsError(
+				'\'discard_mode\' should be \'tophat\' or \'bowtie2\', not {}'.format(
+					mode))
+
+def validate_map_mode(mode):
+	"""Check how reads are mapped to the target"""
+	if mode not in ('tophat', 'bowtie2_first'):
+		raise SettingsError(
+				'\'map_mode\' should be \'tophat\' or \'bowtie2_first\', not {}'
+				.format(mode))
+
 example_settings = """{
 "_comment": "This is an example settings file for waistcoat. Comments begin with underscores",
 
@@ -265,12 +307,18 @@ example_settings = """{
 	"sample 2": "GCGAT"
 	},
 
+"_barcode_mismatches": "OPTIONAL. Assign reads whose barcode has this many mismatches (0 or 1) to the nearest sample",
+"barcode_mismatches": 0,
+
 "_discard": "OPTIONAL. Sequences which map to indexes listed here will be discarded",
 "discard": [
 	"path/to/discard_index_base1",
 	"discard_index_base2"
 	],
 
+"_discard_mode": "OPTIONAL. Discard with 'tophat' (default) or with 'bowtie2', which streams reads through every index in one pass and ignores TopHat-only settings",
+"discard_mode": "tophat",
+
 "_discard_settings": "OPTIONAL. Default settings for tophat when discarding",
 "discard_settings": {
 	"_comment": "settings go here as key value pairs, e.g. this sets --max-insertion-length 5",
@@ -288,7 +336,10 @@ example_settings = """{
 "_target_settings": "OPTIONAL. Settings for final mapping",
 "target_map_settings": {
 	"_comment": "Settings go here"
-	}
+	},
+
+"_map_mode": "OPTIONAL. Map with 'tophat' (default), or 'bowtie2_first' to map end-to-end with bowtie2 and only pass the reads which don't align on to TopHat's spliced search",
+"map_mode": "tophat"
 }
 """
 
@@ -1,18 +1,62 @@
-import csv, os, os.path, pysam
+import csv, os, os.path, array
+import numpy
 
 recording = True
-#for length recording
-max_len = 128
+
+#stage whose read lengths are reported as the final lengths
+FINAL = 'final_seqs'
 
 #data
 names = []
 data = {}
-lengths = {}
+#read length histograms, {stage: {sample: Histogram}}
+histograms = {}
+
+class Histogram(object):
+	"""Counts of read lengths which grows to fit the longest read. Lengths are
+	buffered as they are added and counted in bulk"""
+
+	buffer_size = 1 << 16
+
+	def __init__(self):
+		self._counts = numpy.zeros(0, dtype=numpy.int64)
+		self._pending = array.array('l')
+
+	def add(self, length):
+		"""Count a read of length"""
+		self._pending.append(length)
+		if len(self._pending) >= self.buffer_size:
+			self._flush()
+
+	def merge(self, counts):
+		"""Add counts, where counts[i] is the number of reads of length i"""
+		counts = numpy.asarray(counts, dtype=numpy.int64)
+		self._grow(len(counts))
+		self._counts[:len(counts)] += counts
+
+	@property
+	def counts(self):
+		"""Array of counts, trimmed after the longest read"""
+		self._flush()
+		nonzero = numpy.flatnonzero(self._counts)
+		return self._counts[:nonzero[-1] + 1 if len(nonzero) else 0]
+
+	def _flush(self):
+		if self._pending:
+			self.merge(numpy.bincount(numpy.frombuffer(self._pending, 
+				dtype=numpy.dtype(self._pending.typecode))))
+			self._pending = array.array('l')
+
+	def _grow(self, size):
+		if size > len(self._counts):
+			counts = numpy.zeros(max(size, 2 * len(self._counts)), dtype=numpy.int64)
+			counts[:len(self._counts)] = self._counts
+			self._counts = counts
 
 def clear():
 	"""clear recorded statistics"""
 	data.clear()
-	lengths.clear()
+	histograms.clear()
 	del names[0:len(names)]
 
 def setUp(sample_names):
@@ -37,14 +81,22 @@ def addValues(name, new_data):
 		data[sample].append(value)
 	names.append(name)
 
-def collectFinalStats(sample, samfile):
-	"""Collect statistics from output samfile"""
-	l = [0,] * max_len
-	for alg in pysam.Samfile(samfile, 'rb'):
-		if alg.alen >= 0 and alg.alen < max_len:
-			l[alg.alen] += 1
-	
-	lengths[sample] = l
+def values():
+	"""Return the recorded measurements as a list of (name, {sample: value})"""
+	return [(name, dict((sample, v[i]) for sample,v in data.iteritems()))
+			for i,name in enumerate(names)]
+
+def collector(stage, sample):
+	"""Return the Histogram which records the lengths of sample's reads as they
+	pass through stage. Stages should add each read as they handle it"""
+	if not recording:
+		return Histogram()
+	return histograms.setdefault(stage, {}).setdefault(sample, Histogram())
+
+def lengths(stage=FINAL):
+	"""Return {sample: counts} of read lengths recorded for stage"""
+	return dict((sample, h.counts) for sample,h in 
+			histograms.get(stage, {}).iteritems())
 
 def prettyString():
 	"""return a pretty representation of the statistics"""
@@ -67,22 +119,21 @@ def prettyString():
 	for sample, values in data.iteritems():
 		ret.append(line.format(sample, *values))
 
-	l_start = max_len
-	l_end = 0
-	for sample,l in lengths.iteritems():
-		s = next((i for i,x in enumerate(l) if x))
-		if s < l_start: l_start = s
-		e = len(l) - next((i for i,x in enumerate(reversed(l)) if x))
-		if e > l_end: l_end = e
-
-	maximum = max(sum(x[i] for x in lengths.values()) for i in range(max_len))
-	if maximum:
-		scale = 50.0 / float(maximum)
+	total = numpy.zeros(0, dtype=numpy.int64)
+	for l in lengths().itervalues():
+		if len(l) > len(total):
+			total = numpy.concatenate((total, 
+				numpy.zeros(len(l) - len(total), dtype=numpy.int64)))
+		total[:len(l)] += l
+
+	nonzero = numpy.flatnonzero(total)
+	if len(nonzero):
+		(l_start, l_end) = (nonzero[0], nonzero[-1] + 1)
+		scale = 50.0 / float(total.max())
 		ret.append('Read Lengths:')
 		fmt = "\t{{:>{}d}}: {{}}".format(len(str(l_end)))
 		for i in range(l_start, l_end):
-			value = sum(x[i] for x in lengths.itervalues())
-			ret.append(fmt.format(i, '*'*int(scale*value)))
+			ret.append(fmt.format(i, '*'*int(scale*total[i])))
 
 		ret.append('\t\t* = {:.1f} reads'.format(1.0 / scale))
 
@@ -102,9 +153,14 @@ def write(directory):
 		for sample, values in data.iteritems():
 			out.writerow([sample,] + values)
 
-	with open(os.path.join(directory, 'lengths.csv'), 'wb') as csvfile:
-		out = csv.writer(csvfile, delimiter=' ')
-		out.writerow(['sample'] + range(0,max_len))
-		for sample, l in lengths.iteritems():
-			out.writerow([sample,] + l)
+	#final lengths go in lengths.csv, other stages in lengths_[stage].csv
+	for stage in histograms.iterkeys():
+		name = 'lengths.csv' if stage == FINAL else 'lengths_{}.csv'.format(stage)
+		l = lengths(stage)
+		width = max(len(x) for x in l.itervalues())
+		with open(os.path.join(directory, name), 'wb') as csvfile:
+			out = csv.writer(csvfile, delimiter=' ')
+			out.writerow(['sample'] + range(0,width))
+			for sample, x in l.iteritems():
+				out.writerow([sample,] + list(x) + [0,] * (width - len(x)))
 
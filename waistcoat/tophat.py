@@ -1,7 +1,6 @@
 """Interface with the tophat program"""
 
-import command, tempfile, pysam, os.path, shutil
-from Bio import SeqIO
+import command, tempfile, pysam, gzip, os.path, shutil
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
@@ -199,15 +198,25 @@ def is_valid(settings):
 		pass
 	return False
 
+def output_name(reads_file, suffix, compress = 0):
+	"""Name the reads a stage writes from reads_file, e.g. "x.fq" becomes
+	"x_nomapping.fq", or "x_nomapping.fq.gz" if compress isn't 0"""
+	if reads_file.endswith('.gz'):
+		reads_file = reads_file[:-3]
+	return (reads_file[0:reads_file.rfind('.')] + suffix + 
+			(".fq.gz" if compress else ".fq"))
+
 def discard_mapped(reads_file, index_base, tophat_settings = None, 
-			suffix="_nomapping"):
-	"""Map reads to the index and discard all the reads which map successfully"""
+			suffix="_nomapping", lengths = None, compress = 0):
+	"""Map reads to the index and discard all the reads which map successfully
+	lengths: statistics.Histogram to add the lengths of the remaining reads to
+	compress: gzip level to write the remaining reads at, 0 for plain FASTQ"""
 	tempd = tempfile.mkdtemp(prefix='waistcoat')
 
-	outfile_name = reads_file[0:reads_file.rfind('.')] + suffix + ".fq"
+	outfile_name = output_name(reads_file, suffix, compress)
 	
 	if tophat_settings:
-		th = load_settings(tophat_settings)
+		th = tophat_from_settings(tophat_settings)
 	else:
 		th = TopHat()
 	
@@ -220,21 +229,44 @@ def discard_mapped(reads_file, index_base, tophat_settings = None,
 	#open the hits
 	samfile = pysam.Samfile(os.path.join(tempd, "unmapped.bam"), "rb")
 
-	outfile = open(outfile_name, "wb")
-	count = 0
-	#write out FASTQ records
-	for read in samfile:
-		count += 1
-		SeqIO.write(build_fastq(read), outfile, 'fastq')
-
+	if compress:
+		outfile = gzip.GzipFile(outfile_name, "wb", compress)
+	else:
+		outfile = open(outfile_name, "wb", FASTQ_BUFFER)
+	with outfile:
+		count = write_fastq(samfile, outfile, lengths)
+	samfile.close()
 
 	shutil.rmtree(tempd)
 	os.remove(reads_file)
 
-	outfile.close()
-
 	return (outfile_name, count)
 
+#size of the output buffer and number of records formatted per write
+FASTQ_BUFFER = 1 << 20
+FASTQ_BATCH = 4096
+
+def write_fastq(reads, outfile, lengths = None):
+	"""Write the BAM reads to outfile in FASTQ format and return how many there
+	were. Records are formatted straight from the BAM fields and written in
+	batches. If given, the length of each read is added to lengths"""
+	count = 0
+	batch = []
+	for read in reads:
+		qual = read.qual
+		if qual is None:
+			raise ValueError("Read \'{}\' has no qualities".format(read.qname))
+		if lengths is not None:
+			lengths.add(len(qual))
+		batch.append("@{}\n{}\n+\n{}\n".format(read.qname, read.seq, qual))
+		if len(batch) == FASTQ_BATCH:
+			outfile.write(''.join(batch))
+			count += len(batch)
+			batch = []
+
+	outfile.write(''.join(batch))
+	return count + len(batch)
+
 
 # Precompute conversion table
 SANGER_SCORE_OFFSET = ord("!")
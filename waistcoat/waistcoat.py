@@ -1,24 +1,37 @@
 """Main pipeline file"""
 
-import argparse, sys, gzip, tempfile, shutil, os,os.path, pysam
+import argparse, sys, tempfile, shutil, os,os.path, pysam
 
-import settings, tophat, postprocess, statistics
-import preprocess
+import settings, tophat, bowtie2, postprocess, statistics, scheduler
+import preprocess, checkpoint, cache, instrument, collapse
 
 tophat.verbose = False
 
 verbose = True
 check_output = True
 
+#completed stages are recorded here so that the run can be resumed
+MANIFEST = 'checkpoints.json'
+#name the stages shared by every sample are recorded under when reads are 
+# collapsed
+COLLAPSED = 'all samples'
+
 def main():
 	
 	#parse command line
 	my_args = get_arguments()
-	run(my_args.settings, my_args.reads, my_args.output, extend=my_args.extend)
+	run(my_args.settings, my_args.reads, my_args.output, extend=my_args.extend,
+			cores=my_args.cores, resume=my_args.resume, cache_dir=my_args.cache,
+			cache_size=int(my_args.cache_size * (1 << 30)),
+			max_memory=int(my_args.max_memory * (1 << 30)),
+			two_pass=my_args.two_pass, compress=my_args.compress,
+			collapse=my_args.collapse, hash_reads=my_args.hash_reads)
 
-def run(settings_file, reads, outdir, temp_loc=None, extend=False):
+def run(settings_file, reads, outdir, temp_loc=None, extend=False, cores=1,
+		resume=False, cache_dir=None, cache_size=cache.MAX_SIZE, max_memory=0,
+		two_pass=False, compress=0, collapse=False, hash_reads=False):
 
-	if os.path.exists(outdir):
+	if os.path.exists(outdir) and not resume:
 		if (check_output and not 
 				query_yes_no("Output path \"{}\" already exists, overwrite?"
 					.format(outdir))):
@@ -27,9 +40,21 @@ def run(settings_file, reads, outdir, temp_loc=None, extend=False):
 		
 		shutil.rmtree(outdir)
 
-	os.mkdir(outdir)
+	if not os.path.exists(outdir):
+		os.mkdir(outdir)
 
-	tempdir = tempfile.mkdtemp(prefix='waistcoat', dir=temp_loc)
+	#intermediate files are kept in a directory named after the output until
+	# the run completes, so that an interrupted run can pick them up again.
+	# Anything left by an earlier run is only wanted when resuming
+	tempdir = os.path.join(temp_loc or tempfile.gettempdir(), 'waistcoat.' + 
+			checkpoint.key(os.path.abspath(outdir))[:8])
+	if os.path.exists(tempdir) and not resume:
+		shutil.rmtree(tempdir)
+	if not os.path.exists(tempdir):
+		os.mkdir(tempdir)
+	manifest = checkpoint.Manifest(os.path.join(outdir, MANIFEST))
+	#results shared with other runs of the same reads
+	results = cache.Cache(cache_dir, cache_size) if cache_dir else None
 
 	#Read and validate settings for waistcoat
 	if verbose:
@@ -37,67 +62,109 @@ def run(settings_file, reads, outdir, temp_loc=None, extend=False):
 	my_settings = settings.loadf(settings_file)
 
 	statistics.setUp(my_settings.barcodes.keys())
+	instrument.clear()
 
-	#run the preprocessing pipeline
-	if verbose:
-		print "\n========== Preprocessing =========="
-	remove_input = False
-	if reads.endswith('.gz'):
+	#each sample's stages are keyed on everything their output depends on,
+	# starting from the reads, the barcode settings and whether intermediate
+	# reads are compressed. The reads are known by their path, size and
+	# modification time unless hash_reads is set, as hashing them means
+	# reading the whole lane an extra time
+	pre_key = checkpoint.key('preprocess', checkpoint.file_hash(reads) 
+			if hash_reads else checkpoint.file_id(reads),
+			my_settings.barcode_format, my_settings.barcodes,
+			my_settings.barcode_mismatches, bool(compress))
+
+	#each sample moves on to its next stage (discard against each index, map
+	# to the target then postprocess) as soon as its previous stage finishes
+	(target, target_settings) = my_settings.target
+	samples = [SamplePipeline(sample, None, outdir, manifest, results, tempdir,
+		compress) for sample in sorted(my_settings.barcodes.iterkeys())]
+	#extending is split across processes, sharing the cores between samples
+	post_cores = max(1, cores / len(samples)) if extend and samples else 1
+	#samples which need the output of preprocessing
+	pending = []
+	#when collapsing, the distinct sequences of all the samples are discarded
+	# and mapped once, then expanded back into each sample's hits
+	collapsed = None
+	if collapse:
+		collapsed = CollapsedPipeline(samples, tempdir, manifest, results,
+				compress)
+		if not collapsed.plan([('collapse', collapsed.collapse, (), 1, None),] +
+				mapping_stages(collapsed, my_settings) +
+				[('expand', collapsed.expand, (), 1, None),], pre_key):
+			pending.extend(samples)
+	for p in samples:
+		stages = [] if collapsed else mapping_stages(p, my_settings)
+		stages.append(('postprocess', p.postprocess, 
+			("{}.fa".format(target), extend, post_cores), post_cores, 
+			(target, extend)))
+
+		if (not p.plan(stages, collapsed.key if collapsed else pre_key) and
+				collapsed is None):
+			pending.append(p)
+
+	#run the preprocessing pipeline, unless its output is still around
+	record = manifest.get('preprocess', pre_key, outputs=False)
+	if record is None and results is not None and not pending:
+		record = results.get(pre_key)
+	if record is None or not all(checkpoint.unchanged(*record['files'][p.sample])
+			for p in pending):
 		if verbose:
-			print "Inflating..."
-		gzfile = gzip.GzipFile(reads, 'r')
-		(out, reads) = tempfile.mkstemp(dir=tempdir, prefix='input.', 
-											suffix='.inflated')
-		out = os.fdopen(out, 'w')
-		out.writelines(gzfile)
-		gzfile.close()
-		out.close()
-		remove_input = True
-
-	files = preprocess.run(reads, my_settings, tempdir, remove_input)
-
-	#discard those which map to discard
-	if verbose:
-		print "\n========== Discard =========="
-	for i,(index, dcs) in enumerate(my_settings.discard):
-		new_files = {}
-		count = {}
+			print "\n========== Preprocessing =========="
+		#gzipped reads are decompressed as they are read
+		with instrument.stage('preprocess', whole_process=True) as s:
+			files = preprocess.run(reads, my_settings, tempdir, False, cores,
+					max_memory, not two_pass, compress)
+			s.reads = sum(dict(statistics.values()).get('split_by_barcode', 
+				{}).itervalues())
+		record = manifest.complete('preprocess', pre_key, files.values(),
+				files = dict((sample, (f, os.path.getsize(f))) 
+					for sample,f in files.iteritems()),
+				values = statistics.values(),
+				lengths = dict((sample, [int(x) for x in l]) 
+					for sample,l in statistics.lengths('clean').iteritems()))
+		if results is not None:
+			results.put(pre_key, stage = 'preprocess',
+					values = record['values'], lengths = record['lengths'])
+	else:
 		if verbose:
-			print "Removing reads which map to \'{}\' ({}/{})...".format(index,
-					i+1, len(my_settings.discard))
-		for sample,f in files.iteritems():
-			if verbose:
-				print "\tScanning \'{}\'".format(sample)
-			(new_files[sample], count[sample]) = (
-					tophat.discard_mapped(f, index, tophat_settings = dcs))
-		files = new_files
-		statistics.addValues('discard_' + os.path.basename(index), count)
-
-	#map to genome
-	(target, target_settings) = my_settings.target
+			print "\n========== Resuming after Preprocessing =========="
+		for (name, values) in record['values']:
+			statistics.addValues(name, values)
+		for sample,l in record['lengths'].iteritems():
+			statistics.collector('clean', sample).merge(l)
+	for p in pending:
+		p.reads = record['files'][p.sample][0]
+	clean = dict(statistics.values()).get('clean', {})
+	for p in samples:
+		if p.n_reads is None:
+			p.n_reads = clean.get(p.sample)
+
 	if verbose:
-		print "\n========== Map to {} ==========".format(os.path.basename(target))
-	th = tophat.tophat_from_settings(target_settings)
-	for i,(sample,f) in enumerate(files.iteritems()):
-		th.output_dir = os.path.join(outdir, sample)
-		os.mkdir(th.output_dir)
-		if verbose: print "Mapping {} ({}/{})...".format(sample, i+1, len(files))
-		th.run(f, index_base = target)
-		os.remove(f)
-		
-	if verbose: print "\n========== Postprocess =========="
-	count = {}
-	for i,(sample,f) in enumerate(files.iteritems()):
-		if verbose: print "{} ({}/{})...".format(sample, i+1, len(files))
-		
-		out = os.path.join(outdir, '{}.bam'.format(sample))
-		count[sample] = postprocess.run(outdir, sample,	"{}.fa".format(target),
-				extend=extend)
-		statistics.collectFinalStats(sample, out)
-		
-	statistics.addValues('final_seqs', count)
+		print "\n========== Discard, Map to {} and Postprocess ==========".format(
+				os.path.basename(target))
+	jobs = scheduler.Scheduler(cores)
+	def add_stages(p, last):
+		for (stage, key, fn, args, stage_cores) in p.stages:
+			last = [jobs.add(p.run_stage, (stage, key, fn, args), 
+				cores = stage_cores,
+				name = "{} {}".format(p.sample, stage), after = last),]
+		return last
+	shared = add_stages(collapsed, []) if collapsed else []
+	for p in samples:
+		add_stages(p, shared)
+	jobs.run()
+
+	#record statistics in pipeline order
+	for index, dcs in my_settings.discard:
+		name = 'discard_' + os.path.basename(index)
+		statistics.addValues(name, collapsed.counts[name] if collapsed else
+				dict((p.sample, p.counts[name]) for p in samples))
+	statistics.addValues('final_seqs', dict((p.sample, p.counts['final_seqs'])
+		for p in samples))
 
 	statistics.write(os.path.join(outdir, 'statistics'))
+	instrument.write(os.path.join(outdir, 'statistics'))
 	
 	shutil.rmtree(tempdir)
 
@@ -105,16 +172,334 @@ def run(settings_file, reads, outdir, temp_loc=None, extend=False):
 		print "\n__________ Pipeline Statistics __________"
 		print statistics.prettyString()
 
+def mapping_stages(p, my_settings):
+	"""The stages which discard the reads of the pipeline p against each index
+	then map them to the target"""
+	stages = []
+	if my_settings.discard_mode == 'bowtie2':
+		#one bowtie2 per index, all running at once
+		if my_settings.discard:
+			stages.append(('discard', p.discard_all, (my_settings.discard,),
+				sum(bowtie2.bowtie2_from_settings(dcs).num_threads or 1
+					for index, dcs in my_settings.discard),
+				my_settings.discard))
+	else:
+		for i,(index, dcs) in enumerate(my_settings.discard):
+			stages.append(('discard {}'.format(i), p.discard, (index, dcs), 
+				tophat.tophat_from_settings(dcs).num_threads or 1, (index, dcs)))
+
+	(target, target_settings) = my_settings.target
+	stages.append(('map', p.map, (target, target_settings, 
+		my_settings.map_mode),
+		tophat.tophat_from_settings(target_settings).num_threads or 1,
+		(target, target_settings, my_settings.map_mode)))
+	return stages
+
+class SamplePipeline(object):
+	"""The stages which each sample goes through after preprocessing. Each stage
+	updates the sample's reads, records the number of reads left in counts and
+	returns the files it produced"""
+
+	#stages whose results can be shared between runs through a cache.Cache
+	cached = ('discard', 'discard_all',)
+
+	def __init__(self, sample, reads, outdir, manifest=None, results=None,
+			workdir=None, compress=0):
+		self.sample = sample
+		self.reads = reads
+		self.outdir = outdir
+		self.manifest = manifest
+		self.results = results
+		self.workdir = workdir
+		#gzip level of the reads written between stages, 0 for plain FASTQ
+		self.compress = compress
+		self.counts = {}
+		#the number of reads going into the next stage
+		self.n_reads = None
+		#stages which have recorded the lengths of this sample's reads
+		self.histograms = set()
+		self.stages = []
+
+	def plan(self, stages, key):
+		"""Work out the key of each of stages, a list of (name, function, args,
+		cores, settings which affect the output), and skip those up to the last
+		one which has already completed. The key of the last stage is kept in
+		self.key. Returns True if any were skipped"""
+		key = checkpoint.key(key, self.sample)
+		self.stages = []
+		for (stage, fn, args, cores, depends) in stages:
+			key = checkpoint.key(stage, depends, key)
+			self.stages.append((stage, key, fn, args, cores))
+		self.key = key
+
+		if self.manifest is None:
+			return False
+		for i in reversed(range(len(self.stages))):
+			(stage, key, fn) = self.stages[i][:3]
+			record = self.manifest.get(self._name(stage), key)
+			if (record is None and self.results is not None and 
+					fn.__name__ in self.cached):
+				record = self.results.get(key, os.path.join(self.workdir,
+					'{}.{}.fq{}'.format(self.sample, key[:8], 
+						'.gz' if self.compress else '')))
+				if record is not None:
+					record = self.manifest.complete(self._name(stage), key, 
+							[record['reads'],], reads = record['reads'],
+							counts = record['counts'], lengths = record['lengths'],
+							n_reads = record.get('n_reads'))
+			if record is not None:
+				if verbose:
+					print "Resuming {} after {}".format(self.sample, stage)
+				self.reads = record['reads']
+				self.counts = record['counts']
+				self.n_reads = record.get('n_reads')
+				self._restore_lengths(record['lengths'])
+				self.stages = self.stages[i+1:]
+				return True
+		return False
+
+	def run_stage(self, stage, key, fn, args):
+		"""Run fn(*args), measuring the resources it uses, and record that stage
+		has completed"""
+		with instrument.stage(stage, self.sample) as s:
+			s.reads = self.n_reads
+			outputs = fn(*args)
+		lengths = self._lengths()
+		if self.manifest is not None:
+			self.manifest.complete(self._name(stage), key, outputs, 
+					reads = self.reads, counts = self.counts, lengths = lengths,
+					n_reads = self.n_reads)
+		if self.results is not None and fn.__name__ in self.cached:
+			self.results.put(key, self.reads, sample = self.sample, stage = stage,
+					counts = self.counts, lengths = lengths, n_reads = self.n_reads)
+
+	def _name(self, stage):
+		return "{}/{}".format(self.sample, stage)
+
+	def _collector(self, name):
+		return statistics.collector(name, self.sample)
+
+	def _lengths(self):
+		"""The read lengths recorded so far, to store with a completed stage"""
+		return dict((name, [int(x) for x in self._collector(name).counts])
+				for name in self.histograms)
+
+	def _restore_lengths(self, lengths):
+		"""Record the lengths stored by _lengths again"""
+		for name,l in lengths.iteritems():
+			self._collector(name).merge(l)
+		self.histograms = set(lengths)
+
+	def discard(self, index, discard_settings):
+		"""Remove reads which map to index"""
+		if verbose:
+			print "Removing reads from \'{}\' which map to \'{}\'...".format(
+					self.sample, index)
+		name = 'discard_' + os.path.basename(index)
+		(self.reads, count) = tophat.discard_mapped(self.reads, index, 
+				tophat_settings = discard_settings, 
+				lengths = self._collector(name), 
+				compress = self.compress)
+		self.counts[name] = count
+		self.n_reads = count
+		self.histograms.add(name)
+		return [self.reads,]
+
+	def discard_all(self, indexes):
+		"""Remove reads which map to any of indexes in a single bowtie2 pass"""
+		if verbose:
+			print "Removing reads from \'{}\' which map to {}...".format(
+					self.sample, ', '.join('\'{}\''.format(index) 
+						for index, dcs in indexes))
+		(self.reads, counts) = bowtie2.discard_mapped(self.reads, indexes,
+				compress = self.compress)
+		for (index, dcs), count in zip(indexes, counts):
+			self.counts['discard_' + os.path.basename(index)] = count
+		self.n_reads = counts[-1]
+		return [self.reads,]
+
+	def map(self, target, target_settings, map_mode='tophat'):
+		"""Map the reads to target with TopHat, then remove them. With map_mode
+		'bowtie2_first' the reads are mapped end-to-end with bowtie2 first, and
+		only those which fail to align are given to TopHat"""
+		if verbose: print "Mapping {}...".format(self.sample)
+		th = tophat.tophat_from_settings(target_settings)
+		th.output_dir = os.path.join(self.outdir, self.sample)
+		hits = os.path.join(th.output_dir, 'accepted_hits.bam')
+		#clear out anything left by an interrupted run
+		if os.path.exists(th.output_dir):
+			shutil.rmtree(th.output_dir)
+		os.mkdir(th.output_dir)
+
+		if map_mode == 'bowtie2_first':
+			premapped = os.path.join(self.workdir or th.output_dir, 
+					'{}.premapped.bam'.format(self.sample))
+			(unaligned, count) = bowtie2.map_reads(self.reads, target,
+					target_settings, premapped, compress = self.compress)
+			os.remove(self.reads)
+			self.reads = unaligned
+			if verbose: 
+				print "{} reads from {} left for TopHat".format(count, self.sample)
+			if count == 0:
+				shutil.move(premapped, hits)
+			else:
+				#both BAMs list the references in the index's order
+				th.keep_fasta_order = True
+				th.run(self.reads, index_base = target)
+				tophat_hits = os.path.join(th.output_dir, 'tophat_hits.bam')
+				os.rename(hits, tophat_hits)
+				pysam.merge(hits, tophat_hits, premapped)
+				os.remove(tophat_hits)
+				os.remove(premapped)
+		else:
+			th.run(self.reads, index_base = target)
+
+		os.remove(self.reads)
+		self.reads = None
+		return [hits,]
+
+	def postprocess(self, genome, extend, processes=1):
+		"""Postprocess the mapped reads and collect the final statistics"""
+		if verbose: print "Postprocessing {}...".format(self.sample)
+		self.counts['final_seqs'] = postprocess.run(self.outdir, self.sample,
+				genome, extend=extend, processes=processes)
+		self.histograms.add(statistics.FINAL)
+		bam = os.path.join(self.outdir, self.sample + '.bam')
+		return [bam, bam + '.bai',]
+
+class CollapsedPipeline(SamplePipeline):
+	"""The stages which every sample goes through together when their reads are
+	collapsed: each distinct sequence is discarded against the indexes and 
+	mapped to the target once, then its alignments are expanded back into the
+	accepted_hits.bam of each sample it was found in. The reads left after each
+	stage are counted for every sample, so counts maps each stage to 
+	{sample: reads}"""
+
+	#the reads are only meaningful with the table of counts, which isn't cached
+	cached = ()
+
+	def __init__(self, samples, workdir, manifest=None, results=None,
+			compress=0):
+		if any(p.sample == COLLAPSED for p in samples):
+			raise ValueError(("'{}' can't be used as a sample name when " +
+					"collapsing reads").format(COLLAPSED))
+		SamplePipeline.__init__(self, COLLAPSED, None, workdir, manifest, 
+				results, workdir, compress)
+		self.samples = samples
+		self.table = os.path.join(workdir, COLLAPSED + '.counts')
+
+	def collapse(self):
+		"""Collapse the reads of every sample into one copy of each sequence"""
+		if verbose: print "Collapsing {} samples...".format(len(self.samples))
+		reads = os.path.join(self.workdir, '{}.fq{}'.format(self.sample,
+			'.gz' if self.compress else ''))
+		self.n_reads = preprocess.collapse([p.reads for p in self.samples],
+				reads, self.table, self.compress)
+		for p in self.samples:
+			os.remove(p.reads)
+			p.reads = None
+		self.reads = reads
+		return [self.reads, self.table,]
+
+	def discard(self, index, discard_settings):
+		outputs = SamplePipeline.discard(self, index, discard_settings)
+		self._count('discard_' + os.path.basename(index), True)
+		return outputs
+
+	def discard_all(self, indexes):
+		"""Remove reads which map to any of indexes, one index at a time so that
+		the reads left after each can be counted"""
+		for (index, dcs) in indexes:
+			SamplePipeline.discard_all(self, [(index, dcs),])
+			self._count('discard_' + os.path.basename(index), True)
+		return [self.reads,]
+
+	def expand(self):
+		"""Copy each alignment into the accepted_hits.bam of every sample, once
+		for each time its read was found in the sample"""
+		if verbose: 
+			print "Expanding hits into {} samples...".format(len(self.samples))
+		mapped = os.path.join(self.outdir, self.sample)
+		outputs = []
+		for p in self.samples:
+			output_dir = os.path.join(p.outdir, p.sample)
+			if os.path.exists(output_dir):
+				shutil.rmtree(output_dir)
+			os.mkdir(output_dir)
+			outputs.append(os.path.join(output_dir, 'accepted_hits.bam'))
+		self._table().expand(os.path.join(mapped, 'accepted_hits.bam'), outputs)
+		shutil.rmtree(mapped)
+		return outputs
+
+	def _table(self):
+		return collapse.Table(self.table, [p.sample for p in self.samples])
+
+	def _count(self, name, lengths=False):
+		"""Count the reads left in each sample after stage name, and their
+		lengths if lengths is set"""
+		(counts, dist) = self._table().count(self.reads)
+		self.counts[name] = counts
+		if lengths:
+			for sample,l in dist.iteritems():
+				statistics.collector(name, sample).merge(l)
+			self.histograms.add(name)
+
+	def _collector(self, name):
+		#lengths are recorded for each sample by _count
+		return None
+
+	def _lengths(self):
+		return dict((name, dict((p.sample, [int(x) for x in 
+			statistics.collector(name, p.sample).counts]) 
+			for p in self.samples))
+			for name in self.histograms)
+
+	def _restore_lengths(self, lengths):
+		for name,l in lengths.iteritems():
+			for sample,counts in l.iteritems():
+				statistics.collector(name, sample).merge(counts)
+		self.histograms = set(lengths)
+
 def get_arguments():
 	parser = argparse.ArgumentParser(
 		description="Process RNA-seq reads and map them to a genome")
 
 	parser.add_argument('settings', help='Path to the waistcoat settings file')
-	parser.add_argument('reads', help='GZIPed fastq file containing reads')
+	parser.add_argument('reads', help='FASTQ file containing reads, optionally gzipped')
 	parser.add_argument('output', nargs='?', default='waistcoat_out/',
 			help='Directory to store output files')
 	parser.add_argument('--extend', action='store_true', 
 			help='Use the Extend postprocessing method')
+	parser.add_argument('--cores', type=int, default=1,
+			help='Number of CPU cores to use [1]')
+	parser.add_argument('--resume', action='store_true',
+			help='Continue an interrupted run in output, skipping the stages ' +
+			'which have already completed')
+	parser.add_argument('--cache', default=None, metavar='DIR',
+			help='Directory to keep the filtered reads of each sample in, so that ' +
+			'later runs with the same reads and discard settings can reuse them')
+	parser.add_argument('--hash-reads', action='store_true',
+			help='Recognise the reads by their contents rather than their path, ' +
+			'size and modification time when resuming or using the cache, so ' +
+			'that copies of them are recognised too. This reads them an extra ' +
+			'time')
+	parser.add_argument('--cache-size', type=float, default=cache.MAX_SIZE >> 30,
+			metavar='GB', help='Size to limit the cache to [{}]'.format(
+				cache.MAX_SIZE >> 30))
+	parser.add_argument('--max-memory', type=float, default=0, metavar='GB',
+			help='Memory to hold reads in while removing duplicates, beyond ' +
+			'which they are sorted on disk instead, 0 for no limit [0]')
+	parser.add_argument('--two-pass', action='store_true',
+			help='Split the reads into a file per sample before removing ' +
+			'duplicates, rather than doing both in one pass')
+	parser.add_argument('--compress', type=int, default=0, choices=range(10),
+			metavar='LEVEL', help='gzip the reads passed between stages at ' +
+			'LEVEL, 1 being fastest, which saves scratch space and I/O at the ' +
+			'cost of CPU. 0 writes plain FASTQ [0]')
+	parser.add_argument('--collapse', action='store_true',
+			help='Discard and map each distinct sequence once, however many ' +
+			'samples it was found in, then expand the hits back into each ' +
+			'sample. Only accepted_hits.bam is written for each sample')
 
 	return parser.parse_args()
 